@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import os
+import zipfile
+
+from image_executor import image_executor
+from response_encoding import dumps
+from uploads import UPLOAD_MAX_MB, UploadTooLarge, read_upload
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Batch settings
+BATCH_MAX_IMAGES = int(os.getenv('BATCH_MAX_IMAGES', '100'))
+BATCH_MAX_ARCHIVE_MB = float(os.getenv('BATCH_MAX_ARCHIVE_MB', '500'))
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', '4'))
+BATCH_MAX_PACK = int(os.getenv('BATCH_MAX_PACK', '8'))
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif', '.tif', '.tiff')
+
+
+class BatchError(Exception):
+    """
+    Raised for batches that can't be accepted (too many images, bad archive)
+    """
+
+
+class BatchEntry:
+    """
+    One image of a batch; bytes are only read when the entry is processed
+    """
+
+    def __init__(self, filename, reader):
+        self.filename = filename
+        self._reader = reader
+
+    async def read(self):
+        return await self._reader()
+
+
+def plan_batch(images, archive):
+    """
+    Build the ordered entry list from multipart files and/or a zip archive
+    """
+    # Each file is size- and magic-byte-checked as it's read; dimensions are checked in the worker before decoding
+    entries = [
+        BatchEntry(upload.filename, lambda upload=upload: asyncio.to_thread(read_upload, upload))
+        for upload in images or []
+    ]
+
+    if archive is not None:
+        try:
+            zf = zipfile.ZipFile(archive.file)
+        except zipfile.BadZipFile:
+            raise BatchError("archive is not a valid zip file")
+
+        members = [
+            info for info in zf.infolist()
+            if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS)
+            and not os.path.basename(info.filename).startswith('.')
+        ]
+        # Guard against zip bombs before anything is extracted
+        total_mb = sum(info.file_size for info in members) / (1024 * 1024)
+        if total_mb > BATCH_MAX_ARCHIVE_MB:
+            raise BatchError(f"archive expands to {total_mb:.0f}MB (limit {BATCH_MAX_ARCHIVE_MB:.0f}MB)")
+
+        for info in sorted(members, key=lambda m: m.filename):
+            entries.append(BatchEntry(info.filename, lambda info=info: asyncio.to_thread(_read_member, zf, info)))
+
+    if not entries:
+        raise BatchError("no images in request")
+    if len(entries) > BATCH_MAX_IMAGES:
+        raise BatchError(f"{len(entries)} images in batch (limit {BATCH_MAX_IMAGES})")
+    return entries
+
+
+def _read_member(zf, info):
+    if info.file_size > UPLOAD_MAX_MB * 1024 * 1024:
+        raise UploadTooLarge(f"{info.filename} is {info.file_size / 1e6:.1f}MB (limit {UPLOAD_MAX_MB:.0f}MB)")
+    return zf.read(info)
+
+
+async def run_batch(entries, analyze_one, analyze_many, error_result, pack=1):
+    """
+    Preprocess on the image pool, call the model with bounded concurrency and
+    yield one NDJSON line per image in input order, as soon as it (and every
+    image before it) has completed
+    """
+    pack = max(1, min(pack, BATCH_MAX_PACK))
+    # Bounds how many raw uploads are held in memory at once
+    preprocess_slots = asyncio.Semaphore(image_executor.workers * 2)
+    model_slots = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+    finished = asyncio.Queue()
+
+    async def preprocess(entry):
+        async with preprocess_slots:
+            contents = await entry.read()
+            # Already bounded by preprocess_slots, so batches wait for the pool instead of being shed
+            return await image_executor.prepare(contents, admit=False)
+
+    async def process_group(start, group):
+        prepared = await asyncio.gather(*(preprocess(entry) for entry in group), return_exceptions=True)
+        ready = [(start + i, image) for i, image in enumerate(prepared) if not isinstance(image, Exception)]
+        for i, image in enumerate(prepared):
+            if isinstance(image, Exception):
+                logger.error(f"❌ Batch image {group[i].filename}: {image}")
+                finished.put_nowait((start + i, error_result(image)))
+
+        try:
+            async with model_slots:
+                if len(ready) > 1:
+                    results = await analyze_many([image for _, image in ready])
+                else:
+                    results = [await analyze_one(image) for _, image in ready]
+        except Exception as e:
+            logger.error(f"❌ Batch analysis error: {e}")
+            results = [error_result(e) for _ in ready]
+
+        for (index, _), result in zip(ready, results):
+            finished.put_nowait((index, result))
+
+    tasks = [
+        asyncio.ensure_future(process_group(start, entries[start:start + pack]))
+        for start in range(0, len(entries), pack)
+    ]
+
+    logger.info(f"📦 Batch of {len(entries)} images ({len(tasks)} model calls max)")
+    completed = {}
+    next_index = 0
+    try:
+        while next_index < len(entries):
+            index, result = await finished.get()
+            completed[index] = result
+            while next_index in completed:
+                line = {"index": next_index, "filename": entries[next_index].filename,
+                        "result": completed.pop(next_index)}
+                yield dumps(line) + "\n"
+                next_index += 1
+    finally:
+        # Client went away: don't keep paying for images nobody will read
+        for task in tasks:
+            task.cancel()
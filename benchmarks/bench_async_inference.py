@@ -0,0 +1,113 @@
+"""
+Async inference benchmark
+
+Drives PlantDiseaseDetector.analyze_disease_async against a local stub model
+whose generate_content blocks like the real SDK, and reports requests/sec at
+increasing client concurrency. While the load runs, a probe coroutine measures
+how long the event loop takes to answer (what /health would see).
+
+Usage:
+    python benchmarks/bench_async_inference.py [--latency 0.2] [--requests 64]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.disable(logging.ERROR)
+
+from disease_model import detector
+from inference import gateway
+
+CANNED_REPLY = (
+    '{"is_plant": true, "disease": "Leaf Blight", "confidence": 0.9, "severity": "Medium", '
+    '"description": "stub", "treatment": "stub", "prevention": "stub"}'
+)
+
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class StubModel:
+    """
+    Stand-in for genai.GenerativeModel that blocks for a fixed latency
+    """
+
+    model_name = 'models/stub-model'
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def generate_content(self, contents, **kwargs):
+        time.sleep(self.latency)
+        return StubResponse(CANNED_REPLY)
+
+    async def generate_content_async(self, contents, **kwargs):
+        await asyncio.sleep(self.latency)
+        return StubResponse(CANNED_REPLY)
+
+
+async def probe_loop(stop, samples):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0)
+        samples.append(time.perf_counter() - start)
+        await asyncio.sleep(0.01)
+
+
+async def run_level(clients, total):
+    queue = asyncio.Queue()
+    for _ in range(total):
+        queue.put_nowait(None)
+
+    async def client():
+        while True:
+            try:
+                queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await detector.analyze_disease_async(None)
+
+    stop = asyncio.Event()
+    probe_samples = []
+    probe = asyncio.create_task(probe_loop(stop, probe_samples))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    await probe
+    worst_probe = max(probe_samples) if probe_samples else 0.0
+    return total / elapsed, worst_probe
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=0.2, help='stub model latency in seconds')
+    parser.add_argument('--requests', type=int, default=64, help='requests per concurrency level')
+    parser.add_argument('--limit', type=int, default=16, help='per-model concurrency limit')
+    parser.add_argument('--mode', choices=['executor', 'native'], default='executor')
+    parser.add_argument('--levels', default='1,2,4,8,16,32')
+    args = parser.parse_args()
+
+    detector.model = StubModel(args.latency)
+    gateway.mode = args.mode
+    gateway.set_limit('stub-model', args.limit)
+
+    print(f"stub latency={args.latency*1000:.0f}ms  limit={args.limit}  mode={args.mode}")
+    print(f"{'clients':>8} {'req/s':>10} {'max loop stall (ms)':>20}")
+    for clients in [int(level) for level in args.levels.split(',')]:
+        throughput, stall = await run_level(clients, args.requests)
+        print(f"{clients:>8} {throughput:>10.1f} {stall*1000:>20.2f}")
+
+    gateway.shutdown()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,140 @@
+"""
+Call policy benchmark
+
+Runs CallPolicy (deadline, jittered retries, hedging, failover, circuit
+breakers) against local fake models that inject latency and errors, in three
+scenarios:
+
+  transient  - primary returns 429 on 20% of calls: retries hide the errors
+  outage     - primary fails every call: the breaker opens and traffic fails
+               over to the secondary without paying for retries each time
+  slow-tail  - 3% of primary calls take 10x longer: hedging to the secondary
+               after the primary's p95 cuts the tail
+
+Each scenario is run with the policy disabled (single attempt, no failover)
+and enabled, reporting success rate, p50/p99 latency and upstream calls.
+
+Usage:
+    python benchmarks/bench_call_policy.py [--requests 400] [--concurrency 16] [--latency 0.05]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.disable(logging.ERROR)
+
+import call_policy
+from call_policy import CallPolicy
+from inference import InferenceGateway
+
+
+class ResourceExhausted(Exception):
+    """Same class name as google.api_core's 429 error"""
+
+
+class ServiceUnavailable(Exception):
+    """Same class name as google.api_core's 503 error"""
+
+
+class StubResponse:
+    text = '{"ok": true}'
+
+
+class FakeModel:
+    """
+    Async stand-in for GenerativeModel with injected latency and errors
+    """
+
+    def __init__(self, name, latency, error_rate=0.0, error=ResourceExhausted,
+                 slow_rate=0.0, slow_factor=10.0, seed=0):
+        self.model_name = f"models/{name}"
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error = error
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self.rng = random.Random(seed)
+        self.calls = 0
+
+    async def generate_content_async(self, contents, **kwargs):
+        self.calls += 1
+        latency = self.latency * self.rng.uniform(0.8, 1.2)
+        if self.rng.random() < self.slow_rate:
+            latency *= self.slow_factor
+        await asyncio.sleep(latency)
+        if self.rng.random() < self.error_rate:
+            raise self.error("injected failure")
+        return StubResponse()
+
+
+SCENARIOS = {
+    'transient': dict(error_rate=0.2),
+    'outage': dict(error_rate=1.0, error=ServiceUnavailable),
+    'slow-tail': dict(slow_rate=0.03),
+}
+
+
+def percentile(samples, p):
+    if not samples:
+        return float('nan')
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+async def run(scenario, enabled, args):
+    call_policy._breakers.clear()
+    call_policy._latencies.clear()
+    primary = FakeModel('gemini-2.5-flash', args.latency, seed=1, **SCENARIOS[scenario])
+    secondary = FakeModel('gemini-2.0-flash', args.latency, seed=2)
+    policy = CallPolicy(
+        'bench', lambda: primary,
+        fallback_names=['gemini-2.0-flash'] if enabled else [],
+        resolve={'gemini-2.0-flash': secondary}.get,
+        gateway=InferenceGateway(mode='native', default_limit=args.concurrency * 2),
+        deadline=args.latency * 40,
+        max_retries=2 if enabled else 0,
+        hedge=enabled and scenario == 'slow-tail'
+    )
+    call_policy.RETRY_BASE_DELAY = args.latency
+
+    latencies = []
+    failures = 0
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def one():
+        nonlocal failures
+        async with slots:
+            start = time.perf_counter()
+            try:
+                await policy.generate('prompt')
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                failures += 1
+
+    await asyncio.gather(*(one() for _ in range(args.requests)))
+    return latencies, failures, primary.calls, secondary.calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.05, help='fake model base latency (s)')
+    args = parser.parse_args()
+
+    print(f"{'scenario':>10} {'policy':>7} {'success':>8} {'p50 ms':>8} {'p99 ms':>8} {'primary':>8} {'secondary':>10}")
+    for scenario in SCENARIOS:
+        for enabled in (False, True):
+            latencies, failures, primary_calls, secondary_calls = asyncio.run(run(scenario, enabled, args))
+            print(f"{scenario:>10} {'on' if enabled else 'off':>7} "
+                  f"{len(latencies) / args.requests:>8.1%} {percentile(latencies, 0.5) * 1000:>8.1f} "
+                  f"{percentile(latencies, 0.99) * 1000:>8.1f} {primary_calls:>8} {secondary_calls:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+Semantic chat cache benchmark
+
+Quality: seeds the cache with one answer per farming question, then asks
+  paraphrases  - same question reworded, re-ordered, misspelled (should hit)
+  different    - near-miss questions with another crop, pest, quantity,
+                 timing, intent or a negation (must NOT hit: a wrong answer
+                 is worse than a call)
+and reports hit rate on paraphrases and false-hit rate on the others for a
+range of thresholds, also with the word check (same_question) switched off
+to show what it catches that vector similarity doesn't.
+
+Speed: lookup latency against an index of --entries synthetic questions.
+
+Usage:
+    python benchmarks/bench_chat_cache.py [--entries 5000] [--lookups 2000]
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.disable(logging.ERROR)
+
+import semantic_cache
+from semantic_cache import SemanticCache
+
+NAMESPACE = 'bench'
+
+# (seed question, paraphrases, different questions)
+CASES = [
+    ("How to treat leaf blight in tomato?",
+     ["how do i treat leaf blight on my tomatoes", "Tomato leaf blight treatment?", "how to treat tomato leaf blite",
+      "What is the treatment for leaf blight in tomato plants?"],
+     ["How to treat leaf blight in potato?", "How to prevent leaf blight in tomato?", "What causes leaf curl in tomato?"]),
+    ("How much urea should I apply for 2 acres of wheat?",
+     ["how much urea for 2 acres wheat", "Urea quantity for 2 acres of wheat?"],
+     ["How much urea should I apply for 5 acres of wheat?", "How much DAP should I apply for 2 acres of wheat?"]),
+    ("What is the best time to sow rice?",
+     ["best time to sow rice", "When is the best time for sowing rice?", "what is the best time to sow paddy rice"],
+     ["What is the best time to harvest rice?", "What is the best time to sow wheat?"]),
+    ("How can I control aphids on mustard organically?",
+     ["organic control of aphids on mustard", "How to control aphids in mustard organically"],
+     ["How can I control whiteflies on cotton organically?", "How can I control aphids on mustard with chemicals?"]),
+    ("Why are my maize leaves turning yellow?",
+     ["maize leaves turning yellow why", "Why are the leaves of my maize yellowing?", "why are my maize leafs turning yellow"],
+     ["Why are my maize leaves turning brown?", "Why are my sugarcane leaves turning yellow?"]),
+    ("How often should I irrigate sugarcane in summer?",
+     ["how often to irrigate sugarcane in summer", "Sugarcane irrigation frequency in summer?"],
+     ["How often should I irrigate sugarcane in winter?", "How often should I fertilize sugarcane in summer?"]),
+    ("Which fertilizer is good for banana plants?",
+     ["what fertilizer is good for banana plants", "Good fertilizer for banana plant?"],
+     ["Which fertilizer is good for mango trees?", "Which pesticide is good for banana plants?"]),
+    ("How do I increase organic matter in sandy soil?",
+     ["how to increase organic matter in sandy soil", "Increasing organic matter of sandy soils"],
+     ["How do I increase organic matter in clay soil?", "How do I reduce salinity in sandy soil?"]),
+    # Near-misses whose vectors score above the default threshold: only the exact checks tell them apart
+    ("Should I spray fungicide on my grapes before the rain?",
+     ["should i spray fungicide on grapes before rain", "Spray fungicide on my grapes before the rain?"],
+     ["Should I spray fungicide on my grapes after the rain?",
+      "Should I not spray fungicide on my grapes before the rain?"]),
+    ("My tomato leaves have brown spots with yellow rings, what is it?",
+     ["brown spots with yellow rings on my tomato leaves", "my tomato leaf has brown spots with yellow rings"],
+     ["My potato leaves have brown spots with yellow rings, what is it?"]),
+    ("Should I apply urea to wheat during flowering?",
+     ["should i apply urea on wheat during flowering", "Apply urea to wheat during flowering?"],
+     ["Should I not apply urea to wheat during flowering?", "Shouldn't I apply urea to wheat during flowering?"]),
+]
+
+
+def seeded_cache(threshold):
+    cache = SemanticCache('bench', threshold=threshold, max_entries=1000)
+    for seed, _, _ in CASES:
+        cache.add(seed, 'Ravi', f"Ravi, here is the answer to: {seed}", NAMESPACE)
+    return cache
+
+
+def quality(thresholds):
+    paraphrases = [q for _, similar, _ in CASES for q in similar]
+    different = [q for _, _, others in CASES for q in others]
+    print(f"{'threshold':>9} {'paraphrase hits':>16} {'false hits':>11} {'no word check':>14}")
+    for threshold in thresholds:
+        cache = seeded_cache(threshold)
+        hits = sum(cache.lookup(q, 'Asha', NAMESPACE) is not None for q in paraphrases)
+        false_hits = [q for q in different if cache.lookup(q, 'Asha', NAMESPACE) is not None]
+        same_question = semantic_cache.same_question
+        semantic_cache.same_question = lambda question, other: True
+        try:
+            vector_false_hits = sum(cache.lookup(q, 'Asha', NAMESPACE) is not None for q in different)
+        finally:
+            semantic_cache.same_question = same_question
+        print(f"{threshold:>9.2f} {hits:>9}/{len(paraphrases):<6} {len(false_hits):>4}/{len(different):<6} "
+              f"{vector_false_hits:>7}/{len(different):<6}" + (f"  e.g. {false_hits[0]!r}" if false_hits else ''))
+
+
+def speed(entries, lookups, seed):
+    rng = random.Random(seed)
+    crops = ['rice', 'wheat', 'maize', 'tomato', 'potato', 'cotton', 'mustard', 'banana', 'mango', 'onion',
+             'chilli', 'sugarcane', 'groundnut', 'soybean', 'brinjal', 'okra', 'cabbage', 'gram']
+    topics = ['leaf blight', 'aphids', 'yellow leaves', 'urea dose', 'irrigation', 'sowing time', 'harvest time',
+              'root rot', 'stem borer', 'seed rate', 'spacing', 'weed control', 'zinc deficiency', 'frost damage']
+    verbs = ['How to manage', 'What causes', 'Best practice for', 'How to prevent', 'Organic remedy for']
+    cache = SemanticCache('bench', max_entries=entries)
+    start = time.perf_counter()
+    for i in range(entries):
+        question = f"{rng.choice(verbs)} {rng.choice(topics)} in {rng.choice(crops)} field {i}"
+        cache.add(question, 'Ravi', 'answer', NAMESPACE)
+    fill = time.perf_counter() - start
+    samples = []
+    for _ in range(lookups):
+        question = f"{rng.choice(verbs)} {rng.choice(topics)} in {rng.choice(crops)}"
+        start = time.perf_counter()
+        cache.lookup(question, 'Asha', NAMESPACE)
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    print(f"\n{entries} entries: add {fill / entries * 1e6:.0f}us/entry, lookup p50 "
+          f"{samples[len(samples) // 2] * 1000:.3f}ms p99 {samples[int(len(samples) * 0.99)] * 1000:.3f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=5000)
+    parser.add_argument('--lookups', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=5)
+    args = parser.parse_args()
+
+    quality([0.70, 0.75, 0.80, 0.83, 0.86, 0.90, 0.95])
+    cache = seeded_cache(0.86)
+    print(f"\npersonalized reply: {cache.lookup('tomato leaf blight treatment?', 'Asha', NAMESPACE)!r}")
+    speed(args.entries, args.lookups, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""
+Endpoint load benchmark
+
+Reproducible asyncio load generator for the HTTP API. By default it runs the
+app in-process with the local fake Gemini backend (GEMINI_BACKEND=fake, see
+fake_backend), so no API quota is used; with --url it targets a running
+server instead (start that one with GEMINI_BACKEND=fake too, unless you mean
+to hit the real API).
+
+For each endpoint and concurrency level, a closed-loop client population sends
+--requests requests (distinct images / questions, so caches and coalescing
+don't hide the work) and throughput and p50/p95/p99 latency are reported.
+--json writes the same numbers to a file for tracking across commits.
+
+Usage:
+    python benchmarks/bench_endpoints.py [--concurrency 1,8,32] [--requests 64] [--latency fixed:0.3]
+    python benchmarks/bench_endpoints.py --url http://localhost:8000 --endpoints chat,chat_stream
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import numpy as np
+from PIL import Image
+
+ENDPOINTS = ('disease', 'soil', 'chat', 'chat_stream', 'disease_batch')
+
+
+def make_images(count, seed, width=1280, height=960):
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        pixels = rng.integers(0, 255, (height // 16, width // 16, 3), dtype=np.uint8)
+        img = Image.fromarray(pixels).resize((width, height), Image.Resampling.BILINEAR)
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG', quality=85)
+        images.append(buffer.getvalue())
+    return images
+
+
+def make_request(endpoint, i, images):
+    """
+    (method, path, request kwargs) for the i-th request to an endpoint
+    """
+    if endpoint == 'disease':
+        return 'POST', '/api/disease-detection', {'files': {'image': (f'{i}.jpg', images[i], 'image/jpeg')}}
+    if endpoint == 'soil':
+        return 'POST', '/api/soil-analysis', {'files': {'image': (f'{i}.jpg', images[i], 'image/jpeg')}}
+    if endpoint == 'chat':
+        return 'POST', '/api/chat', {'json': {'message': f'How often should I water tomatoes? (#{i})', 'userName': 'Bench'}}
+    if endpoint == 'chat_stream':
+        return 'POST', '/api/chat/stream', {'json': {'message': f'Best crop for clay soil? (#{i})', 'userName': 'Bench'}}
+    if endpoint == 'disease_batch':
+        files = [('images', (f'{i}-{j}.jpg', images[(i * 4 + j) % len(images)], 'image/jpeg')) for j in range(4)]
+        return 'POST', '/api/disease-detection/batch', {'files': files, 'data': {'pack': '4'}}
+    raise ValueError(endpoint)
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def run_level(client, endpoint, concurrency, total, images, offset):
+    latencies = []
+    first_bytes = []
+    errors = 0
+    next_index = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for i in next_index:
+            method, path, kwargs = make_request(endpoint, offset + i, images)
+            start = time.perf_counter()
+            try:
+                async with client.stream(method, path, **kwargs) as response:
+                    first = None
+                    async for _ in response.aiter_raw():
+                        if first is None:
+                            first = time.perf_counter() - start
+                    if response.status_code != 200:
+                        errors += 1
+                        continue
+                latencies.append(time.perf_counter() - start)
+                first_bytes.append(first if first is not None else latencies[-1])
+            except httpx.HTTPError:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {
+        'endpoint': endpoint,
+        'concurrency': concurrency,
+        'requests': total,
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'first_byte_p50_ms': round(percentile(first_bytes, 50) * 1000, 1),
+    }
+
+
+async def run(args):
+    levels = [int(level) for level in args.concurrency.split(',')]
+    endpoints = args.endpoints.split(',')
+    images = make_images(args.requests * len(levels) + 4, args.seed)
+
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=120)
+    else:
+        os.environ['GEMINI_BACKEND'] = 'fake'
+        os.environ['FAKE_GEMINI_LATENCY'] = args.latency
+        os.environ['FAKE_GEMINI_ERROR_RATE'] = str(args.error_rate)
+        # Every benchmark client is one IP, which the anonymous tier would throttle
+        os.environ['RATE_LIMITS'] = 'off'
+        logging.disable(logging.ERROR)
+        import main
+        from model_registry import SERVICES, registry
+        await registry.warm_up(SERVICES)
+        # In-process ASGI transport buffers whole responses, so first-byte equals total here
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url='http://bench', timeout=120)
+
+    results = []
+    async with client:
+        for endpoint in endpoints:
+            offset = 0
+            for concurrency in levels:
+                result = await run_level(client, endpoint, concurrency, args.requests, images, offset)
+                offset += args.requests
+                results.append(result)
+                print(f"{endpoint:>14} {concurrency:>5} {result['throughput_rps']:>9.1f} {result['p50_ms']:>9.1f} "
+                      f"{result['p95_ms']:>9.1f} {result['p99_ms']:>9.1f} {result['first_byte_p50_ms']:>10.1f} "
+                      f"{result['errors']:>6}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default=None, help='target a running server instead of the in-process app')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+    parser.add_argument('--concurrency', default='1,8,32')
+    parser.add_argument('--requests', type=int, default=64, help='requests per endpoint and concurrency level')
+    parser.add_argument('--latency', default='lognormal:0.3,0.3', help='fake Gemini latency (in-process only)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fake Gemini error rate (in-process only)')
+    parser.add_argument('--seed', type=int, default=11)
+    parser.add_argument('--json', default=None, help='write results to this file')
+    args = parser.parse_args()
+
+    print(f"{'endpoint':>14} {'conc':>5} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ttfb p50':>10} {'errors':>6}")
+    results = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
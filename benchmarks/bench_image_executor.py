@@ -0,0 +1,153 @@
+"""
+Image executor benchmark
+
+Two questions, each answered in-process with the fake Gemini backend:
+
+  chat   - latency of /api/chat while --uploaders clients keep posting large
+           photos to /api/disease-detection, with image work on the event
+           loop (IMAGE_EXECUTOR=inline) vs on the process pool (process)
+  mixed  - latency of small uploads when a few huge ones arrive at the same
+           time, FIFO dispatch vs size-aware lanes (IMAGE_SCHEDULING)
+
+Each configuration runs in a fresh subprocess, since the settings are read
+at import time. Queue wait and processing time come from the executor's
+own stats.
+
+Usage:
+    python benchmarks/bench_image_executor.py [--seconds 10] [--uploaders 4] [--workers 2]
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CONFIGS = {
+    'chat': [('inline', {'IMAGE_EXECUTOR': 'inline'}), ('process', {'IMAGE_EXECUTOR': 'process'})],
+    'mixed': [('fifo', {'IMAGE_SCHEDULING': 'fifo'}), ('size-aware', {'IMAGE_SCHEDULING': 'size'})],
+}
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def measure(scenario, seconds, uploaders):
+    import logging
+    import httpx
+
+    logging.disable(logging.ERROR)
+    import main
+    from bench_endpoints import make_images
+    from model_registry import SERVICES, registry
+
+    await registry.warm_up(SERVICES)
+    main.image_executor.start()
+    await asyncio.sleep(2)
+
+    stop = time.monotonic() + seconds
+    transport = httpx.ASGITransport(app=main.app)
+    results = {'latencies': [], 'uploads': 0}
+
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=120) as client:
+        if scenario == 'chat':
+            photos = make_images(uploaders * 4, 22, 4000, 3000)
+
+            async def uploader(u):
+                i = 0
+                while time.monotonic() < stop:
+                    data = photos[(u * 4 + i) % len(photos)] + str(i).encode()
+                    await client.post('/api/disease-detection', files={'image': ('p.jpg', data, 'image/jpeg')})
+                    results['uploads'] += 1
+                    i += 1
+
+            async def chatter():
+                i = 0
+                while time.monotonic() < stop:
+                    start = time.perf_counter()
+                    await client.post('/api/chat', json={'message': f'When should I plant maize? #{i}',
+                                                         'userName': 'Bench'})
+                    results['latencies'].append(time.perf_counter() - start)
+                    i += 1
+                    await asyncio.sleep(0.05)
+
+            await asyncio.gather(chatter(), *(uploader(u) for u in range(uploaders)))
+        else:
+            huge = make_images(uploaders, 23, 6000, 4500)
+            small = make_images(64, 24, 800, 600)
+
+            async def big_uploader(u):
+                i = 0
+                while time.monotonic() < stop:
+                    data = huge[u] + str(i).encode()
+                    await client.post('/api/disease-detection', files={'image': ('h.jpg', data, 'image/jpeg')})
+                    results['uploads'] += 1
+                    i += 1
+
+            async def small_uploader(s):
+                i = 0
+                while time.monotonic() < stop:
+                    start = time.perf_counter()
+                    data = small[(s * 8 + i) % len(small)] + str(i).encode()
+                    await client.post('/api/disease-detection', files={'image': ('s.jpg', data, 'image/jpeg')})
+                    results['latencies'].append(time.perf_counter() - start)
+                    i += 1
+
+            await asyncio.gather(*(big_uploader(u) for u in range(uploaders)),
+                                 *(small_uploader(s) for s in range(4)))
+
+    stats = main.image_executor.stats()
+    main.image_executor.shutdown()
+    latencies = results['latencies']
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'uploads': results['uploads'],
+        'queue_wait_ms': stats['avg_queue_wait_ms'],
+        'processing_ms': stats['avg_processing_ms'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default='chat,mixed')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--uploaders', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=2, help='image pool size')
+    parser.add_argument('--latency', default='fixed:0.2', help='fake Gemini latency')
+    parser.add_argument('--run', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(asyncio.run(measure(args.run, args.seconds, args.uploaders))))
+        return
+
+    print(f"{os.cpu_count()} cores, image pool of {args.workers}")
+    print(f"{'scenario':>8} {'config':>11} {'measured':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'uploads':>8} {'wait ms':>8} {'proc ms':>8}")
+    for scenario in args.scenarios.split(','):
+        for name, overrides in CONFIGS[scenario]:
+            env = dict(os.environ, GEMINI_BACKEND='fake', GEMINI_API_KEY='bench', FAKE_GEMINI_LATENCY=args.latency,
+                       CHAT_CACHE_PATH='', JOBS_DB='', RATE_LIMITS='off', IMAGE_WORKERS=str(args.workers), **overrides)
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run', scenario, '--seconds', str(args.seconds),
+                 '--uploaders', str(args.uploaders)],
+                env=env, capture_output=True, text=True, check=True
+            ).stdout
+            r = json.loads(output.strip().splitlines()[-1])
+            measured = 'chat' if scenario == 'chat' else 'small img'
+            print(f"{scenario:>8} {name:>11} {measured:>9} {r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8} "
+                  f"{r['uploads']:>8} {r['queue_wait_ms']:>8} {r['processing_ms']:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Async job benchmark
+
+Compares the synchronous /api/disease-detection endpoint with the job API
+(/api/jobs/disease-detection + polling /api/jobs/{id}) on a flaky client
+population, in-process with the fake Gemini backend.
+
+Each client gives up on a synchronous request after --client-timeout seconds,
+like a phone losing its connection; that result is lost even though Gemini
+was paid for it. Job clients only need the connection for the upload, then
+poll (every --poll seconds) and can pick the result up whenever they're back.
+
+Reported per mode: time until the client has the result (p50/p95), time to
+the 202 for jobs, and how many analyses were lost.
+
+Usage:
+    python benchmarks/bench_jobs.py [--clients 16] [--requests 64] [--latency lognormal:0.8,0.4] [--client-timeout 1.0]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+from bench_endpoints import make_images, percentile
+
+
+async def sync_client(client, images, indices, timeout, latencies, lost):
+    for i in indices:
+        start = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(
+                client.post('/api/disease-detection', files={'image': (f'{i}.jpg', images[i], 'image/jpeg')}),
+                timeout
+            )
+            if response.status_code == 200:
+                latencies.append(time.perf_counter() - start)
+                continue
+        except asyncio.TimeoutError:
+            pass
+        lost.append(i)
+
+
+async def job_client(client, images, indices, poll, latencies, accepts, lost):
+    for i in indices:
+        start = time.perf_counter()
+        response = await client.post('/api/jobs/disease-detection',
+                                     files={'image': (f'{i}.jpg', images[i], 'image/jpeg')})
+        if response.status_code != 202:
+            lost.append(i)
+            continue
+        accepts.append(time.perf_counter() - start)
+        job_id = response.json()['jobId']
+        while True:
+            await asyncio.sleep(poll)
+            job = (await client.get(f'/api/jobs/{job_id}')).json()
+            if job['status'] == 'completed':
+                latencies.append(time.perf_counter() - start)
+                break
+            if job['status'] == 'failed':
+                lost.append(i)
+                break
+
+
+def report(mode, latencies, lost, total, accepts=None):
+    accepted = f"{percentile(accepts, 50) * 1000:>10.1f}" if accepts else f"{'-':>10}"
+    print(f"{mode:>6} {len(latencies):>6}/{total:<4} {len(lost):>5} {percentile(latencies, 50) * 1000:>9.0f} "
+          f"{percentile(latencies, 95) * 1000:>9.0f} {accepted}")
+
+
+async def run(args):
+    # Separate images per mode, so the result cache filled by the first run doesn't help the second
+    images = make_images(args.requests * 2, args.seed, 960, 720)
+    import main
+    from model_registry import SERVICES, registry
+    await registry.warm_up(SERVICES)
+    main.jobs.start()
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=120) as client:
+        shares = [list(range(c, args.requests, args.clients)) for c in range(args.clients)]
+
+        latencies, lost = [], []
+        await asyncio.gather(*(sync_client(client, images, share, args.client_timeout, latencies, lost)
+                               for share in shares))
+        report('sync', latencies, lost, args.requests)
+
+        latencies, accepts, lost = [], [], []
+        await asyncio.gather(*(job_client(client, images, [i + args.requests for i in share], args.poll,
+                                          latencies, accepts, lost)
+                               for share in shares))
+        report('jobs', latencies, lost, args.requests, accepts)
+    main.jobs.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=64)
+    parser.add_argument('--latency', default='lognormal:0.8,0.4', help='fake Gemini latency')
+    parser.add_argument('--client-timeout', type=float, default=1.0, help='seconds before a sync client gives up')
+    parser.add_argument('--poll', type=float, default=0.25, help='job polling interval')
+    parser.add_argument('--seed', type=int, default=19)
+    args = parser.parse_args()
+
+    os.environ['GEMINI_BACKEND'] = 'fake'
+    os.environ['FAKE_GEMINI_LATENCY'] = args.latency
+    os.environ['JOBS_DB'] = os.path.join(tempfile.mkdtemp(), 'jobs.sqlite3')
+    os.environ['CHAT_CACHE_PATH'] = ''
+    os.environ['RATE_LIMITS'] = 'off'
+    logging.disable(logging.ERROR)
+
+    print(f"{'mode':>6} {'got':>11} {'lost':>5} {'p50 ms':>9} {'p95 ms':>9} {'202 p50 ms':>10}")
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Load-shedding simulation
+
+Replays an open-loop Poisson arrival stream (more requests per second than
+the simulated Gemini can serve) through InferenceGateway twice:
+
+  unbounded  - every request is admitted and waits as long as it takes
+  adaptive   - AIMD limit + bounded priority queue + deadlines (the default)
+
+The stub model behaves like an overloaded upstream: each call's own
+latency is lognormal around --latency (--sigma 0.4 matches the fake
+backend; real Gemini latency is at least that noisy), above its capacity
+every call slows down in proportion to the concurrency (processor sharing),
+and beyond 3x capacity it answers with ResourceExhausted (HTTP 429).
+
+Reports, per priority, how many requests succeeded, were shed (503) or
+failed upstream, and p50/p99 latency of the successful ones, so the effect
+on tail latency and on chat (high priority) vs batch (low) is visible.
+
+Usage:
+    python benchmarks/bench_load_shedding.py [--capacity 8] [--latency 0.2] [--sigma 0.4] [--overload 1.5] [--duration 20]
+"""
+import argparse
+import asyncio
+import logging
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.disable(logging.ERROR)
+
+from concurrency_limiter import PRIORITIES, AdaptiveLimiter, Overloaded, set_priority
+from inference import InferenceGateway
+
+# Share of traffic per priority: chat, single-image requests, batch surveys
+MIX = (('high', 0.2), ('normal', 0.5), ('low', 0.3))
+
+
+class ResourceExhausted(Exception):
+    """Same class name as google.api_core's 429 error"""
+
+
+class StubResponse:
+    text = '{"ok": true}'
+
+
+class OverloadedStubModel:
+    model_name = 'models/stub-model'
+
+    def __init__(self, capacity, latency, sigma=0.0, seed=7):
+        self.capacity = capacity
+        self.latency = latency
+        self.sigma = sigma
+        self.rng = random.Random(seed)
+        self.in_flight = 0
+        self.peak = 0
+
+    async def generate_content_async(self, contents, **kwargs):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            if self.in_flight > 3 * self.capacity:
+                await asyncio.sleep(self.latency / 4)
+                raise ResourceExhausted("429 quota exceeded")
+            # Processor sharing: re-evaluate the slowdown as concurrency changes
+            remaining = self.rng.lognormvariate(math.log(self.latency), self.sigma) if self.sigma else self.latency
+            while remaining > 0:
+                step = min(remaining, 0.02)
+                slowdown = max(1.0, self.in_flight / self.capacity)
+                await asyncio.sleep(step * slowdown)
+                remaining -= step
+            return StubResponse()
+        finally:
+            self.in_flight -= 1
+
+
+def percentile(samples, p):
+    if not samples:
+        return float('nan')
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+async def one_request(gateway, model, priority, results):
+    set_priority(priority)
+    start = time.perf_counter()
+    try:
+        await gateway.generate(model, 'prompt')
+        results[priority]['ok'].append(time.perf_counter() - start)
+    except Overloaded:
+        results[priority]['shed'].append(time.perf_counter() - start)
+    except Exception:
+        results[priority]['failed'] += 1
+
+
+async def run(config, args):
+    rng = random.Random(args.seed)
+    gateway = InferenceGateway(mode='native', default_limit=args.capacity)
+    model = OverloadedStubModel(args.capacity, args.latency, args.sigma, args.seed)
+    if config == 'unbounded':
+        gateway._limiters[('stub-model', None)] = AdaptiveLimiter(
+            'stub-model', 10 ** 6, adaptive=False, max_limit=10 ** 6, max_queue=10 ** 6,
+            timeouts={priority: 10 ** 9 for priority in PRIORITIES}
+        )
+
+    results = {priority: {'ok': [], 'shed': [], 'failed': 0} for priority, _ in MIX}
+    rate = args.overload * args.capacity / args.latency
+    tasks = []
+    start = time.perf_counter()
+    limits = []
+    while time.perf_counter() - start < args.duration:
+        roll = rng.random()
+        for priority, share in MIX:
+            roll -= share
+            if roll <= 0:
+                break
+        tasks.append(asyncio.ensure_future(one_request(gateway, model, priority, results)))
+        limits.append(gateway.limiter('stub-model').limit)
+        await asyncio.sleep(rng.expovariate(rate))
+    await asyncio.gather(*tasks)
+    return results, model.peak, limits
+
+
+def report(config, results, peak, limits):
+    print(f"\n{config} (peak upstream concurrency {peak}, limit avg {sum(limits)/len(limits):.1f})")
+    print(f"{'priority':>9} {'ok':>6} {'shed':>6} {'429':>5} {'p50 s':>7} {'p99 s':>7} {'max s':>7} {'shed p99 ms':>12}")
+    for priority, _ in MIX:
+        r = results[priority]
+        ok = r['ok']
+        print(f"{priority:>9} {len(ok):>6} {len(r['shed']):>6} {r['failed']:>5} "
+              f"{percentile(ok, 0.5):>7.2f} {percentile(ok, 0.99):>7.2f} {max(ok or [float('nan')]):>7.2f} "
+              f"{percentile(r['shed'], 0.99) * 1000:>12.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--capacity', type=int, default=8, help='concurrent calls the stub serves at full speed')
+    parser.add_argument('--latency', type=float, default=0.2, help='stub latency at or below capacity (s)')
+    parser.add_argument('--sigma', type=float, default=0.4, help='lognormal sigma of the stub latency (0 = fixed)')
+    parser.add_argument('--overload', type=float, default=1.5, help='arrival rate as a multiple of capacity')
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    print(f"arrivals {args.overload * args.capacity / args.latency:.0f}/s for {args.duration:.0f}s, "
+          f"upstream capacity {args.capacity / args.latency:.0f}/s")
+    for config in ('unbounded', 'adaptive'):
+        results, peak, limits = asyncio.run(run(config, args))
+        report(config, results, peak, limits)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Local classifier benchmark
+
+Measures CPU latency and throughput of the offline disease tier
+(local_classifier) with the checked-in tiny model, at several batch sizes,
+split into feature extraction and the matrix/softmax step. Runs fully offline.
+
+Usage:
+    python benchmarks/bench_local_classifier.py [--model models/saved/disease_tiny] [--images 256]
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'models'))
+
+import numpy as np
+
+from build_tiny_classifier import synth
+from image_preprocessing import prepare_image
+from local_classifier import FEATURE_SIZE, LocalDiseaseClassifier, extract_features
+
+
+def make_prepared(count, rng):
+    prepared = []
+    for i in range(count):
+        img = synth(i % 5, rng).resize((1024, 768))
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG', quality=85)
+        prepared.append(prepare_image(buffer.getvalue()).compact())
+    return prepared
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default=os.path.join(ROOT, 'models', 'saved', 'disease_tiny'))
+    parser.add_argument('--images', type=int, default=256)
+    parser.add_argument('--batches', default='1,8,32,128')
+    args = parser.parse_args()
+
+    classifier = LocalDiseaseClassifier(args.model)
+    rng = np.random.default_rng(0)
+    prepared = make_prepared(args.images, rng)
+
+    # Thumbnail decode (draft-mode from the encoded bytes) is part of the real request path
+    start = time.perf_counter()
+    thumbs = [image.thumbnail(FEATURE_SIZE) for image in prepared]
+    decode_ms = (time.perf_counter() - start) / len(prepared) * 1000
+    print(f"{args.images} images, thumbnail decode {decode_ms:.3f} ms/image")
+
+    print(f"{'batch':>6} {'features ms/img':>16} {'model ms/batch':>15} {'total ms/img':>13} {'images/s':>10}")
+    for batch in [int(b) for b in args.batches.split(',')]:
+        feature_time = 0.0
+        model_time = 0.0
+        for offset in range(0, len(thumbs), batch):
+            chunk = thumbs[offset:offset + batch]
+            t0 = time.perf_counter()
+            features = (extract_features(chunk) - classifier.feature_mean) / classifier.feature_std
+            t1 = time.perf_counter()
+            logits = features @ classifier.weights + classifier.bias
+            np.exp(logits - logits.max(axis=1, keepdims=True))
+            t2 = time.perf_counter()
+            feature_time += t1 - t0
+            model_time += t2 - t1
+        batches = (len(thumbs) + batch - 1) // batch
+        total = feature_time + model_time
+        print(f"{batch:>6} {feature_time/len(thumbs)*1000:>16.3f} {model_time/batches*1000:>15.4f} "
+              f"{total/len(thumbs)*1000:>13.3f} {len(thumbs)/total:>10.0f}")
+
+    results = classifier.classify_batch(thumbs)
+    answered = sum(result is not None for result in results)
+    print(f"answered locally at threshold {classifier.threshold}: {answered}/{len(results)}")
+
+
+if __name__ == '__main__':
+    main()
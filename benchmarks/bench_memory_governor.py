@@ -0,0 +1,128 @@
+"""
+Memory governor load test
+
+Runs the FastAPI app in-process (httpx ASGI transport) with a stub Gemini
+model and fires concurrent /api/disease-detection uploads (distinct images, so
+caching and coalescing don't hide the work). Compares p50/p99 latency with
+the old per-request gc.collect() (GC_MODE=always) against the memory governor.
+
+Usage:
+    python benchmarks/bench_memory_governor.py [--requests 300] [--concurrency 16]
+"""
+import argparse
+import asyncio
+import io
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.disable(logging.ERROR)
+
+import httpx
+import numpy as np
+from PIL import Image
+
+import main
+from disease_model import detector
+from memory_governor import governor
+
+CANNED_REPLY = (
+    '{"is_plant": true, "disease": "Leaf Blight", "confidence": 0.9, "severity": "Medium", '
+    '"description": "stub", "treatment": "stub", "prevention": "stub"}'
+)
+
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class StubModel:
+    model_name = 'models/stub-model'
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def generate_content(self, contents, **kwargs):
+        time.sleep(self.latency)
+        return StubResponse(CANNED_REPLY)
+
+
+def make_uploads(count, width=1600, height=1200):
+    rng = np.random.default_rng(7)
+    uploads = []
+    for _ in range(count):
+        pixels = rng.integers(0, 255, (height // 8, width // 8, 3), dtype=np.uint8)
+        img = Image.fromarray(pixels).resize((width, height), Image.Resampling.BILINEAR)
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG', quality=85)
+        uploads.append(buffer.getvalue())
+    return uploads
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def run(mode, uploads, concurrency):
+    governor.mode = mode
+    governor.collections.clear()
+    detector.cache.clear()
+    latencies = []
+    queue = asyncio.Queue()
+    for data in uploads:
+        queue.put_nowait(data)
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        async def worker():
+            while True:
+                try:
+                    data = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                start = time.perf_counter()
+                response = await client.post(
+                    '/api/disease-detection', files={'image': ('leaf.jpg', data, 'image/jpeg')}
+                )
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "p50": percentile(latencies, 50) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+        "rps": len(latencies) / elapsed,
+        "collections": sum(governor.collections.values()),
+        "pause_ms": governor.total_pause_ms
+    }
+
+
+async def amain():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.05, help='stub model latency in seconds')
+    args = parser.parse_args()
+
+    detector.model = StubModel(args.latency)
+    detector.near_duplicates.max_distance = 0
+    uploads = make_uploads(args.requests)
+
+    print(f"{args.requests} uploads, concurrency={args.concurrency}, stub latency={args.latency*1000:.0f}ms")
+    print(f"{'mode':>10} {'p50 ms':>9} {'p99 ms':>9} {'req/s':>8} {'GCs':>6} {'GC pause ms':>12}")
+    for mode in ('always', 'governor'):
+        governor.total_pause_ms = 0.0
+        r = await run(mode, uploads, args.concurrency)
+        print(f"{mode:>10} {r['p50']:>9.1f} {r['p99']:>9.1f} {r['rps']:>8.1f} "
+              f"{r['collections']:>6} {r['pause_ms']:>12.1f}")
+
+
+if __name__ == '__main__':
+    asyncio.run(amain())
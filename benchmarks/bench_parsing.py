@@ -0,0 +1,112 @@
+"""
+Structured-output parsing benchmark
+
+Builds a corpus of disease/soil replies shaped like Gemini's (bare JSON,
+```json fences, prose around the JSON, and replies cut off part-way as when
+max_output_tokens is hit) and parses it with:
+
+  legacy  - the per-analyzer parser this service used before: split on ```,
+            json.loads, hand-written .get() defaults
+  shared  - response_schema.StructuredParser: one-pass extraction, orjson when
+            installed, precompiled schema, truncated-JSON salvage
+
+Reports usable-result rate per reply shape and mean parse time.
+
+Usage:
+    python benchmarks/bench_parsing.py [--replies 2000] [--seed 3]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.disable(logging.ERROR)
+
+from disease_model import DISEASE_SCHEMA
+from fake_backend import FakeGenerativeModel
+from response_schema import StructuredParser, orjson
+from soil_analyzer import SOIL_SCHEMA
+
+LEGACY_FIELDS = {
+    'disease': ('is_plant', 'disease', 'severity', 'description', 'treatment', 'prevention'),
+    'soil': ('is_soil', 'soil_type', 'color', 'texture', 'moisture', 'nitrogen', 'phosphorus', 'potassium',
+             'organic_matter', 'recommendations', 'suitable_crops', 'improvements'),
+}
+SHAPES = ('bare', 'fenced', 'prose', 'truncated', 'truncated_fenced')
+
+
+def legacy_extract(text):
+    json_text = text.strip()
+    if '```' in json_text:
+        for part in json_text.split('```'):
+            if part.strip().startswith('json'):
+                json_text = part.strip()[4:].strip()
+                break
+            elif part.strip().startswith(('{', '[')):
+                json_text = part.strip()
+                break
+    return json_text.strip()
+
+
+def legacy_parse(kind, text):
+    try:
+        data = json.loads(legacy_extract(text))
+        result = {field: data.get(field, 'Unknown') for field in LEGACY_FIELDS[kind]}
+        number = 'confidence' if kind == 'disease' else 'ph_estimate'
+        result[number] = float(data.get(number, 0.75))
+        return result
+    except Exception:
+        return None
+
+
+def build_corpus(count, seed):
+    rng = random.Random(seed)
+    model = FakeGenerativeModel('bench', latency='fixed:0', fenced_rate=0, seed=seed)
+    corpus = []
+    for i in range(count):
+        kind = 'disease' if i % 2 == 0 else 'soil'
+        item = model._disease(rng.random(), i) if kind == 'disease' else model._soil(rng.random(), i)
+        text = json.dumps(item, indent=2)
+        shape = SHAPES[i % len(SHAPES)]
+        if shape.startswith('truncated'):
+            text = text[:int(len(text) * rng.uniform(0.6, 0.95))]
+        if shape.endswith('fenced'):
+            text = f"```json\n{text}" + ('' if shape.startswith('truncated') else '\n```')
+        elif shape == 'prose':
+            text = f"Here is the analysis:\n{text}\nLet me know if you need more detail."
+        corpus.append((kind, shape, text))
+    return corpus
+
+
+def run(name, corpus, parse):
+    usable = {shape: [0, 0] for shape in SHAPES}
+    start = time.perf_counter()
+    for kind, shape, text in corpus:
+        usable[shape][1] += 1
+        if parse(kind, text) is not None:
+            usable[shape][0] += 1
+    elapsed = time.perf_counter() - start
+    cells = ' '.join(f"{ok / total * 100:>16.0f}%" for ok, total in usable.values())
+    print(f"{name:>7} {cells} {elapsed / len(corpus) * 1e6:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--replies', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=3)
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.replies, args.seed)
+    parsers = {'disease': StructuredParser('disease', DISEASE_SCHEMA), 'soil': StructuredParser('soil', SOIL_SCHEMA)}
+    print(f"{len(corpus)} replies, loads via {'orjson' if orjson is not None else 'json'}; usable results per shape")
+    print(f"{'':>7} " + ' '.join(f"{shape:>17}" for shape in SHAPES) + f" {'us/reply':>10}")
+    run('legacy', corpus, legacy_parse)
+    run('shared', corpus, lambda kind, text: parsers[kind].parse_one(text))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Image preprocessing benchmark
+
+Compares the old endpoint path (full decode -> thumbnail(LANCZOS) -> SDK
+lossless WebP re-encode) with image_preprocessing.prepare_image (draft-mode
+JPEG decode -> EXIF transpose -> thumbnail -> single JPEG encode) on a
+synthetic 12MP phone photo. Each path runs in a fresh subprocess so peak RSS
+is measured independently.
+
+Usage:
+    python benchmarks/bench_preprocessing.py [--iterations 5] [--width 4000 --height 3000]
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+from PIL import Image
+
+
+def make_sample(path, width, height):
+    # Smooth gradients plus noise compress like a real photo (not like flat color or pure noise)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    rng = np.random.default_rng(42)
+    r = 80 + 60 * np.sin(x / 97.0) + rng.normal(0, 12, (height, width))
+    g = 140 + 50 * np.cos(y / 131.0) + rng.normal(0, 12, (height, width))
+    b = 60 + 40 * np.sin((x + y) / 173.0) + rng.normal(0, 12, (height, width))
+    pixels = np.clip(np.dstack([r, g, b]), 0, 255).astype(np.uint8)
+    Image.fromarray(pixels).save(path, 'JPEG', quality=92)
+
+
+def legacy_path(contents):
+    img = Image.open(io.BytesIO(contents))
+    if img.width > 1024 or img.height > 1024:
+        img.thumbnail((1024, 1024), Image.Resampling.LANCZOS)
+    # What google.generativeai does with a PIL image that isn't backed by a file
+    buffer = io.BytesIO()
+    img.save(buffer, format='webp', lossless=True)
+    return len(buffer.getvalue())
+
+
+def fast_path(contents):
+    from image_preprocessing import prepare_image
+    return len(prepare_image(contents).data)
+
+
+def peak_rss_kb():
+    # VmHWM is per address space; ru_maxrss on Linux carries the parent's peak across exec
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_worker(path_name, sample, iterations):
+    with open(sample, 'rb') as f:
+        contents = f.read()
+    func = legacy_path if path_name == 'legacy' else fast_path
+    if path_name == 'fast':
+        import image_preprocessing  # noqa: F401  (import cost outside the timed region)
+
+    baseline_kb = peak_rss_kb()
+    timings = []
+    encoded = 0
+    for _ in range(iterations):
+        start = time.perf_counter()
+        encoded = func(contents)
+        timings.append(time.perf_counter() - start)
+    peak_kb = peak_rss_kb()
+
+    print(json.dumps({
+        "mean_ms": sum(timings) / len(timings) * 1000,
+        "min_ms": min(timings) * 1000,
+        "peak_rss_delta_mb": (peak_kb - baseline_kb) / 1024,
+        "encoded_kb": encoded / 1024
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--height', type=int, default=3000)
+    parser.add_argument('--worker', choices=['legacy', 'fast'], help=argparse.SUPPRESS)
+    parser.add_argument('--sample', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.sample, args.iterations)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sample = os.path.join(tmp, 'sample.jpg')
+        make_sample(sample, args.width, args.height)
+        print(f"sample: {args.width}x{args.height} JPEG, {os.path.getsize(sample)/1024:.0f}KB")
+        print(f"{'path':>8} {'mean ms':>10} {'min ms':>10} {'peak RSS +MB':>14} {'payload KB':>12}")
+        for path_name in ('legacy', 'fast'):
+            output = subprocess.run(
+                [sys.executable, __file__, '--worker', path_name, '--sample', sample,
+                 '--iterations', str(args.iterations)],
+                capture_output=True, text=True, check=True
+            ).stdout
+            r = json.loads(output.strip().splitlines()[-1])
+            print(f"{path_name:>8} {r['mean_ms']:>10.1f} {r['min_ms']:>10.1f} "
+                  f"{r['peak_rss_delta_mb']:>14.1f} {r['encoded_kb']:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Prompt token benchmark
+
+For each service, input tokens per Gemini request with:
+
+  inline         - the old way: the full instructions concatenated into every
+                   request (chat also re-ran an f-string template per call)
+  system_instr   - instructions set once as the model's system_instruction;
+                   each request carries only the image or question. Gemini
+                   still bills the instruction on every call, but it is an
+                   identical prefix, so implicit caching can discount it
+  context_cache  - explicit cached content: the instruction is billed at the
+                   cached rate (--cached-rate, 25% by default). Only possible
+                   when the instruction has >= GEMINI_CONTEXT_CACHE_MIN_TOKENS
+
+Token counts are estimated (~4 chars/token, 258 per small image) unless
+--live is given with GEMINI_API_KEY set, in which case count_tokens is used.
+
+Usage:
+    python benchmarks/bench_prompt_tokens.py [--live] [--cached-rate 0.25]
+"""
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.disable(logging.ERROR)
+
+from chatbot import CHAT_PROMPT, chatbot
+from disease_model import DISEASE_PROMPT
+from fake_backend import IMAGE_TOKENS
+from prompts import CONTEXT_CACHE_MIN_TOKENS, estimate_tokens
+from soil_analyzer import SOIL_PROMPT
+
+QUESTION = chatbot._build_prompt("How do I treat leaf blight in my tomato plants?", "Ravi")
+
+
+def counter(live):
+    if not live:
+        return lambda text, images=0: estimate_tokens(text) + IMAGE_TOKENS * images
+    import google.generativeai as genai
+    genai.configure(api_key=os.environ['GEMINI_API_KEY'])
+    model = genai.GenerativeModel('gemini-2.5-flash')
+    return lambda text, images=0: model.count_tokens(text).total_tokens + IMAGE_TOKENS * images
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--live', action='store_true', help='exact counts via the count_tokens API')
+    parser.add_argument('--cached-rate', type=float, default=0.25, help='price of a cached token vs a normal one')
+    args = parser.parse_args()
+    count = counter(args.live)
+
+    rows = [
+        ('disease', DISEASE_PROMPT, DISEASE_PROMPT.request_text, 1),
+        ('soil', SOIL_PROMPT, SOIL_PROMPT.request_text, 1),
+        ('chat', CHAT_PROMPT, QUESTION, 0),
+    ]
+    print("input tokens per request (billed = what Gemini charges, sent = what the service puts in contents)")
+    print(f"{'service':>8} {'instruction':>12} {'per-request':>12} {'inline billed':>14} {'sys_instr billed':>17} "
+          f"{'sys_instr sent':>15} {'ctx_cache billed':>17}")
+    for service, prompt, request, images in rows:
+        instruction = count(prompt.system_instruction)
+        dynamic = count(request, images)
+        inline = instruction + dynamic
+        cacheable = instruction >= CONTEXT_CACHE_MIN_TOKENS
+        cached = f"{dynamic + instruction * args.cached_rate:.0f}" if cacheable else 'too short'
+        print(f"{service:>8} {instruction:>12} {dynamic:>12} {inline:>14} {inline:>17} {dynamic:>15} {cached:>17}")
+
+    print()
+    print(f"explicit context caching needs >= {CONTEXT_CACHE_MIN_TOKENS} instruction tokens "
+          f"(GEMINI_CONTEXT_CACHE_MIN_TOKENS)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+Rate limit benchmark
+
+  cost      - what the limiter itself costs: microseconds per check and bytes
+              per bucket with --keys distinct clients, and how long a sweep
+              of the idle ones takes
+  fairness  - one client flooding /api/chat from --greedy concurrent loops
+              while --polite clients send a question every --think seconds,
+              with the limiter off and on (the fake Gemini backend, with
+              GEMINI_MAX_CONCURRENCY small enough that the flood saturates it).
+              Reported: the polite clients' latency and success rate, and
+              each side's share of Gemini calls from the usage ledger
+
+Every client has its own API key (all on the "standard" tier), since the
+in-process transport gives every request the same IP.
+
+Usage:
+    python benchmarks/bench_rate_limits.py [--keys 200000] [--seconds 20] [--greedy 16] [--polite 8]
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def measure_cost(keys):
+    import logging
+    from rate_limits import RateLimiter, parse_tiers
+
+    logging.disable(logging.WARNING)
+    limiter = RateLimiter(tiers=parse_tiers('anonymous=60/10'), keys={}, workers=1, max_keys=keys * 2)
+    scopes = [{'type': 'http', 'headers': [], 'client': (f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", 1)}
+              for i in range(keys)]
+
+    start = time.perf_counter()
+    for scope in scopes:
+        limiter.hit(scope)
+    first = time.perf_counter() - start
+
+    # Existing buckets: the steady-state cost of a check
+    start = time.perf_counter()
+    for scope in scopes:
+        limiter.hit(scope)
+    again = time.perf_counter() - start
+
+    # Memory on a fresh limiter, so the timing runs above aren't slowed by tracing
+    limiter = RateLimiter(tiers=limiter.tiers, keys={}, workers=1, max_keys=keys * 2)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for scope in scopes:
+        limiter.hit(scope)
+    per_bucket = (tracemalloc.get_traced_memory()[0] - before) / keys
+    tracemalloc.stop()
+
+    # Pretend the buckets' TATs are all in the past, so all of them are idle
+    for key in limiter._tat:
+        limiter._tat[key] = 0.0
+    start = time.perf_counter()
+    dropped = limiter.sweep()
+    sweep = time.perf_counter() - start
+    return {'new_us': first / keys * 1e6, 'existing_us': again / keys * 1e6, 'bytes_per_bucket': per_bucket,
+            'swept': dropped, 'sweep_ms': sweep * 1000}
+
+
+async def measure_fairness(seconds, greedy, polite, think):
+    import logging
+    import httpx
+
+    logging.disable(logging.ERROR)
+    import main
+    from model_registry import SERVICES, registry
+
+    await registry.warm_up(SERVICES)
+    stop = time.monotonic() + seconds
+    transport = httpx.ASGITransport(app=main.app)
+    results = {'latencies': [], 'polite_ok': 0, 'polite_sent': 0, 'greedy_sent': 0, 'greedy_429': 0}
+
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=120) as client:
+        async def flood(loop):
+            i = 0
+            while time.monotonic() < stop:
+                response = await client.post('/api/chat', json={'message': f'flood {loop} {i}'},
+                                             headers={'X-API-Key': 'key-greedy'})
+                results['greedy_sent'] += 1
+                if response.status_code == 429:
+                    results['greedy_429'] += 1
+                    # A well-behaved client would wait Retry-After; a greedy one barely pauses
+                    await asyncio.sleep(0.05)
+                i += 1
+
+        async def ask(p):
+            i = 0
+            while time.monotonic() < stop:
+                start = time.perf_counter()
+                response = await client.post('/api/chat', json={'message': f'polite {p} {i}'},
+                                             headers={'X-API-Key': f'key-{p}'})
+                results['polite_sent'] += 1
+                if response.status_code == 200 and response.json().get('success'):
+                    results['polite_ok'] += 1
+                    results['latencies'].append(time.perf_counter() - start)
+                i += 1
+                await asyncio.sleep(think)
+
+        await asyncio.gather(*(flood(g) for g in range(greedy)), *(ask(p) for p in range(polite)))
+
+    report = main.usage.report(limit=polite + 1, sort='calls')
+    calls = {row['client']: row['calls'] for row in report}
+    greedy_calls = calls.get('key:greedy', 0)
+    latencies = results['latencies']
+    return {
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'polite_ok': results['polite_ok'],
+        'polite_sent': results['polite_sent'],
+        'greedy_sent': results['greedy_sent'],
+        'greedy_429': results['greedy_429'],
+        'greedy_call_share': round(greedy_calls / max(1, sum(calls.values())), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default='cost,fairness')
+    parser.add_argument('--keys', type=int, default=200000)
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--greedy', type=int, default=16, help='concurrent loops of the flooding client')
+    parser.add_argument('--polite', type=int, default=8)
+    parser.add_argument('--think', type=float, default=0.5, help='pause between a polite client\'s questions')
+    parser.add_argument('--latency', default='fixed:0.2', help='fake Gemini latency')
+    parser.add_argument('--concurrency', type=int, default=4, help='GEMINI_MAX_CONCURRENCY')
+    parser.add_argument('--run', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(asyncio.run(measure_fairness(args.seconds, args.greedy, args.polite, args.think))))
+        return
+
+    scenarios = args.scenarios.split(',')
+    if 'cost' in scenarios:
+        r = measure_cost(args.keys)
+        print(f"{args.keys} buckets: {r['new_us']:.2f}us per check (new bucket), {r['existing_us']:.2f}us "
+              f"(existing), {r['bytes_per_bucket']:.0f} bytes per bucket incl. key; "
+              f"sweep of {r['swept']} idle buckets {r['sweep_ms']:.0f}ms")
+
+    if 'fairness' in scenarios:
+        keys = ','.join(['greedy:key-greedy:standard'] + [f'polite{p}:key-{p}:standard' for p in range(args.polite)])
+        print(f"\n1 client x {args.greedy} loops flooding, {args.polite} polite clients every {args.think}s, "
+              f"Gemini concurrency {args.concurrency}")
+        print(f"{'limits':>7} {'p50 ms':>8} {'p95 ms':>8} {'polite ok':>10} {'flood sent':>11} {'flood 429':>10} "
+              f"{'flood share of calls':>21}")
+        for mode in ('off', 'on'):
+            env = dict(os.environ, GEMINI_BACKEND='fake', GEMINI_API_KEY='bench', FAKE_GEMINI_LATENCY=args.latency,
+                       CHAT_CACHE_PATH='', JOBS_DB='', GEMINI_MAX_CONCURRENCY=str(args.concurrency),
+                       GEMINI_LIMITER_MODE='fixed', RATE_LIMITS=mode, RATE_LIMIT_KEYS=keys, USAGE_DB='')
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run', 'fairness', '--seconds', str(args.seconds),
+                 '--greedy', str(args.greedy), '--polite', str(args.polite), '--think', str(args.think)],
+                env=env, capture_output=True, text=True, check=True
+            ).stdout
+            r = json.loads(output.strip().splitlines()[-1])
+            print(f"{mode:>7} {r['p50_ms']:>8} {r['p95_ms']:>8} {r['polite_ok']:>5}/{r['polite_sent']:<4} "
+                  f"{r['greedy_sent']:>11} {r['greedy_429']:>10} {r['greedy_call_share']:>21}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""
+Response encoding benchmark
+
+Payload size and encode time for typical responses in every format and
+content coding the server can negotiate:
+
+  formats   - json (stdlib, what JSONResponse used), orjson (FastJSONResponse),
+              msgpack and cbor (CompactResponse, when the client's Accept asks)
+  codings   - identity, gzip (GZIP_LEVEL) and brotli (BROTLI_QUALITY), applied
+              by CompressionMiddleware to bodies over COMPRESS_MIN_BYTES
+
+Sizes are exact; "wire ms" is the transfer time of that many bytes over a
+--kbps link (64 kbit/s is a rural 2G/EDGE connection), ignoring latency.
+Encode time is serialization plus compression, best of --repeat runs.
+
+Usage:
+    python benchmarks/bench_response_encoding.py [--kbps 64] [--repeat 2000]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import response_encoding
+from response_encoding import _Compressor
+
+SOIL = {
+    "success": True,
+    "is_soil": True,
+    "soil_type": "Red laterite with sandy loam texture",
+    "color": "Reddish brown with patches of light orange, indicating iron oxide",
+    "texture": "Medium to coarse, friable, with visible sand grains and small gravel",
+    "moisture": "Moist in the top layer, drier below; no standing water",
+    "ph_estimate": 5.8,
+    "nitrogen": "Low",
+    "phosphorus": "Low to Medium",
+    "potassium": "Medium",
+    "organic_matter": "Low",
+    "recommendations": "Apply 5-10 tonnes per hectare of well-rotted farmyard manure or compost before the rains. "
+                       "Add agricultural lime at 1-2 tonnes per hectare to raise the pH towards 6.5, split over two "
+                       "seasons. Use a balanced NPK fertiliser at planting and top-dress maize with CAN after "
+                       "four to six weeks. Mulch to keep moisture in and reduce erosion on slopes.",
+    "suitable_crops": ["Cassava", "Groundnuts", "Sweet potato", "Pigeon pea", "Sorghum", "Cashew"],
+    "improvements": "Build organic matter with crop residues, green manure (mucuna, lablab) and cover crops; "
+                    "contour ridges or terraces on sloping fields; avoid burning residues; rotate cereals with "
+                    "legumes to fix nitrogen.",
+}
+
+NOT_SOIL = {
+    "success": False, "is_soil": False, "detected_object": "floor tiles",
+    "message": "This image shows floor tiles, not soil. Please upload a clear photo of soil for analysis.",
+    "tips": ["Take a photo of actual ground soil", "Ensure good lighting", "Remove any debris or objects",
+             "Focus on the soil surface"],
+    "soil_type": "Not Soil", "color": "N/A", "texture": "N/A", "moisture": "N/A", "ph_estimate": 0,
+    "nitrogen": "N/A", "phosphorus": "N/A", "potassium": "N/A", "organic_matter": "N/A",
+    "recommendations": "Please upload a valid soil image for analysis.", "suitable_crops": [], "improvements": "N/A",
+}
+
+DISEASE = {
+    "success": True, "is_plant": True, "disease": "Northern Leaf Blight", "confidence": 0.87, "severity": "Moderate",
+    "description": "Long, elliptical grey-green to tan lesions on the leaves, starting on the lower leaves and "
+                   "moving up the plant. Caused by the fungus Exserohilum turcicum, favoured by cool, wet weather.",
+    "treatment": "Remove and destroy badly infected leaves. If more than half the plants show lesions before "
+                 "tasselling, spray a fungicide containing azoxystrobin or propiconazole, following the label.",
+    "prevention": "Plant resistant varieties, rotate maize with legumes for at least one season, plough crop "
+                  "residues under after harvest, and avoid dense planting that keeps leaves wet.",
+}
+
+CHAT = {
+    "success": True,
+    "reply": "Great question! 🌽 For maize in your area, plant at the start of the long rains once the soil is "
+             "moist to a depth of about 15cm. Space rows 75cm apart with 25-30cm between plants, two seeds per hole, "
+             "and thin to one plant after two weeks. Apply DAP at planting (about 50kg per acre) and top-dress with "
+             "CAN when the maize is knee high.\n\nWeed twice in the first six weeks, because young maize cannot "
+             "compete for water and nitrogen. Watch for fall armyworm: check the funnels every week and act early "
+             "if you see windowpane damage or sawdust-like frass; a pinch of sand and ash in the funnel helps on "
+             "small plots, otherwise ask your agro-dealer for an approved spray.\n\nIf your rains are unreliable, "
+             "choose an early-maturing, drought-tolerant variety and plant with the first reliable rains rather "
+             "than waiting. Intercropping with beans or cowpeas gives you a second harvest and adds nitrogen for "
+             "next season. Keep some crop residue on the field as mulch after harvest - it protects the soil from "
+             "the sun and the first heavy storms, and it feeds the soil life that keeps your ground productive. "
+             "Store the harvest only when the grain is dry enough to crack between your teeth, in clean bags off "
+             "the floor, to avoid weevils and aflatoxin. Good luck with your planting, and ask me anything else!",
+}
+
+
+def batch_ndjson(n):
+    return ''.join(response_encoding.dumps({"index": i, "filename": f"field_{i}.jpg", "result": SOIL}) + '\n'
+                   for i in range(n)).encode()
+
+
+def stdlib_json(content):
+    # What JSONResponse sends
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(',', ':')).encode()
+
+
+def formats():
+    found = {'json': stdlib_json}
+    if response_encoding.orjson is not None:
+        found['orjson'] = lambda c: response_encoding.orjson.dumps(c)
+    if response_encoding.msgpack is not None:
+        found['msgpack'] = response_encoding.msgpack.packb
+    if response_encoding.cbor2 is not None:
+        found['cbor'] = response_encoding.cbor2.dumps
+    return found
+
+
+def codings():
+    found = {'identity': None, 'gzip': 'gzip'}
+    if response_encoding.brotli is not None:
+        found['br'] = 'br'
+    return found
+
+
+def best_time(fn, repeat):
+    best = float('inf')
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        best = min(best, (time.perf_counter() - start) / repeat)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--kbps', type=float, default=64)
+    parser.add_argument('--repeat', type=int, default=2000)
+    parser.add_argument('--batch', type=int, default=20, help='lines in the NDJSON batch payload')
+    args = parser.parse_args()
+
+    payloads = [('soil', SOIL), ('not-soil', NOT_SOIL), ('disease', DISEASE), ('chat', CHAT)]
+    print(f"gzip level {response_encoding.GZIP_LEVEL}, brotli quality {response_encoding.BROTLI_QUALITY}, "
+          f"wire time at {args.kbps:g} kbit/s")
+    print(f"{'payload':>9} {'format':>8} {'coding':>9} {'bytes':>7} {'vs json':>8} {'encode us':>10} {'wire ms':>8}")
+    for name, content in payloads:
+        baseline = len(stdlib_json(content))
+        for format_name, encode in formats().items():
+            for coding_name, coding in codings().items():
+                if coding is None:
+                    def run():
+                        return encode(content)
+                else:
+                    def run():
+                        return _Compressor(coding).compress(encode(content), True)
+                size = len(run())
+                seconds = best_time(run, args.repeat)
+                print(f"{name:>9} {format_name:>8} {coding_name:>9} {size:>7} {size / baseline:>7.0%} "
+                      f"{seconds * 1e6:>10.1f} {size * 8 / args.kbps:>8.0f}")
+        print()
+
+    # Streamed batch: each line compressed and flushed as it's produced, as the middleware does
+    body = batch_ndjson(args.batch)
+    lines = body.splitlines(keepends=True)
+    print(f"NDJSON batch of {args.batch} soil results, {len(body)} bytes raw")
+    for coding_name, coding in codings().items():
+        if coding is None:
+            continue
+        compressor = _Compressor(coding)
+        streamed = sum(len(compressor.compress(line, i == len(lines) - 1)) for i, line in enumerate(lines))
+        whole = len(_Compressor(coding).compress(body, True))
+        print(f"  {coding_name:>5}: {streamed} bytes flushed per line ({streamed / len(body):.0%}), "
+              f"{whole} bytes in one piece ({whole / len(body):.0%})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Cold-start benchmark
+
+Measures two numbers for the service:
+  1. `import main` time, with the slowest modules from `python -X importtime`
+  2. time from launching uvicorn to the first successful /health response
+     (and, for reference, to the first 200 from /ready)
+
+With --budget-ms the script exits non-zero when time-to-first-health exceeds
+the budget, so cold-start regressions can be tracked in CI.
+
+Usage:
+    python benchmarks/bench_startup.py [--runs 3] [--port 8765] [--budget-ms 2000]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_profile(top):
+    """
+    Run `import main` under -X importtime; returns (total_ms, [(cumulative_ms, module), ...])
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import main'],
+        cwd=ROOT, capture_output=True, text=True
+    )
+    modules = []
+    total_us = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        cumulative = int(cumulative)
+        # Top-level imports (no indentation) add up to the whole import
+        if not name.startswith('  '):
+            total_us += cumulative
+        modules.append((cumulative / 1000, name.strip()))
+    modules.sort(reverse=True)
+    return total_us / 1000, modules[:top]
+
+
+def time_to_first_response(port, timeout):
+    """
+    Launch uvicorn and poll; returns (health_ms, ready_ms or None)
+    """
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port), '--log-level', 'warning'],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    health_ms = None
+    ready_ms = None
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=1.0) as client:
+            while time.perf_counter() - start < timeout:
+                try:
+                    if health_ms is None and client.get('/health').status_code == 200:
+                        health_ms = (time.perf_counter() - start) * 1000
+                    if health_ms is not None:
+                        status = client.get('/ready').status_code
+                        if status == 200:
+                            ready_ms = (time.perf_counter() - start) * 1000
+                            break
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.01)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+    return health_ms, ready_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--budget-ms', type=float, default=None,
+                        help='fail (exit 1) if median time to first /health exceeds this')
+    args = parser.parse_args()
+
+    total_ms, modules = import_profile(args.top)
+    print(f"import main: {total_ms:.0f} ms")
+    for cumulative_ms, name in modules:
+        print(f"  {cumulative_ms:>8.1f} ms  {name}")
+
+    health, ready = [], []
+    for _ in range(args.runs):
+        health_ms, ready_ms = time_to_first_response(args.port, args.timeout)
+        if health_ms is None:
+            print("❌ /health never answered")
+            sys.exit(1)
+        health.append(health_ms)
+        if ready_ms is not None:
+            ready.append(ready_ms)
+
+    median_health = statistics.median(health)
+    print(f"first /health: median {median_health:.0f} ms over {args.runs} runs (min {min(health):.0f})")
+    if ready:
+        print(f"first /ready 200: median {statistics.median(ready):.0f} ms")
+    else:
+        print("/ready never reported 200 (is GEMINI_API_KEY set?)")
+
+    if args.budget_ms is not None and median_health > args.budget_ms:
+        print(f"❌ over budget: {median_health:.0f} ms > {args.budget_ms:.0f} ms")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""
+Upload memory benchmark
+
+Peak RSS of a server process while it ingests a burst of concurrent uploads:
+large camera photos, oversized junk bodies and decompression bombs (tiny PNGs
+that declare 88MP, just under PIL's own limit).
+
+  legacy    - the old path: await image.read() into bytes, Image.open on a
+              BytesIO copy with PIL's default limits, no body size limit
+  streaming - UploadLimitMiddleware cuts oversized bodies off as they stream
+              in, open_upload validates size and magic bytes on the spooled
+              file, PIL decodes straight from it and the header is checked
+              before any pixels are decoded
+
+Each mode runs in its own uvicorn subprocess (only preprocessing, no Gemini
+call), so the numbers are the server's own peak RSS (VmHWM).
+
+Usage:
+    python benchmarks/bench_upload_memory.py [--clients 16] [--photos 48] [--bombs 4] [--junk 4]
+"""
+import argparse
+import asyncio
+import io
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PIL_DEFAULT_MAX_PIXELS = 89478485
+
+
+def peak_rss_mb():
+    # VmHWM starts fresh at exec; ru_maxrss would carry over the parent's peak
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def serve(mode, port):
+    import logging
+    import uvicorn
+    from fastapi import FastAPI, File, UploadFile
+    from fastapi.responses import JSONResponse
+    from PIL import Image
+
+    from image_preprocessing import _downscale, _encode, prepare_image
+    from uploads import UploadLimitMiddleware, UploadRejected, open_upload
+
+    logging.disable(logging.WARNING)
+    app = FastAPI()
+
+    if mode == 'streaming':
+        app.add_middleware(UploadLimitMiddleware)
+
+        @app.post('/upload')
+        async def upload(image: UploadFile = File(...)):
+            try:
+                prepared = prepare_image(open_upload(image))
+            except UploadRejected as e:
+                return JSONResponse(status_code=e.status_code, content={"error": str(e)})
+            return {"size": prepared.size}
+    else:
+        Image.MAX_IMAGE_PIXELS = PIL_DEFAULT_MAX_PIXELS
+
+        @app.post('/upload')
+        async def upload(image: UploadFile = File(...)):
+            try:
+                contents = await image.read()
+                img = Image.open(io.BytesIO(contents))
+                img = _downscale(img, 1024)
+                data = _encode(img, 'JPEG', 85)
+            except Exception as e:
+                return JSONResponse(status_code=400, content={"error": str(e)})
+            return {"size": img.size, "bytes": len(data)}
+
+    @app.get('/rss')
+    async def rss():
+        return {"peak_mb": peak_rss_mb()}
+
+    uvicorn.run(app, host='127.0.0.1', port=port, log_level='error')
+
+
+def make_payloads(args):
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(args.seed)
+    photos = []
+    for _ in range(4):
+        # Noisy 12MP photo, ~8MB as a high-quality JPEG
+        pixels = rng.integers(0, 255, (3000 // 8, 4000 // 8, 3), dtype=np.uint8)
+        img = Image.fromarray(pixels).resize((4000, 3000), Image.Resampling.BILINEAR)
+        noise = rng.integers(-20, 20, (3000, 4000, 3), dtype=np.int16)
+        img = Image.fromarray(np.clip(np.asarray(img, dtype=np.int16) + noise, 0, 255).astype(np.uint8))
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG', quality=95)
+        photos.append(buffer.getvalue())
+
+    buffer = io.BytesIO()
+    Image.new('1', (11000, 8000)).save(buffer, 'PNG')
+    bomb = buffer.getvalue()
+    junk = b'\xff\xd8\xff' + os.urandom(40 * 1024 * 1024)
+
+    payloads = [('photo.jpg', photos[i % len(photos)]) for i in range(args.photos)]
+    payloads += [('bomb.png', bomb)] * args.bombs + [('junk.jpg', junk)] * args.junk
+    order = np.random.default_rng(args.seed).permutation(len(payloads))
+    return [payloads[i] for i in order], len(photos[0]), len(bomb)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def burst(port, payloads, clients):
+    import httpx
+
+    statuses = {}
+    queue = list(payloads)
+
+    async def client(http):
+        while queue:
+            name, data = queue.pop()
+            try:
+                response = await http.post('/upload', files={'image': (name, data, 'application/octet-stream')})
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            except httpx.HTTPError:
+                statuses['dropped'] = statuses.get('dropped', 0) + 1
+
+    async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{port}', timeout=300) as http:
+        baseline = (await http.get('/rss')).json()['peak_mb']
+        start = time.perf_counter()
+        await asyncio.gather(*(client(http) for _ in range(clients)))
+        elapsed = time.perf_counter() - start
+        peak = (await http.get('/rss')).json()['peak_mb']
+    return baseline, peak, elapsed, statuses
+
+
+def run_mode(mode, payloads, clients):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', mode, '--port', str(port)])
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        return asyncio.run(burst(port, payloads, clients))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--serve', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--photos', type=int, default=48, help='~8MB 12MP JPEGs')
+    parser.add_argument('--bombs', type=int, default=4, help='12KB PNGs declaring 88MP')
+    parser.add_argument('--junk', type=int, default=4, help='40MB bodies')
+    parser.add_argument('--modes', default='legacy,streaming')
+    parser.add_argument('--seed', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port)
+        return
+
+    payloads, photo_bytes, bomb_bytes = make_payloads(args)
+    print(f"{len(payloads)} uploads from {args.clients} clients: {args.photos} photos ({photo_bytes / 1e6:.1f}MB), "
+          f"{args.bombs} bombs ({bomb_bytes / 1e3:.0f}KB), {args.junk} junk (40MB)")
+    print(f"{'mode':>10} {'idle MB':>8} {'peak MB':>8} {'growth':>8} {'seconds':>8}  statuses")
+    for mode in args.modes.split(','):
+        baseline, peak, elapsed, statuses = run_mode(mode, payloads, args.clients)
+        print(f"{mode:>10} {baseline:>8.0f} {peak:>8.0f} {peak - baseline:>8.0f} {elapsed:>8.1f}  {statuses}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Worker scaling benchmark
+
+Image-endpoint throughput with 1, 2, 4... uvicorn worker processes. Each
+level starts `uvicorn main:app --workers N` (WORKERS=N, fake Gemini backend,
+fresh SHARED_STATE_DIR) and sends --requests distinct camera-sized photos
+from --concurrency clients, so decoding and resizing dominate and the result
+cache can't help. Throughput can only scale up to the number of cores
+(printed first); beyond that the extra workers just add memory.
+
+Usage:
+    python benchmarks/bench_workers.py [--workers 1,2,4] [--requests 96] [--concurrency 16] [--latency fixed:0.3]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx
+
+from bench_endpoints import make_images, percentile
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(workers, port, latency):
+    env = dict(os.environ, WORKERS=str(workers), GEMINI_BACKEND='fake', GEMINI_API_KEY='bench',
+               FAKE_GEMINI_LATENCY=latency, SHARED_STATE_DIR=tempfile.mkdtemp(), CHAT_CACHE_PATH='',
+               JOBS_DB='', GC_MODE='governor', RATE_LIMITS='off')
+    return subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--workers', str(workers), '--port', str(port),
+         '--log-level', 'warning'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+async def wait_ready(port, workers, timeout=60):
+    # Every worker must have warmed up, not just the first one to accept
+    deadline = time.monotonic() + timeout
+    seen = set()
+    while time.monotonic() < deadline:
+        try:
+            async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{port}') as client:
+                response = await client.get('/stats')
+                seen.add(response.json()['worker']['pid'])
+                if len(seen) >= workers and (await client.get('/ready')).status_code == 200:
+                    return
+        except (httpx.HTTPError, KeyError, ValueError):
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"server with {workers} workers didn't come up")
+
+
+async def load(port, images, concurrency):
+    latencies = []
+    errors = 0
+    next_index = iter(range(len(images)))
+
+    async def client():
+        nonlocal errors
+        # One connection per client, so requests spread over the workers
+        async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{port}', timeout=120) as http:
+            for i in next_index:
+                start = time.perf_counter()
+                response = await http.post('/api/disease-detection',
+                                           files={'image': (f'{i}.jpg', images[i], 'image/jpeg')})
+                if response.status_code == 200 and response.json().get('success'):
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return len(latencies) / (time.perf_counter() - start), latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default='1,2,4')
+    parser.add_argument('--requests', type=int, default=96)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency', default='fixed:0.3', help='fake Gemini latency')
+    parser.add_argument('--seed', type=int, default=21)
+    args = parser.parse_args()
+
+    images = make_images(args.requests, args.seed, 3000, 2250)
+    print(f"{os.cpu_count()} cores, {args.requests} x {len(images[0]) / 1e6:.1f}MB photos, "
+          f"{args.concurrency} clients")
+    print(f"{'workers':>8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'errors':>7}")
+    baseline = None
+    for workers in [int(w) for w in args.workers.split(',')]:
+        port = free_port()
+        server = start_server(workers, port, args.latency)
+        try:
+            asyncio.run(wait_ready(port, workers))
+            rps, latencies, errors = asyncio.run(load(port, images, args.concurrency))
+        finally:
+            server.terminate()
+            server.wait()
+        baseline = baseline or rps
+        print(f"{workers:>8} {rps:>8.1f} {percentile(latencies, 50) * 1000:>8.0f} "
+              f"{percentile(latencies, 95) * 1000:>8.0f} {errors:>7}   x{rps / baseline:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+"""
+Pre-screen evaluation harness
+
+Runs the local pre-screen (prescreen.py) over a labeled sample set and
+reports, per service:
+
+  false rejects  - usable photos it turned away (each one is a farmer told
+                   to retake a good photo: keep this near zero)
+  caught         - unusable photos it rejected before any model call (each
+                   one saves a Gemini round-trip), and how many of those got
+                   the right reason
+  time           - per image, from upload bytes (/api/prevalidate) and from
+                   the prepared 1024px JPEG (inside the analysis pipeline)
+
+Sample set layout: <samples>/<service>/<label>/<image file>, where service
+is disease or soil and label is "ok" or the expected reason (too_dark,
+overexposed, blurry, not_plant, not_soil). Past uploads labeled with
+Gemini's verdict ("Not a Plant Image", is_soil false) make a good set.
+--make-samples writes a synthetic one (leaf and soil textures, objects,
+blurred and badly exposed variants): enough to exercise the thresholds,
+but far easier than real photos.
+
+Metrics are computed once per image; --sweep re-judges them for each value
+of one threshold, e.g. --sweep blur.min_sharpness=2,4,6,10,16
+
+Usage:
+    python benchmarks/eval_prescreen.py --make-samples /tmp/prescreen_samples
+    python benchmarks/eval_prescreen.py --samples /tmp/prescreen_samples [--thresholds FILE] [--sweep SECTION.KEY=V1,V2]
+"""
+import argparse
+import copy
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+from image_preprocessing import prepare_image
+from prescreen import PRESCREEN_THRESHOLDS, judge, load_thresholds, measure_image, screen_upload
+
+SERVICES = ('disease', 'soil')
+WIDTH, HEIGHT = 1024, 768
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def _noise(rng, scale, strength):
+    # Multi-scale texture: coarse blobs plus fine grain
+    coarse = rng.normal(0, 1, (HEIGHT // scale + 1, WIDTH // scale + 1, 1))
+    coarse = np.kron(coarse, np.ones((scale, scale, 1)))[:HEIGHT, :WIDTH]
+    fine = rng.normal(0, 1, (HEIGHT, WIDTH, 1))
+    return (coarse * 0.6 + fine * 0.4) * strength
+
+
+def _from_hsv(h, s, v, rng, texture=18, scale=24):
+    base = Image.new('HSV', (WIDTH, HEIGHT), (int(h * 255), int(s * 255), int(v * 255))).convert('RGB')
+    pixels = np.asarray(base, dtype=np.float32) + _noise(rng, scale, texture)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def leaf(rng):
+    background = _from_hsv(rng.uniform(0.05, 0.1), rng.uniform(0.2, 0.5), rng.uniform(0.25, 0.5), rng)
+    hue = rng.uniform(0.13, 0.36)  # yellowing to deep green
+    leaf_img = _from_hsv(hue, rng.uniform(0.45, 0.85), rng.uniform(0.35, 0.7), rng, texture=14, scale=8)
+    mask = Image.new('L', (WIDTH, HEIGHT))
+    draw = ImageDraw.Draw(mask)
+    cx, cy = WIDTH // 2 + rng.integers(-80, 80), HEIGHT // 2 + rng.integers(-60, 60)
+    rx, ry = rng.integers(300, 480), rng.integers(160, 300)
+    draw.ellipse((cx - rx, cy - ry, cx + rx, cy + ry), fill=255)
+    img = Image.composite(leaf_img, background, mask)
+    draw = ImageDraw.Draw(img)
+    draw.line((cx - rx, cy, cx + rx, cy), fill=(200, 220, 150), width=4)
+    for _ in range(rng.integers(0, 30)):  # lesions
+        x, y = cx + rng.integers(-rx // 2, rx // 2), cy + rng.integers(-ry // 2, ry // 2)
+        r = int(rng.integers(6, 40))
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(int(c) for c in rng.integers(60, 140, 3) * [1.2, 0.8, 0.3]))
+    return img
+
+
+def soil(rng):
+    hue = rng.choice([rng.uniform(0.03, 0.1), rng.uniform(0.0, 0.05)])
+    saturation = rng.choice([rng.uniform(0.25, 0.6), rng.uniform(0.03, 0.12)])  # brown/red, or grey
+    img = _from_hsv(hue, saturation, rng.uniform(0.2, 0.6), rng, texture=30, scale=int(rng.integers(4, 24)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(rng.integers(0, 40)):  # pebbles and the odd weed
+        x, y, r = rng.integers(0, WIDTH), rng.integers(0, HEIGHT), int(rng.integers(3, 14))
+        color = (60, 130, 40) if rng.random() < 0.2 else tuple(int(c) for c in rng.integers(90, 200, 3))
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=color)
+    return img
+
+
+def thing(rng, kind):
+    if kind == 'fabric':
+        return _from_hsv(rng.uniform(0.5, 0.9), rng.uniform(0.4, 0.9), rng.uniform(0.3, 0.8), rng, texture=25, scale=3)
+    if kind == 'concrete':
+        return _from_hsv(0.0, 0.02, rng.uniform(0.4, 0.7), rng, texture=20, scale=6)
+    if kind == 'paper':
+        return _from_hsv(0.1, 0.03, 0.93, rng, texture=6, scale=16)
+    if kind == 'skin':
+        return _from_hsv(rng.uniform(0.04, 0.08), rng.uniform(0.3, 0.5), rng.uniform(0.5, 0.8), rng, texture=8)
+    # foliage: a frame full of grass or leaves, not soil
+    return _from_hsv(rng.uniform(0.22, 0.35), rng.uniform(0.5, 0.8), rng.uniform(0.3, 0.6), rng, texture=40, scale=3)
+
+
+def blurred(img, rng):
+    return img.filter(ImageFilter.GaussianBlur(float(rng.uniform(5, 10))))
+
+
+def exposed(img, factor):
+    pixels = np.asarray(img, dtype=np.float32) * factor
+    if factor > 1:
+        pixels += 60
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def make_samples(out, per_label, seed):
+    rng = np.random.default_rng(seed)
+    plan = {
+        'disease': {
+            'ok': lambda: leaf(rng),
+            'not_plant': lambda: thing(rng, rng.choice(['fabric', 'concrete', 'paper', 'skin'])),
+            'blurry': lambda: blurred(leaf(rng), rng),
+            'too_dark': lambda: exposed(leaf(rng), rng.uniform(0.06, 0.15)),
+            'overexposed': lambda: exposed(leaf(rng), rng.uniform(2.6, 4.0)),
+        },
+        'soil': {
+            'ok': lambda: soil(rng),
+            'not_soil': lambda: thing(rng, rng.choice(['fabric', 'concrete', 'paper', 'skin', 'foliage'])),
+            'blurry': lambda: blurred(soil(rng), rng),
+            'too_dark': lambda: exposed(soil(rng), rng.uniform(0.06, 0.15)),
+            'overexposed': lambda: exposed(soil(rng), rng.uniform(2.6, 4.0)),
+        },
+    }
+    for service, labels in plan.items():
+        for label, make in labels.items():
+            directory = os.path.join(out, service, label)
+            os.makedirs(directory, exist_ok=True)
+            for i in range(per_label):
+                make().save(os.path.join(directory, f'{i:03d}.jpg'), 'JPEG', quality=88)
+    print(f"Wrote {per_label} images per label to {out}")
+
+
+def load_samples(root):
+    samples = []
+    for service in SERVICES:
+        service_dir = os.path.join(root, service)
+        if not os.path.isdir(service_dir):
+            continue
+        for label in sorted(os.listdir(service_dir)):
+            for name in sorted(os.listdir(os.path.join(service_dir, label))):
+                with open(os.path.join(service_dir, label, name), 'rb') as f:
+                    samples.append((service, label, f.read()))
+    return samples
+
+
+def measure_samples(samples, thresholds):
+    measured = []
+    upload_times, pipeline_times = [], []
+    for service, label, data in samples:
+        result = screen_upload(data, service, thresholds)
+        upload_times.append(result['elapsed_ms'])
+        prepared = prepare_image(data).compact()
+        start = time.perf_counter()
+        measure_image(prepared.thumbnail(thresholds['size']))
+        pipeline_times.append((time.perf_counter() - start) * 1000)
+        measured.append((service, label, result['metrics']))
+    return measured, upload_times, pipeline_times
+
+
+def score(measured, thresholds, service):
+    rows = [(label, judge(metrics, service, thresholds)) for s, label, metrics in measured if s == service]
+    good = [predicted for label, predicted in rows if label == 'ok']
+    bad = [(label, predicted) for label, predicted in rows if label != 'ok']
+    false_rejects = sum(predicted is not None for predicted in good)
+    caught = sum(predicted is not None for _, predicted in bad)
+    exact = sum(predicted == label for label, predicted in bad)
+    return rows, len(good), false_rejects, len(bad), caught, exact
+
+
+def report(measured, thresholds):
+    for service in SERVICES:
+        rows, good, false_rejects, bad, caught, exact = score(measured, thresholds, service)
+        if not rows:
+            continue
+        print(f"\n{service}: {good} usable, {bad} unusable photos")
+        labels = sorted({label for label, _ in rows}, key=lambda label: (label != 'ok', label))
+        predictions = sorted({predicted or 'ok' for _, predicted in rows}, key=lambda p: (p != 'ok', p))
+        print(f"  {'expected':>12} " + ' '.join(f"{p:>11}" for p in predictions))
+        for label in labels:
+            counts = [sum(1 for l, p in rows if l == label and (p or 'ok') == prediction) for prediction in predictions]
+            print(f"  {label:>12} " + ' '.join(f"{c:>11}" for c in counts))
+        print(f"  false rejects {false_rejects}/{good} ({false_rejects / max(1, good):.1%}), "
+              f"caught {caught}/{bad} ({caught / max(1, bad):.1%}, right reason {exact}), "
+              f"Gemini calls saved {caught / max(1, len(rows)):.1%} of this set")
+
+
+def sweep(measured, thresholds, spec):
+    path, _, values = spec.partition('=')
+    section, _, key = path.partition('.')
+    print(f"\nSweep of {path}")
+    print(f"{'value':>8} " + ' '.join(f"{s + ' false rej':>17} {s + ' caught':>14}" for s in SERVICES))
+    for value in values.split(','):
+        candidate = copy.deepcopy(thresholds)
+        candidate[section][key] = float(value)
+        cells = []
+        for service in SERVICES:
+            _, good, false_rejects, bad, caught, _ = score(measured, candidate, service)
+            cells.append(f"{false_rejects / max(1, good):>17.1%} {caught / max(1, bad):>14.1%}")
+        print(f"{value:>8} " + ' '.join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', default=None, help='labeled sample set to evaluate')
+    parser.add_argument('--make-samples', default=None, metavar='DIR', help='write a synthetic sample set')
+    parser.add_argument('--per-label', type=int, default=40)
+    parser.add_argument('--thresholds', default=PRESCREEN_THRESHOLDS)
+    parser.add_argument('--sweep', action='append', default=[], help='SECTION.KEY=V1,V2,...')
+    parser.add_argument('--seed', type=int, default=25)
+    args = parser.parse_args()
+
+    if args.make_samples:
+        make_samples(args.make_samples, args.per_label, args.seed)
+        if not args.samples:
+            return
+    if not args.samples:
+        parser.error('--samples or --make-samples is required')
+
+    thresholds = load_thresholds(args.thresholds)
+    samples = load_samples(args.samples)
+    measured, upload_times, pipeline_times = measure_samples(samples, thresholds)
+    print(f"{len(samples)} images, thresholds from {args.thresholds if os.path.exists(args.thresholds) else 'defaults'}")
+    print(f"time per image: from upload bytes p50 {percentile(upload_times, 50):.1f}ms "
+          f"p95 {percentile(upload_times, 95):.1f}ms; from the prepared JPEG p50 "
+          f"{percentile(pipeline_times, 50):.1f}ms p95 {percentile(pipeline_times, 95):.1f}ms")
+    report(measured, thresholds)
+    for spec in args.sweep:
+        sweep(measured, thresholds, spec)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Checks for the async job queue (run with python -m pytest benchmarks)
+"""
+import asyncio
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jobs
+from concurrency_limiter import Overloaded
+from rate_limits import current_client
+
+
+def test_overload_deferrals_are_not_counted_as_interruptions():
+    logging.disable(logging.ERROR)
+    deferrals = jobs.JOB_MAX_ATTEMPTS + 1
+    calls = []
+
+    async def handler(payload):
+        calls.append(payload)
+        if len(calls) <= deferrals:
+            raise Overloaded("busy", retry_after=0)
+        return {"ok": True}
+
+    async def scenario():
+        queue = jobs.JobQueue(jobs.JobStore(':memory:'), workers=1)
+        queue.register('disease', handler)
+        queue.start()
+        try:
+            job_id = await queue.submit('disease', b'upload')
+            for _ in range(400):
+                await asyncio.sleep(0.05)
+                job = queue.get(job_id)
+                if job['status'] in jobs.FINISHED_STATES:
+                    return job, queue.deferred
+            return queue.get(job_id), queue.deferred
+        finally:
+            queue.stop()
+
+    job, deferred = asyncio.run(scenario())
+    assert job['status'] == 'completed', job['error']
+    assert job['attempts'] == 1
+    assert deferred == deferrals
+
+
+def test_job_calls_are_accounted_to_the_submitting_client():
+    seen = []
+
+    async def handler(payload):
+        seen.append(current_client())
+        return {"ok": True}
+
+    async def scenario():
+        queue = jobs.JobQueue(jobs.JobStore(':memory:'), workers=1)
+        queue.register('soil', handler)
+        queue.start()
+        try:
+            job_id = await queue.submit('soil', b'upload', client='key:acme')
+            for _ in range(100):
+                await asyncio.sleep(0.02)
+                if queue.get(job_id)['status'] in jobs.FINISHED_STATES:
+                    break
+        finally:
+            queue.stop()
+
+    asyncio.run(scenario())
+    assert seen == ['key:acme']
+    assert current_client() is None
+
+
+def test_webhooks_to_internal_addresses_are_refused():
+    for url in ('http://127.0.0.1:8000/hook', 'http://localhost/hook', 'http://169.254.169.254/latest/meta-data/',
+                'http://10.0.0.5/hook', 'http://[::1]/hook', 'http://[::ffff:127.0.0.1]/hook', 'http://0.0.0.0/',
+                'http://100.64.0.1/hook', 'ftp://example.com/hook', 'http:///hook'):
+        with pytest.raises(jobs.WebhookRejected):
+            jobs.check_webhook(url, hosts=[], allow_private=False)
+
+
+def test_webhook_host_allowlist():
+    with pytest.raises(jobs.WebhookRejected):
+        jobs.check_webhook('https://8.8.8.8/hook', hosts=['hooks.example.com'], allow_private=False)
+    with pytest.raises(jobs.WebhookRejected):
+        jobs.check_webhook('https://hooks.example.com.evil.test/hook', hosts=['.example.com'], allow_private=False)
+    jobs.check_webhook('https://8.8.8.8/hook', hosts=[], allow_private=False)
+    jobs.check_webhook('http://127.0.0.1/hook', hosts=['127.0.0.1'], allow_private=True)
+
+
+def test_delivery_rechecks_the_url(monkeypatch):
+    logging.disable(logging.ERROR)
+    posted = []
+    monkeypatch.setattr(jobs.requests, 'post', lambda *args, **kwargs: posted.append(args))
+    assert jobs.deliver_webhook('http://127.0.0.1:9/hook', {"jobId": "x"}, retries=0) is False
+    assert not posted
@@ -0,0 +1,147 @@
+"""
+Checks for the adaptive limiter's claimed properties (run with python -m pytest benchmarks)
+
+  - the limit holds under steady, healthy but noisy latency
+  - the limit backs off when the upstream starts queueing
+  - under overload, p99 latency of high-priority calls stays bounded and
+    low-priority work is shed instead of piling up
+  - calls cut off by the caller's deadline count as congestion; cancelled ones don't
+"""
+import argparse
+import asyncio
+import math
+import os
+import random
+import sys
+import threading
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import concurrency_limiter
+from bench_load_shedding import percentile, run
+from concurrency_limiter import AdaptiveLimiter
+from inference import InferenceGateway
+
+
+def simulate(monkeypatch, capacity, seconds, initial_limit=8, median=0.8, sigma=0.4, limiter=None, seed=1):
+    """
+    Closed loop on a virtual clock: each round sends limit calls at once, each taking a lognormal
+    latency, stretched by concurrency / capacity when above capacity (processor sharing)
+    """
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(concurrency_limiter, 'time', types.SimpleNamespace(monotonic=lambda: clock.now))
+    limiter = limiter or AdaptiveLimiter('sim', initial_limit, adaptive=True, max_limit=64)
+    rng = random.Random(seed)
+    end = clock.now + seconds
+
+    async def rounds():
+        while clock.now < end:
+            calls = int(limiter.limit)
+            for _ in range(calls):
+                await limiter.acquire('normal')
+            slowdown = max(1.0, calls / capacity)
+            latencies = [rng.lognormvariate(math.log(median), sigma) * slowdown for _ in range(calls)]
+            for latency in latencies:
+                limiter.release(latency)
+            clock.now += max(latencies)
+
+    asyncio.run(rounds())
+    return limiter
+
+
+def test_limit_holds_under_healthy_noisy_latency(monkeypatch):
+    # The fake backend's default latency, upstream far from saturated: nothing to back off from
+    limiter = simulate(monkeypatch, capacity=1000, seconds=120)
+    assert limiter.limit >= 8
+    # Reference p90 of lognormal(0.8s, 0.4) is 0.8 * e^(1.28 * 0.4) ~ 1.33s
+    assert 1.0 < limiter.baseline_p90 < 1.7
+
+
+def test_limit_backs_off_when_upstream_queues(monkeypatch):
+    limiter = simulate(monkeypatch, capacity=16, seconds=120)
+    grown = limiter.limit
+    assert grown > 12
+    # Upstream capacity drops to a quarter: latency climbs until the limit follows it down
+    simulate(monkeypatch, capacity=4, seconds=120, limiter=limiter)
+    assert limiter.limit < grown / 2
+
+
+def run_gateway(overload, duration=5.0):
+    args = argparse.Namespace(capacity=8, latency=0.2, sigma=0.4, overload=overload, duration=duration, seed=7)
+    results, peak, _ = asyncio.run(run('adaptive', args))
+    return results, peak
+
+
+def test_overload_keeps_high_priority_p99_bounded_and_sheds_low():
+    results, peak = run_gateway(overload=1.5)
+    assert percentile(results['high']['ok'], 0.99) < 1.5
+    assert len(results['low']['shed']) > 0
+    # Shed before the stub's 429 point (3x capacity), so nothing fails upstream
+    assert sum(r['failed'] for r in results.values()) == 0
+    assert peak < 3 * 8
+
+
+def test_no_shedding_below_capacity():
+    results, _ = run_gateway(overload=0.6)
+    assert all(not r['shed'] and not r['failed'] for r in results.values())
+
+
+class SlowModel:
+    model_name = 'models/slow-model'
+
+    def __init__(self, release=None):
+        self.release = release
+
+    def generate_content(self, contents, **kwargs):
+        self.release.wait(5)
+        return contents
+
+    async def generate_content_async(self, contents, **kwargs):
+        await asyncio.sleep(10)
+
+
+def test_deadline_timeouts_shrink_the_limit_and_cancellations_do_not():
+    gateway = InferenceGateway(mode='native', default_limit=8)
+    model = SlowModel()
+    limiter = gateway.limiter('slow-model', 'chat')
+
+    async def scenario():
+        # Hedge loser or client disconnect: neutral
+        task = asyncio.ensure_future(gateway.generate(model, 'prompt', service='chat'))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert limiter.limit == 8 and limiter.in_flight == 0
+        # Past the deadline: congestion
+        try:
+            await gateway.generate(model, 'prompt', service='chat', timeout=0.01)
+        except asyncio.TimeoutError:
+            pass
+        assert limiter.limit < 8 and limiter.in_flight == 0
+
+    asyncio.run(scenario())
+
+
+def test_timed_out_executor_call_keeps_its_slot_until_the_thread_returns():
+    gateway = InferenceGateway(mode='executor', default_limit=8)
+    release = threading.Event()
+    model = SlowModel(release)
+    limiter = gateway.limiter('slow-model', 'chat')
+
+    async def scenario():
+        try:
+            await gateway.generate(model, 'prompt', service='chat', timeout=0.05)
+        except asyncio.TimeoutError:
+            pass
+        held = limiter.in_flight
+        release.set()
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if limiter.in_flight == 0:
+                break
+        return held, limiter.in_flight
+
+    held, after = asyncio.run(scenario())
+    assert (held, after) == (1, 0)
+    assert limiter.limit < 8
@@ -0,0 +1,39 @@
+"""
+Checks for structured reply parsing (run with python -m pytest benchmarks)
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from response_schema import SALVAGED, StructuredParser
+from soil_analyzer import SOIL_SCHEMA
+
+SOIL_REPLY = {"is_soil": True, "soil_type": "Loamy", "color": "Dark brown", "ph_estimate": 6.8,
+              "recommendations": "Add compost before sowing"}
+
+
+def test_truncated_replies_are_flagged():
+    parser = StructuredParser('soil', SOIL_SCHEMA)
+    text = json.dumps(SOIL_REPLY)
+    assert SALVAGED not in parser.parse_one(text)
+    assert parser.parse_one(text[:-30])[SALVAGED]
+
+    items = parser.parse_many(json.dumps([SOIL_REPLY, SOIL_REPLY])[:-30], 2)
+    # Only the object the reply was cut off in was repaired
+    assert SALVAGED not in items[0] and items[1][SALVAGED]
+
+
+def test_salvaged_results_are_not_cached():
+    from soil_analyzer import SoilAnalyzer
+
+    analyzer = SoilAnalyzer()
+    stored = []
+    analyzer.cache.set_behind = lambda key, value: stored.append(key)
+    ticket = ('key', 'ns', None, 'gemini-2.5-flash', b'image')
+    salvaged = analyzer._parse_response(json.dumps(SOIL_REPLY)[:-30])
+    analyzer._remember(ticket, salvaged, 'gemini-2.5-flash')
+    assert not stored and SALVAGED not in salvaged
+    analyzer._remember(ticket, analyzer._parse_response(json.dumps(SOIL_REPLY)), 'gemini-2.5-flash')
+    assert stored == ['key']
@@ -0,0 +1,84 @@
+"""
+Checks for the semantic chat cache (run with python -m pytest benchmarks)
+"""
+import asyncio
+import os
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import semantic_cache
+from semantic_cache import CHAT_CACHE_THRESHOLD, SemanticCache, embed
+
+# Different questions whose vectors score above the default threshold
+NEAR_MISSES = [
+    ("Should I spray copper fungicide on my grape vines before the rain comes?",
+     "Should I spray copper fungicide on my grape vines after the rain comes?"),
+    ("Tomato leaves have small brown spots with yellow halos and the lower leaves are drying",
+     "Potato leaves have small brown spots with yellow halos and the lower leaves are drying"),
+    ("Should I apply urea to my wheat field this week?", "Should I not apply urea to my wheat field this week?"),
+    ("Should I apply urea to my wheat field this week?", "Shouldn't I apply urea to my wheat field this week?"),
+]
+
+PARAPHRASES = [
+    ("How to treat leaf blight in tomato?", "Tomato leaf blight treatment?"),
+    ("What is the best time to sow rice?", "what is the best time to sow paddy rice"),
+    ("Why are my maize leaves turning yellow?", "why are my maize leafs turning yellow"),
+]
+
+
+@pytest.mark.parametrize("seed,question", NEAR_MISSES)
+def test_near_miss_questions_do_not_hit(seed, question):
+    assert float(embed(seed) @ embed(question)) >= CHAT_CACHE_THRESHOLD
+    cache = SemanticCache('test', threshold=CHAT_CACHE_THRESHOLD)
+    cache.add(seed, 'Ravi', 'answer', 'ns')
+    assert cache.lookup(question, 'Asha', 'ns') is None
+
+
+@pytest.mark.parametrize("seed,question", PARAPHRASES)
+def test_paraphrases_hit(seed, question):
+    cache = SemanticCache('test', threshold=CHAT_CACHE_THRESHOLD)
+    cache.add(seed, 'Ravi', 'answer for Ravi', 'ns')
+    assert cache.lookup(question, 'Asha', 'ns') == 'answer for Asha'
+
+
+def test_snapshot_is_written_off_the_event_loop(tmp_path, monkeypatch):
+    writers = []
+    savez = np.savez
+    monkeypatch.setattr(semantic_cache.np, 'savez', lambda *args, **kwargs: (
+        writers.append(threading.current_thread()), savez(*args, **kwargs)))
+    cache = SemanticCache('test', path=str(tmp_path / 'chat_cache.npz'), save_every=1)
+
+    async def scenario():
+        cache.add("How to treat leaf blight in tomato?", 'Ravi', 'answer', 'ns')
+        await cache._saving
+        return threading.current_thread()
+
+    loop_thread = asyncio.run(scenario())
+    assert writers and loop_thread not in writers
+    assert os.path.exists(tmp_path / 'chat_cache.npz')
+
+
+def test_only_one_worker_writes_a_shared_snapshot(tmp_path):
+    path = str(tmp_path / 'chat_cache.npz')
+    first = SemanticCache('test', path=path, save_every=1, shared=True)
+    second = SemanticCache('test', path=path, save_every=1, shared=True)
+    assert first.writer and not second.writer
+    second.add("How to treat leaf blight in tomato?", 'Ravi', 'answer', 'ns')
+    assert not os.path.exists(path)
+    first.add("What is the best time to sow rice?", 'Ravi', 'answer', 'ns')
+    assert SemanticCache('test', path=path).stats()['entries'] == 1
+
+
+@pytest.mark.parametrize("name,reply", [
+    ('Farmer', "Hello Farmer! Farmer groups can share a sprayer."),
+    ('Rose', "Hi Rose! Prune rose bushes after flowering, Rose."),
+])
+def test_generic_or_common_word_names_are_not_replaced(name, reply):
+    cache = SemanticCache('test', threshold=CHAT_CACHE_THRESHOLD)
+    cache.add("When should I prune my bushes?", name, reply, 'ns')
+    assert cache.lookup("When should I prune my bushes?", 'Asha', 'ns') == reply
@@ -0,0 +1,84 @@
+"""
+Checks for the cold-start properties (run with python -m pytest benchmarks)
+
+  - importing the app builds no Gemini client or model
+  - /health answers while the models are still warming up; /ready waits for them
+  - the services' models are built in parallel
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# In-process app: fake Gemini backend, no on-disk state, images handled inline
+for name, value in (('GEMINI_API_KEY', 'test'), ('GEMINI_BACKEND', 'fake'), ('IMAGE_EXECUTOR', 'inline'),
+                    ('RATE_LIMITS', 'off'), ('CHAT_CACHE_PATH', ''), ('JOBS_DB', ''), ('USAGE_DB', '')):
+    os.environ.setdefault(name, value)
+
+
+def test_import_builds_no_model():
+    code = ("import sys, main; from model_registry import registry; "
+            "print('google.generativeai' in sys.modules, registry._genai is None, len(registry._models))")
+    env = dict(os.environ, GEMINI_BACKEND='gemini', GEMINI_API_KEY='test')
+    proc = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, capture_output=True, text=True, timeout=60)
+    assert proc.returncode == 0, proc.stderr
+    assert proc.stdout.split() == ['False', 'True', '0']
+
+
+def test_health_answers_before_models_are_warm(monkeypatch):
+    import main
+    from model_registry import registry
+
+    # Another test module may have imported the registry before the defaults above were set
+    monkeypatch.setattr(registry, 'backend', 'fake')
+    monkeypatch.setattr(registry, 'api_key', 'test')
+
+    release = threading.Event()
+
+    def slow_builder(genai, model_name):
+        release.wait(10)
+        return genai.GenerativeModel(model_name)
+
+    for service in main.SERVICES:
+        registry.configure(service, builder=slow_builder)
+
+    async def scenario():
+        async with main.app.router.lifespan_context(main.app):
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url='http://test') as client:
+                health = await asyncio.wait_for(client.get('/health'), 2)
+                cold = await client.get('/ready')
+                release.set()
+                await registry.wait_until_warm()
+                warm = await client.get('/ready')
+        return health, cold, warm
+
+    try:
+        health, cold, warm = asyncio.run(scenario())
+    finally:
+        release.set()
+    assert health.status_code == 200
+    assert cold.status_code == 503 and cold.json()['warming_up']
+    assert warm.status_code == 200, warm.json()
+
+
+def test_warm_up_builds_services_in_parallel():
+    from model_registry import ModelRegistry
+
+    registry = ModelRegistry(api_key='test', backend='fake')
+    services = ('disease', 'soil', 'chat')
+    for service in services:
+        # A builder per service, so no two share a model and each one is built
+        registry.configure(service, builder=lambda genai, model_name: (time.sleep(0.3), genai.GenerativeModel(model_name))[1])
+
+    start = time.perf_counter()
+    asyncio.run(registry.warm_up({service: ['gemini-2.5-flash'] for service in services}))
+    elapsed = time.perf_counter() - start
+    assert registry.ready
+    assert elapsed < 0.6, f"{elapsed:.2f}s for three 0.3s builds"
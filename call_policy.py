@@ -0,0 +1,329 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+
+from concurrency_limiter import Overloaded, is_congestion_error
+from inference import gateway as default_gateway, model_name_of
+from metrics import REGISTRY
+from prompts import PROMPTS
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Call policy settings
+# Total time budget for one logical call, retries and failover included (seconds)
+CALL_DEADLINE = float(os.getenv('GEMINI_CALL_DEADLINE', '30'))
+MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '2'))
+RETRY_BASE_DELAY = float(os.getenv('GEMINI_RETRY_BASE_DELAY', '0.5'))
+RETRY_MAX_DELAY = float(os.getenv('GEMINI_RETRY_MAX_DELAY', '4'))
+# Models tried in order when the service's own model is failing or its breaker is open
+FAILOVER_MODELS = [name.strip() for name in
+                   os.getenv('GEMINI_FAILOVER_MODELS', 'gemini-2.5-flash,gemini-2.0-flash').split(',') if name.strip()]
+# Send a duplicate to the next model when the first hasn't answered by its p95 latency
+HEDGE_ENABLED = os.getenv('GEMINI_HEDGE', 'off').lower() in ('1', 'on', 'true', 'yes')
+HEDGE_PERCENTILE = float(os.getenv('GEMINI_HEDGE_PERCENTILE', '0.95'))
+HEDGE_MIN_SAMPLES = 20
+BREAKER_FAILURES = int(os.getenv('GEMINI_BREAKER_FAILURES', '5'))
+BREAKER_COOLDOWN = float(os.getenv('GEMINI_BREAKER_COOLDOWN', '30'))
+
+# Transient errors worth retrying (by class name, so the SDK needn't be imported)
+RETRYABLE_ERRORS = (
+    'ResourceExhausted', 'TooManyRequests', 'DeadlineExceeded', 'ServiceUnavailable',
+    'InternalServerError', 'TimeoutError', 'ConnectionError', 'RemoteDisconnected'
+)
+# Errors that mean "this model is unusable", so the next model is tried without retrying
+MODEL_ERRORS = ('NotFound', 'PermissionDenied', 'FailedPrecondition')
+
+CALLS = REGISTRY.counter('gemini_calls', 'Gemini attempts by model and outcome', ('model', 'outcome'))
+RETRIES = REGISTRY.counter('gemini_retries', 'Gemini retries after transient errors', ('model',))
+FAILOVERS = REGISTRY.counter('gemini_failovers', 'Calls moved to the next model', ('from_model', 'to_model'))
+HEDGES = REGISTRY.counter('gemini_hedges', 'Hedged duplicate calls by result', ('result',))
+
+
+def is_retryable(error):
+    return isinstance(error, asyncio.TimeoutError) or is_congestion_error(error) \
+        or type(error).__name__ in RETRYABLE_ERRORS
+
+
+def backoff_delay(attempt):
+    """
+    Full-jitter exponential backoff: uniform in [0, min(max, base * 2^attempt)]
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """
+    Per-model breaker: opens after BREAKER_FAILURES consecutive failures, lets a
+    single probe through after BREAKER_COOLDOWN seconds, closes on its success
+    """
+
+    def __init__(self, name, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.name = name
+        self.failure_threshold = failures
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opened = 0
+
+    def available(self):
+        """
+        Closed, or due for a probe (doesn't change state)
+        """
+        return self.state == 'closed' or time.monotonic() - self.opened_at >= self.cooldown
+
+    def allow(self):
+        """
+        Whether to call the model now; an open breaker admits one probe per cooldown period
+        """
+        if self.state == 'closed':
+            return True
+        now = time.monotonic()
+        if now - self.opened_at >= self.cooldown:
+            self.state = 'half_open'
+            self.opened_at = now
+            logger.info(f"🟡 Circuit for {self.name} half-open, probing")
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != 'closed':
+            logger.info(f"🟢 Circuit for {self.name} closed")
+        self.state = 'closed'
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.failure_threshold:
+            if self.state != 'open':
+                self.opened += 1
+                logger.warning(f"🔴 Circuit for {self.name} open for {self.cooldown:.0f}s")
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+
+    def stats(self):
+        return {"state": self.state, "consecutive_failures": self.failures, "times_opened": self.opened}
+
+
+class LatencyTracker:
+    """
+    Recent successful latencies per model, for the hedge delay
+    """
+
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, p):
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+# Shared by every service: breaker state and latency are properties of the model, not the caller
+_breakers = {}
+_latencies = {}
+
+
+def breaker_for(model_name):
+    if model_name not in _breakers:
+        _breakers[model_name] = CircuitBreaker(model_name)
+    return _breakers[model_name]
+
+
+def latency_for(model_name):
+    if model_name not in _latencies:
+        _latencies[model_name] = LatencyTracker()
+    return _latencies[model_name]
+
+
+def breaker_stats():
+    return {name: breaker.stats() for name, breaker in _breakers.items()}
+
+
+class CallPolicy:
+    """
+    Deadline, retry, hedging and failover around InferenceGateway.generate.
+
+    primary() returns the service's own model (read on every call, so tests and
+    the registry can swap it); fallback models come from resolve(name).
+    """
+
+    def __init__(self, service, primary, fallback_names=FAILOVER_MODELS, resolve=None,
+                 gateway=default_gateway, deadline=CALL_DEADLINE, max_retries=MAX_RETRIES, hedge=HEDGE_ENABLED):
+        self.service = service
+        self.primary = primary
+        self.fallback_names = list(fallback_names)
+        self.resolve = resolve
+        self.gateway = gateway
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.hedge = hedge
+
+    def _resolve(self, name):
+        if self.resolve is not None:
+            return self.resolve(name)
+        from model_registry import registry
+        # Same system instruction / options as the service's own model
+        return registry.model(name, **registry.options(self.service))
+
+    def candidates(self):
+        """
+        Models to try, in order, skipping ones whose breaker is open and not due for a probe
+        """
+        models = []
+        primary = self.primary()
+        if primary is not None:
+            models.append(primary)
+        seen = {model_name_of(model) for model in models}
+        for name in self.fallback_names:
+            if name in seen:
+                continue
+            model = self._resolve(name)
+            if model is not None:
+                models.append(model)
+                seen.add(name)
+        allowed = [model for model in models if breaker_for(model_name_of(model)).available()]
+        # Everything open: still try the preferred model rather than failing without a call
+        return allowed or models[:1]
+
+    async def _attempt(self, model, contents, timeout, kwargs):
+        model_name = model_name_of(model)
+        start = time.perf_counter()
+        # The SDK timeout stops the HTTP request itself; the gateway's timeout also frees the caller in
+        # executor mode and counts as congestion for the limiter
+        kwargs = dict(kwargs, request_options={'timeout': max(1.0, timeout)})
+        try:
+            response = await self.gateway.generate(model, contents, service=self.service, timeout=timeout, **kwargs)
+        except Overloaded:
+            raise
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            breaker_for(model_name).record_failure()
+            CALLS.inc(model=model_name, outcome=type(e).__name__)
+            raise
+        breaker_for(model_name).record_success()
+        latency_for(model_name).add(time.perf_counter() - start)
+        CALLS.inc(model=model_name, outcome='ok')
+        PROMPTS.record_usage(self.service, response)
+        # Which model answered, for callers that key results by model (failover and hedging change it)
+        response.model_name = model_name
+        return response
+
+    async def _hedged(self, model, backup, contents, timeout, kwargs):
+        """
+        Start on model; if it's slower than its p95, race a duplicate on backup
+        """
+        delay = latency_for(model_name_of(model)).percentile(HEDGE_PERCENTILE)
+        first = asyncio.ensure_future(self._attempt(model, contents, timeout, kwargs))
+        if delay is None or delay >= timeout:
+            return await first
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+
+        logger.info(f"🏇 Hedging {self.service} call to {model_name_of(backup)} after {delay*1000:.0f}ms")
+        second = asyncio.ensure_future(self._attempt(backup, contents, timeout - delay, kwargs))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        HEDGES.inc(result='hedge_won' if task is second else 'primary_won')
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def generate(self, contents, **kwargs):
+        """
+        Awaitable generate_content with deadline, retries, optional hedging and failover.
+        The response's model_name is the model that answered. Raises the last error
+        (or asyncio.TimeoutError) once the budget is spent.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        models = self.candidates()
+        if not models:
+            raise Exception(f"No Gemini model available for {self.service}")
+
+        last_error = None
+        for index, model in enumerate(models):
+            model_name = model_name_of(model)
+            if not breaker_for(model_name).allow() and index + 1 < len(models):
+                continue  # another request is already probing this model
+            backup = models[index + 1] if self.hedge and index + 1 < len(models) else None
+            for attempt in range(self.max_retries + 1):
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise last_error or asyncio.TimeoutError(f"{self.service} call deadline exceeded")
+                try:
+                    if backup is not None:
+                        return await self._hedged(model, backup, contents, remaining, kwargs)
+                    return await self._attempt(model, contents, remaining, kwargs)
+                except Overloaded:
+                    raise
+                except Exception as e:
+                    last_error = e
+                    if type(e).__name__ in MODEL_ERRORS:
+                        break  # this model is unusable: go straight to the next one
+                    if not is_retryable(e):
+                        raise  # bad request: another attempt or model won't help
+                    if attempt == self.max_retries or not breaker_for(model_name).allow():
+                        break
+                    delay = min(backoff_delay(attempt), max(0.0, deadline - loop.time()))
+                    logger.warning(f"🔁 {self.service}: {model_name} failed ({type(e).__name__}), "
+                                   f"retry {attempt + 1}/{self.max_retries} in {delay:.2f}s")
+                    RETRIES.inc(model=model_name)
+                    await asyncio.sleep(delay)
+
+            if index + 1 < len(models):
+                next_name = model_name_of(models[index + 1])
+                logger.warning(f"↪️ {self.service}: failing over {model_name} -> {next_name}")
+                FAILOVERS.inc(from_model=model_name, to_model=next_name)
+
+        raise last_error
+
+    async def stream(self, contents, answered=None, **kwargs):
+        """
+        Streamed variant: fails over only before the first chunk, since text already
+        sent to the client can't be taken back. answered (a dict) gets the "model_name"
+        of the model that is streaming once its first chunk arrives.
+        """
+        last_error = None
+        models = self.candidates()
+        for index, model in enumerate(models):
+            model_name = model_name_of(model)
+            if not breaker_for(model_name).allow() and index + 1 < len(models):
+                continue
+            started = False
+            try:
+                async for text in self.gateway.stream(model, contents, service=self.service, **kwargs):
+                    if not started and answered is not None:
+                        answered['model_name'] = model_name
+                    started = True
+                    yield text
+                breaker_for(model_name).record_success()
+                return
+            except Overloaded:
+                raise
+            except Exception as e:
+                breaker_for(model_name).record_failure()
+                if started or not (is_retryable(e) or type(e).__name__ in MODEL_ERRORS):
+                    raise
+                last_error = e
+                logger.warning(f"↪️ {self.service}: stream from {model_name} failed ({type(e).__name__}), failing over")
+        if last_error is not None:
+            raise last_error
+        raise Exception(f"No Gemini model available for {self.service}")
@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import REGISTRY
+from result_cache import DiskTier
+from shared_state import WORKERS, shared_path
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Chat session settings
+CHAT_SESSION_TTL = float(os.getenv('CHAT_SESSION_TTL', str(6 * 3600)))
+CHAT_SESSION_MAX = int(os.getenv('CHAT_SESSION_MAX', '10000'))
+# Optional SQLite persistence, e.g. CHAT_SESSION_DB=data/chat_sessions.sqlite3 (unset = memory only,
+# or a file in SHARED_STATE_DIR when running several workers, since follow-ups may land on any of them)
+CHAT_SESSION_DB = os.getenv('CHAT_SESSION_DB', shared_path('chat_sessions.sqlite3'))
+# History sent with each turn is kept under this many (estimated) tokens by compacting older turns
+CHAT_HISTORY_TOKENS = int(os.getenv('CHAT_HISTORY_TOKENS', '2000'))
+CHAT_SUMMARY_TOKENS = int(os.getenv('CHAT_SUMMARY_TOKENS', '400'))
+# Most recent question/answer pairs that are never compacted
+CHAT_KEEP_EXCHANGES = int(os.getenv('CHAT_KEEP_EXCHANGES', '2'))
+
+COMPACTIONS = REGISTRY.counter('chat_history_compactions', 'Older chat turns folded into the session summary')
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+
+def estimate_tokens(text):
+    # ~4 characters per token for English text; close enough for budgeting
+    return len(text) // 4 + 1
+
+
+def _first_sentence(text, limit):
+    text = ' '.join(text.split())
+    sentence = _SENTENCE_END.split(text, 1)[0]
+    return sentence if len(sentence) <= limit else sentence[:limit].rsplit(' ', 1)[0] + '…'
+
+
+class ChatSession:
+    """
+    One conversation: recent turns verbatim, older ones compacted into a short summary
+    """
+
+    def __init__(self, session_id, user_name, turns=None, summary=None, updated_at=None):
+        self.id = session_id
+        self.user_name = user_name
+        self.turns = turns or []
+        self.summary = summary or []
+        self.updated_at = updated_at or time.time()
+        # Turns of one session are answered one at a time, in order
+        self.lock = asyncio.Lock()
+
+    @property
+    def has_history(self):
+        return bool(self.turns or self.summary)
+
+    def contents(self, question):
+        """
+        Gemini contents for the next turn: summary, recent turns, then the new question
+        """
+        contents = []
+        if self.summary:
+            contents.append({'role': 'user', 'parts': ["Summary of our conversation so far:\n" + '\n'.join(self.summary)]})
+            contents.append({'role': 'model', 'parts': ["Thanks, I'll keep that in mind."]})
+        contents.extend({'role': role, 'parts': [text]} for role, text in self.turns)
+        contents.append({'role': 'user', 'parts': [question]})
+        return contents
+
+    def add_exchange(self, question, reply, budget=CHAT_HISTORY_TOKENS):
+        self.turns.append(('user', question))
+        self.turns.append(('model', reply))
+        self.updated_at = time.time()
+        self.compact(budget)
+
+    def tokens(self):
+        return sum(estimate_tokens(text) for _, text in self.turns) + sum(estimate_tokens(line) for line in self.summary)
+
+    def compact(self, budget=CHAT_HISTORY_TOKENS, summary_budget=CHAT_SUMMARY_TOKENS, keep=CHAT_KEEP_EXCHANGES):
+        """
+        Fold the oldest exchanges into one summary line each until the history fits the budget
+        (extractive: question gist + first sentence of the answer, no extra model call)
+        """
+        while self.tokens() > budget and len(self.turns) > 2 * keep:
+            (_, question), (_, reply) = self.turns[0], self.turns[1]
+            del self.turns[:2]
+            question = question.split("'s Question:", 1)[-1]
+            self.summary.append(f"- Asked: {_first_sentence(question, 160)} Answered: {_first_sentence(reply, 200)}")
+            COMPACTIONS.inc()
+        while self.summary and sum(estimate_tokens(line) for line in self.summary) > summary_budget:
+            self.summary.pop(0)
+
+    def to_dict(self):
+        return {"user_name": self.user_name, "turns": self.turns, "summary": self.summary, "updated_at": self.updated_at}
+
+    @classmethod
+    def from_dict(cls, session_id, data):
+        return cls(session_id, data['user_name'], [tuple(turn) for turn in data['turns']],
+                   data['summary'], data['updated_at'])
+
+
+class SessionStore:
+    """
+    Chat sessions by ID: in-memory LRU with an idle TTL, optionally written
+    through to SQLite so conversations survive restarts
+    """
+
+    def __init__(self, max_sessions=CHAT_SESSION_MAX, ttl_seconds=CHAT_SESSION_TTL, disk_path=None, shared=False):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        # Other workers write to the same file, so the in-memory copy is checked against it on every turn
+        self.shared = shared
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.disk = None
+        self.created = 0
+        self.evicted = 0
+        self.expired = 0
+
+        if disk_path:
+            try:
+                self.disk = DiskTier(disk_path)
+                self.disk.purge_expired()
+                logger.info(f"💾 Chat sessions persisted to {disk_path}")
+            except Exception as e:
+                logger.warning(f"⚠️ Session store unavailable ({disk_path}): {e}")
+                self.disk = None
+
+    def get(self, session_id, user_name):
+        """
+        Existing session (memory, then disk) or a new empty one
+        """
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                if session.updated_at + self.ttl_seconds >= now:
+                    self._sessions.move_to_end(session_id)
+                else:
+                    del self._sessions[session_id]
+                    self.expired += 1
+                    session = None
+        if session is not None:
+            if self.shared:
+                self._refresh(session)
+            return session
+
+        session = None
+        if self.disk is not None:
+            try:
+                stored = self.disk.get(f"chat:{session_id}")
+                if stored is not None:
+                    session = ChatSession.from_dict(session_id, stored[0])
+            except Exception as e:
+                logger.warning(f"⚠️ Session read failed: {e}")
+        if session is None:
+            session = ChatSession(session_id, user_name)
+            self.created += 1
+
+        with self._lock:
+            # Another request may have loaded it meanwhile; keep one object per ID so its lock is shared
+            session = self._sessions.setdefault(session_id, session)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evicted += 1
+        return session
+
+    def _refresh(self, session):
+        # Pick up turns another worker added since this copy was loaded
+        try:
+            stored = self.disk.get(f"chat:{session.id}") if self.disk is not None else None
+        except Exception as e:
+            logger.warning(f"⚠️ Session read failed: {e}")
+            return
+        if stored is not None and stored[0]['updated_at'] > session.updated_at:
+            newer = ChatSession.from_dict(session.id, stored[0])
+            session.turns, session.summary, session.updated_at = newer.turns, newer.summary, newer.updated_at
+
+    def save(self, session):
+        if self.disk is None:
+            return
+        try:
+            self.disk.set(f"chat:{session.id}", session.to_dict(), session.updated_at + self.ttl_seconds)
+        except Exception as e:
+            logger.warning(f"⚠️ Session write failed: {e}")
+
+    def delete(self, session_id):
+        with self._lock:
+            found = self._sessions.pop(session_id, None) is not None
+        if self.disk is not None:
+            try:
+                self.disk.delete(f"chat:{session_id}")
+            except Exception as e:
+                logger.warning(f"⚠️ Session delete failed: {e}")
+        return found
+
+    def stats(self):
+        sessions = list(self._sessions.values())
+        return {
+            "sessions": len(sessions),
+            "max_sessions": self.max_sessions,
+            "ttl_seconds": self.ttl_seconds,
+            "disk": self.disk is not None,
+            "created": self.created,
+            "evicted": self.evicted,
+            "expired": self.expired,
+            "history_token_budget": CHAT_HISTORY_TOKENS,
+            "avg_history_tokens": round(sum(s.tokens() for s in sessions) / len(sessions), 1) if sessions else 0.0
+        }
+
+
+def store_from_env():
+    return SessionStore(disk_path=CHAT_SESSION_DB or None, shared=WORKERS > 1)
@@ -1,44 +1,25 @@
-import google.generativeai as genai
+import asyncio
 import logging
-import os
+import time
+from collections import deque
 
-logger = logging.getLogger(__name__)
-
-# 🔑 Gemini API Key from environment variable ONLY (no hardcoded fallback)
-GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+from call_policy import CallPolicy
+from chat_sessions import store_from_env
+from concurrency_limiter import Overloaded
+from inference import model_name_of, run_sync
+from metrics import FALLBACKS, annotate
+from model_registry import CHAT_MODEL_NAMES, registry
+from prompts import PROMPTS, Prompt
+from semantic_cache import CHAT_CACHE_PATH, SemanticCache, depersonalize, normalize, personalize
+from shared_state import WORKERS
+from singleflight import SingleFlight
 
-if not GEMINI_API_KEY:
-    logger.error("❌ GEMINI_API_KEY environment variable not set!")
-
-class FarmingChatbot:
-    def __init__(self):
-        logger.info("💬 Initializing AI Farming Chatbot...")
-        try:
-            if not GEMINI_API_KEY:
-                raise Exception("GEMINI_API_KEY environment variable is missing")
-            
-            genai.configure(api_key=GEMINI_API_KEY)
-            self.model = genai.GenerativeModel('gemini-2.5-flash')
-            logger.info("✅ Chatbot ready!")
+logger = logging.getLogger(__name__)
 
-        except Exception as e:
-            logger.error(f"❌ Chatbot initialization failed: {e}")
-            self.model = None
-
-    def get_response(self, user_message, user_name="Farmer"):
-        """
-        Get AI response to user's farming question
-        """
-        try:
-            if not self.model:
-                return {
-                    "reply": "I'm having trouble connecting right now. Please try again!",
-                    "success": False
-                }
-            
-            # Personalized system context with user's name
-            system_context = f"""
-You are an expert agricultural AI assistant helping {user_name}, a farmer, with farming questions.
+# Same for every farmer, so it's set once as the model's system instruction instead of prepended to every question
+CHAT_SYSTEM_INSTRUCTION = """
+You are an expert agricultural AI assistant helping farmers with farming questions.
+Each question starts with the farmer's name ("<name>'s Question: ...").
 
 Your expertise includes:
 - Crop diseases and pest management
@@ -51,7 +32,7 @@ Your expertise includes:
 - Sustainable agriculture
 
 Guidelines:
-- Address the farmer by name ({user_name}) occasionally to be personal and friendly
+- Address the farmer by name occasionally to be personal and friendly
 - Be encouraging and supportive - farming is hard work!
 - Provide practical, actionable advice they can implement
 - Use simple language (avoid overly technical jargon)
@@ -60,36 +41,209 @@ Guidelines:
 - Keep responses concise (2-3 paragraphs max, unless detailed explanation needed)
 - Use emojis occasionally to be friendly 🌾
 - If you give specific product recommendations, mention they're general suggestions
+- Use earlier turns of the conversation for context on follow-up questions
 
-Remember: You're helping {user_name} succeed in their farming journey!
+Remember: You're helping farmers succeed in their farming journey!
 """
 
-            # Combine context with user message
-            full_prompt = f"{system_context}\n\n{user_name}'s Question: {user_message}\n\nYour Response:"
-            
-            # Get response from Gemini
-            response = self.model.generate_content(full_prompt)
-            
-            if not response or not response.text:
+# Bump the version whenever the instruction or _build_prompt changes, so cached answers from the old prompt aren't reused
+CHAT_PROMPT = PROMPTS.register(Prompt('chat', 'v2', CHAT_SYSTEM_INSTRUCTION))
+
+class FarmingChatbot:
+    def __init__(self):
+        logger.info("💬 Initializing AI Farming Chatbot...")
+        self.in_flight = SingleFlight('chat')
+        # Answers to similar questions already asked (by anyone), re-personalized per user
+        self.semantic_cache = SemanticCache('chat', path=CHAT_CACHE_PATH or None, shared=WORKERS > 1)
+        # Server-side conversation history for clients that send a sessionId
+        self.sessions = store_from_env()
+        self.stream_stats = {"started": 0, "completed": 0, "cancelled": 0, "errors": 0}
+        self._ttft_samples = deque(maxlen=1000)
+        self._model = None
+        PROMPTS.configure(registry, 'chat')
+        # Deadline, retries and failover to the other Gemini models
+        self.policy = CallPolicy('chat', lambda: self.model)
+
+    @property
+    def model(self):
+        # Built lazily by the shared registry (or already warmed up by the app lifespan)
+        if self._model is None:
+            self._model = registry.get('chat', CHAT_MODEL_NAMES)
+        return self._model
+
+    @model.setter
+    def model(self, value):
+        self._model = value
+
+    def get_response(self, user_message, user_name="Farmer", session_id=None):
+        """
+        Get AI response to user's farming question
+        """
+        return run_sync(self.get_response_async(user_message, user_name, session_id))
+
+    async def get_response_async(self, user_message, user_name="Farmer", session_id=None):
+        """
+        Non-blocking variant used by the API (Gemini call goes through the shared inference gateway).
+        With a session_id the reply takes the session's earlier turns into account.
+        """
+        await registry.wait_until_warm()
+        try:
+            if not self.model:
+                FALLBACKS.inc(service='chat')
                 return {
-                    "reply": f"I'm sorry {user_name}, I couldn't generate a response. Could you rephrase your question?",
+                    "reply": "I'm having trouble connecting right now. Please try again!",
                     "success": False
                 }
             
-            reply = response.text.strip()
-            
-            logger.info(f"✅ Generated response for {user_name} ({len(reply)} chars)")
-            
-            return {
-                "reply": reply,
-                "success": True
-            }
+            session = await asyncio.to_thread(self.sessions.get, session_id, user_name) if session_id else None
+            if session is None:
+                return await self._answer(None, user_message, user_name)
+            async with session.lock:
+                return await self._answer(session, user_message, user_name)
             
+        except Overloaded:
+            raise
         except Exception as e:
             logger.error(f"Chatbot error: {e}")
+            FALLBACKS.inc(service='chat')
             return {
                 "reply": f"I apologize {user_name}, but I'm having trouble right now. As your farming assistant, I'm here to help with crops, soil, diseases, and farming techniques. Please try asking again!",
                 "success": False
             }
 
+    async def _answer(self, session, user_message, user_name):
+        # Follow-ups depend on the conversation, so only standalone questions use the shared cache
+        standalone = session is None or not session.has_history
+        namespace = self._cache_namespace()
+        question = self._build_prompt(user_message, user_name)
+        
+        reply = self.semantic_cache.lookup(user_message, user_name, namespace) if standalone else None
+        model_name = None
+        if reply is not None:
+            annotate(answered_by='cache')
+        elif standalone:
+            # Get response from Gemini (the same question already in flight, from anyone, shares one call)
+            flight_key = (namespace, normalize(user_message))
+            template, model_name = await self.in_flight.do(flight_key,
+                                                           lambda: self._generate_template(question, user_name))
+            reply = personalize(template, user_name) if template else None
+        else:
+            reply, model_name = await self._generate_reply(session.contents(question))
+        
+        if not reply:
+            FALLBACKS.inc(service='chat')
+            return {
+                "reply": f"I'm sorry {user_name}, I couldn't generate a response. Could you rephrase your question?",
+                "success": False
+            }
+        
+        logger.info(f"✅ Generated response for {user_name} ({len(reply)} chars)")
+        if standalone:
+            # Under the model that answered: a failover reply isn't the primary model's answer
+            self.semantic_cache.add(user_message, user_name, reply, self._cache_namespace(model_name))
+        await self._remember_turn(session, question, reply)
+        
+        return {
+            "reply": reply,
+            "success": True
+        }
+
+    async def stream_response(self, user_message, user_name="Farmer", session_id=None):
+        """
+        Yield the reply in chunks as Gemini generates it (raises if the model is unavailable)
+        """
+        await registry.wait_until_warm()
+        if not self.model:
+            raise Exception("Chatbot model not initialized")
+        
+        session = await asyncio.to_thread(self.sessions.get, session_id, user_name) if session_id else None
+        if session is None:
+            async for text in self._stream_answer(None, user_message, user_name):
+                yield text
+            return
+        async with session.lock:
+            async for text in self._stream_answer(session, user_message, user_name):
+                yield text
+
+    async def _stream_answer(self, session, user_message, user_name):
+        self.stream_stats["started"] += 1
+        standalone = session is None or not session.has_history
+        namespace = self._cache_namespace()
+        question = self._build_prompt(user_message, user_name)
+        
+        cached = self.semantic_cache.lookup(user_message, user_name, namespace) if standalone else None
+        if cached is not None:
+            annotate(answered_by='cache')
+            self.stream_stats["completed"] += 1
+            await self._remember_turn(session, question, cached)
+            yield cached
+            return
+        
+        start = time.perf_counter()
+        first_token = True
+        parts = []
+        
+        try:
+            contents = question if session is None else session.contents(question)
+            answered = {}
+            async for text in self.policy.stream(contents, answered=answered):
+                if first_token:
+                    ttft = time.perf_counter() - start
+                    self._ttft_samples.append(ttft)
+                    logger.info(f"⏱️ First token for {user_name} after {ttft*1000:.0f}ms")
+                    first_token = False
+                parts.append(text)
+                yield text
+            
+            self.stream_stats["completed"] += 1
+            reply = ''.join(parts).strip()
+            logger.info(f"✅ Streamed response for {user_name} ({len(reply)} chars)")
+            if standalone:
+                self.semantic_cache.add(user_message, user_name, reply, self._cache_namespace(answered.get('model_name')))
+            await self._remember_turn(session, question, reply)
+            
+        except (asyncio.CancelledError, GeneratorExit):
+            self.stream_stats["cancelled"] += 1
+            logger.info(f"🔌 {user_name} disconnected, upstream stream cancelled")
+            raise
+        except Exception:
+            self.stream_stats["errors"] += 1
+            raise
+
+    async def _remember_turn(self, session, question, reply):
+        # Only completed answers enter the history; failed or cancelled turns leave it unchanged
+        if session is not None and reply:
+            session.add_exchange(question, reply)
+            await asyncio.to_thread(self.sessions.save, session)
+
+    def streaming_stats(self):
+        samples = sorted(self._ttft_samples)
+        
+        def pct(p):
+            return round(samples[min(len(samples) - 1, int(len(samples) * p))] * 1000, 1) if samples else 0.0
+        
+        return dict(self.stream_stats, ttft_p50_ms=pct(0.50), ttft_p95_ms=pct(0.95))
+
+    def _cache_namespace(self, model_name=None):
+        # Lookups use the primary model's; answers are stored under the model that gave them
+        return f"{model_name or model_name_of(self.model)}:{CHAT_PROMPT.key}"
+
+    def _build_prompt(self, user_message, user_name):
+        # The instructions live in the model's system_instruction; each turn only carries who is asking
+        return f"{user_name}'s Question: {user_message}"
+
+    async def _generate_template(self, question, user_name):
+        # The reply with the asker's name as a placeholder, so callers sharing the call get their own name
+        reply, model_name = await self._generate_reply(question)
+        return (depersonalize(reply, user_name) if reply else None), model_name
+
+    async def _generate_reply(self, contents):
+        """
+        (reply text or None, name of the model that answered)
+        """
+        response = await self.policy.generate(contents)
+        if not response or not response.text:
+            return None, None
+        return response.text.strip(), response.model_name
+
 chatbot = FarmingChatbot()
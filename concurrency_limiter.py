@@ -0,0 +1,263 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import math
+import os
+import time
+
+from shared_state import per_worker
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Admission control settings
+# "adaptive" = AIMD limit per model, "fixed" = the configured limit never moves
+LIMITER_MODE = os.getenv('GEMINI_LIMITER_MODE', 'adaptive')
+LIMITER_MIN_LIMIT = int(os.getenv('GEMINI_MIN_CONCURRENCY', '1'))
+# Deployment-wide, like GEMINI_MAX_CONCURRENCY; each worker gets its share
+LIMITER_MAX_LIMIT = per_worker(os.getenv('GEMINI_MAX_CONCURRENCY_CEILING', '64'))
+# Latency is judged per window of this many successful calls: congestion is the window's p90
+# exceeding this multiple of the baseline p90, so one slow call in a noisy distribution isn't
+LIMITER_WINDOW = int(os.getenv('GEMINI_LIMIT_WINDOW', '25'))
+LIMITER_LATENCY_TOLERANCE = float(os.getenv('GEMINI_LATENCY_TOLERANCE', '1.5'))
+LIMITER_BACKOFF = float(os.getenv('GEMINI_LIMIT_BACKOFF', '0.9'))
+# Requests allowed to wait for a slot (all priorities together)
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', '64'))
+
+# Lower rank is served first; each priority has its own max queue wait (seconds)
+PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+QUEUE_TIMEOUTS = {
+    'high': float(os.getenv('ADMISSION_TIMEOUT_HIGH', '5')),
+    'normal': float(os.getenv('ADMISSION_TIMEOUT_NORMAL', '15')),
+    'low': float(os.getenv('ADMISSION_TIMEOUT_LOW', '60')),
+}
+
+# Exceptions (by class name, so the SDK needn't be imported) that mean "back off"
+CONGESTION_ERRORS = (
+    'ResourceExhausted', 'TooManyRequests', 'DeadlineExceeded', 'ServiceUnavailable',
+    'TimeoutError', 'InternalServerError'
+)
+
+_priority = contextvars.ContextVar('gemini_priority', default='normal')
+
+
+def set_priority(priority):
+    """
+    Priority for Gemini calls made from the current request (inherited by tasks it spawns)
+    """
+    if priority not in PRIORITIES:
+        raise ValueError(f"unknown priority {priority!r}")
+    _priority.set(priority)
+
+
+def current_priority():
+    return _priority.get()
+
+
+def is_congestion_error(error):
+    return type(error).__name__ in CONGESTION_ERRORS
+
+
+class Overloaded(Exception):
+    """
+    Raised instead of queueing when the model can't take the request in time
+    """
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = max(1, min(60, int(math.ceil(retry_after))))
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit with a bounded, priority-ordered wait queue.
+
+    The limit grows by about one slot per limit's worth of successful calls
+    and shrinks multiplicatively when calls are rate-limited or time out, or
+    when a window's p90 latency is well above the baseline p90 (the gradient
+    sets how far it shrinks). Waiters are served by
+    priority, then arrival; each has a deadline, and a request whose estimated
+    wait already exceeds it is rejected immediately rather than queued.
+    """
+
+    def __init__(self, name, initial_limit, adaptive=LIMITER_MODE == 'adaptive',
+                 min_limit=LIMITER_MIN_LIMIT, max_limit=LIMITER_MAX_LIMIT,
+                 max_queue=ADMISSION_QUEUE_SIZE, timeouts=QUEUE_TIMEOUTS):
+        self.name = name
+        self.adaptive = adaptive
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.max_queue = max_queue
+        self.timeouts = dict(timeouts)
+        self.in_flight = 0
+        self._queue = []
+        self._queued = 0
+        self._seq = itertools.count()
+        # EWMAs of healthy windows' p50 (per-call estimate for waits) and p90 (the "no congestion" reference)
+        self.baseline = None
+        self.baseline_p90 = None
+        self._window = []
+        self._window_peak = 0
+        self._last_decrease = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.shed = 0
+
+    def set_limit(self, limit):
+        self.limit = float(min(max(int(limit), self.min_limit), self.max_limit))
+        self._wake()
+
+    def _estimated_wait(self, rank):
+        ahead = sum(1 for entry in self._queue if not entry[3]['done'] and entry[0] <= rank)
+        per_call = self.baseline if self.baseline is not None else 1.0
+        return (ahead + 1) / max(1.0, self.limit) * per_call
+
+    def check(self, priority=None):
+        """
+        Raise Overloaded if a request of this priority would be rejected right now
+        """
+        priority = priority or current_priority()
+        rank = PRIORITIES[priority]
+        if self.in_flight < int(self.limit) and not self._queued:
+            return
+        if self._queued >= self.max_queue and self._worst_entry(rank) is None:
+            self.rejected += 1
+            raise Overloaded(f"{self.name}: wait queue full", self._estimated_wait(rank))
+        wait = self._estimated_wait(rank)
+        if wait > self.timeouts[priority]:
+            self.rejected += 1
+            raise Overloaded(f"{self.name}: estimated wait {wait:.1f}s exceeds {priority} deadline", wait)
+
+    async def acquire(self, priority=None):
+        priority = priority or current_priority()
+        rank = PRIORITIES[priority]
+
+        if self.in_flight < int(self.limit) and not self._queued:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+
+        self.check(priority)
+
+        if self._queued >= self.max_queue:
+            # Make room by shedding the newest request of the lowest priority below ours
+            victim = self._worst_entry(rank)
+            self._drop(victim, Overloaded(f"{self.name}: shed for higher-priority work",
+                                          self._estimated_wait(victim[0])))
+            self.shed += 1
+
+        loop = asyncio.get_running_loop()
+        state = {'done': False, 'future': loop.create_future()}
+        entry = (rank, next(self._seq), priority, state)
+        heapq.heappush(self._queue, entry)
+        self._queued += 1
+        timer = loop.call_later(self.timeouts[priority], self._expire, entry)
+        try:
+            await state['future']
+        except asyncio.CancelledError:
+            future = state['future']
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.release()  # granted just as the caller went away
+            elif not state['done']:
+                state['done'] = True
+                self._queued -= 1
+            raise
+        finally:
+            timer.cancel()
+        self.admitted += 1
+
+    def _worst_entry(self, rank):
+        candidates = [entry for entry in self._queue if not entry[3]['done'] and entry[0] > rank]
+        return max(candidates, key=lambda entry: (entry[0], entry[1])) if candidates else None
+
+    def _drop(self, entry, error):
+        state = entry[3]
+        if state['done']:
+            return
+        state['done'] = True
+        self._queued -= 1
+        if not state['future'].done():
+            state['future'].set_exception(error)
+
+    def _expire(self, entry):
+        if not entry[3]['done']:
+            self.expired += 1
+            self._drop(entry, Overloaded(f"{self.name}: waited {self.timeouts[entry[2]]:.0f}s for a slot",
+                                         self._estimated_wait(entry[0])))
+
+    def _wake(self):
+        while self._queue and self.in_flight < int(self.limit):
+            entry = heapq.heappop(self._queue)
+            state = entry[3]
+            if state['done']:
+                continue
+            state['done'] = True
+            self._queued -= 1
+            self.in_flight += 1
+            state['future'].set_result(True)
+
+    def release(self, latency=None, error=None):
+        """
+        Free a slot; latency/error (when given) feed the AIMD controller
+        """
+        self.in_flight -= 1
+        if self.adaptive and (latency is not None or error is not None):
+            self._update(latency, error)
+        self._wake()
+
+    def _update(self, latency, error):
+        if error is not None:
+            if is_congestion_error(error):
+                self._decrease(LIMITER_BACKOFF)
+            return
+        self._window.append(latency)
+        self._window_peak = max(self._window_peak, self.in_flight + 1)
+        if len(self._window) >= LIMITER_WINDOW:
+            self._close_window()
+
+    def _close_window(self):
+        window = sorted(self._window)
+        p50 = window[len(window) // 2]
+        p90 = window[min(len(window) - 1, int(len(window) * 0.9))]
+        utilized = self._window_peak >= self.limit / 2
+        self._window = []
+        self._window_peak = 0
+
+        if self.baseline_p90 is None:
+            self.baseline, self.baseline_p90 = p50, p90
+            return
+        if p90 > LIMITER_LATENCY_TOLERANCE * self.baseline_p90:
+            # Queueing upstream: shrink in proportion to the slowdown (but never below half)
+            self._decrease(max(0.5, min(LIMITER_BACKOFF, LIMITER_LATENCY_TOLERANCE * self.baseline_p90 / p90)))
+            return
+        # Only healthy windows move the reference, so queueing delay doesn't become the new normal
+        self.baseline += 0.2 * (p50 - self.baseline)
+        self.baseline_p90 += 0.2 * (p90 - self.baseline_p90)
+        if utilized:
+            # Only grow while the limit is actually being used; about one slot per limit's worth of calls
+            self.limit = min(self.max_limit, self.limit + len(window) / self.limit)
+
+    def _decrease(self, factor):
+        now = time.monotonic()
+        # At most one decrease per baseline round-trip, so one slow burst doesn't collapse the limit
+        if now - self._last_decrease >= (self.baseline or 1.0):
+            self.limit = max(self.min_limit, self.limit * factor)
+            self._last_decrease = now
+            logger.info(f"📉 {self.name} concurrency limit -> {self.limit:.1f}")
+
+    def stats(self):
+        return {
+            "mode": "adaptive" if self.adaptive else "fixed",
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": self._queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "expired": self.expired,
+            "shed": self.shed,
+            "baseline_latency_ms": round(self.baseline * 1000, 1) if self.baseline is not None else None,
+            "baseline_p90_ms": round(self.baseline_p90 * 1000, 1) if self.baseline_p90 is not None else None
+        }
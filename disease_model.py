@@ -1,71 +1,29 @@
-import google.generativeai as genai
 from PIL import Image
+import asyncio
 import logging
-import json
 import io
-import os
 
-logger = logging.getLogger(__name__)
-
-# 🔑 Gemini API Key from environment variable ONLY (no hardcoded fallback)
-GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-
-if not GEMINI_API_KEY:
-    logger.error("❌ GEMINI_API_KEY environment variable not set!")
+from call_policy import CallPolicy
+from concurrency_limiter import Overloaded
+from image_preprocessing import ensure_prepared
+from inference import model_name_of, run_sync
+from local_classifier import FEATURE_SIZE, load_local_classifier
+from metrics import FALLBACKS, annotate, stage
+from model_registry import DISEASE_MODEL_NAMES, registry
+from perceptual_index import NearDuplicateIndex
+from prescreen import prescreener
+from prompts import PROMPTS, Prompt
+from response_schema import SALVAGED, Schema, StructuredParser
+from result_cache import cache_from_env, make_key
+from singleflight import SingleFlight
 
-class PlantDiseaseDetector:
-    def __init__(self):
-        logger.info("🤖 Initializing Google Gemini Vision AI...")
-        try:
-            if not GEMINI_API_KEY:
-                raise Exception("GEMINI_API_KEY environment variable is missing")
-            
-            genai.configure(api_key=GEMINI_API_KEY)
-
-            # Use the CORRECT model names from your available list
-            model_names = [
-                'gemini-2.5-flash',           # Latest stable
-                'gemini-flash-latest',        # Always latest
-                'gemini-2.0-flash',           # Stable alternative
-            ]
-            
-            self.model = None
-            
-            for model_name in model_names:
-                try:
-                    logger.info(f"🔍 Trying model: {model_name}...")
-                    self.model = genai.GenerativeModel(model_name)
-                    logger.info(f"✅ Successfully using model: {model_name}")
-                    break
-                except Exception as e:
-                    logger.warning(f"❌ Model {model_name} failed: {e}")
-                    continue
-            
-            if not self.model:
-                raise Exception("No valid Gemini model found")
-                
-            logger.info("✅ Gemini AI initialized successfully!")
-            
-        except Exception as e:
-            logger.error(f"❌ Gemini initialization failed: {e}")
-            self.model = None
+logger = logging.getLogger(__name__)
 
-    def analyze_disease(self, image):
-        """
-        Use Google Gemini Vision to analyze plant diseases
-        """
-        try:
-            if not self.model:
-                logger.error("Model not initialized")
-                return self._fallback_analysis()
-            
-            logger.info("🔍 Sending image to Google Gemini Vision AI...")
-            
-            # Prepare prompt for plant disease detection
-            prompt = """
+# Instructions for plant disease detection, set once as the model's system instruction
+DISEASE_INSTRUCTION = """
 You are an expert agricultural AI assistant specializing in plant disease detection.
 
-Analyze this image and provide a JSON response with the following structure:
+Analyze each image you receive and provide a JSON response with the following structure:
 
 {
   "is_plant": true/false,
@@ -101,80 +59,286 @@ Rules:
 Respond with ONLY valid JSON, no other text.
 """
 
-            # Send to Gemini
-            try:
-                response = self.model.generate_content([prompt, image])
-                
-                if not response or not response.text:
-                    logger.error("Empty response from Gemini")
-                    return self._fallback_analysis()
-                
-                logger.info(f"📥 Gemini raw response: {response.text[:300]}...")
-                
-                # Parse JSON response
-                result = self._parse_gemini_response(response.text)
-                
-                logger.info(f"🔬 Analysis: {result['disease']} ({result['confidence']*100:.1f}%)")
-                
-                return result
-                
-            except Exception as api_error:
-                logger.error(f"Gemini API call failed: {api_error}")
+# Sent instead of "Analyze this image." when several images are packed into one request
+MULTI_IMAGE_INSTRUCTIONS = """
+You will receive {count} images. Analyze each one independently and respond with ONLY a JSON array
+containing exactly {count} objects with the structure from your instructions, in the same order as the images.
+"""
+
+# Bump the version whenever the texts change (it is part of the result-cache key)
+DISEASE_PROMPT = PROMPTS.register(Prompt('disease', 'v2', DISEASE_INSTRUCTION, "Analyze this image.",
+                                         MULTI_IMAGE_INSTRUCTIONS))
+
+# Shape of one reply; also sent to Gemini as the response_schema in JSON mode
+DISEASE_SCHEMA = Schema('disease', {
+    'is_plant': ('boolean', True),
+    'disease': ('string', 'Unknown'),
+    'confidence': ('number', 0.75, 0.0, 1.0),
+    'severity': ('string', 'Unknown'),
+    'description': ('string', 'Analysis completed'),
+    'treatment': ('string', 'Consult agricultural expert'),
+    'prevention': ('string', 'Monitor regularly'),
+}, required=('disease',))
+
+class PlantDiseaseDetector:
+    def __init__(self):
+        logger.info("🤖 Initializing plant disease detector...")
+        self.cache = cache_from_env('disease')
+        self.near_duplicates = NearDuplicateIndex('disease')
+        self.in_flight = SingleFlight('disease')
+        self.local_model = load_local_classifier()
+        self._model = None
+        PROMPTS.configure(registry, 'disease')
+        # Deadline, retries and failover to the other Gemini models
+        self.policy = CallPolicy('disease', lambda: self.model)
+        self.parser = StructuredParser('disease', DISEASE_SCHEMA)
+
+    @property
+    def model(self):
+        # Built lazily by the shared registry (or already warmed up by the app lifespan)
+        if self._model is None:
+            self._model = registry.get('disease', DISEASE_MODEL_NAMES)
+        return self._model
+
+    @model.setter
+    def model(self, value):
+        self._model = value
+
+    def analyze_disease(self, image):
+        """
+        Use Google Gemini Vision to analyze plant diseases
+        """
+        return run_sync(self.analyze_disease_async(image))
+
+    async def analyze_disease_async(self, image):
+        """
+        Non-blocking variant used by the API (Gemini call goes through the shared inference gateway)
+        """
+        await registry.wait_until_warm()
+        try:
+            # Downscaled, encoded once; the same bytes are hashed and sent to Gemini
+            image = ensure_prepared(image)
+            
+            # Obviously unusable photos (too dark, blurry, no leaf colors) never reach a model
+            rejected = self._prescreen(image)
+            if rejected is not None:
+                annotate(answered_by='prescreen')
+                return rejected
+            
+            # Confident cases are answered offline; the rest escalate to Gemini
+            local = self._classify_locally([image])[0]
+            if local is not None:
+                annotate(answered_by='local')
+                return local
+            
+            if not self.model:
+                logger.error("Model not initialized")
                 return self._fallback_analysis()
             
+            # Repeat uploads and near-duplicates are answered without calling Gemini
+            known, ticket = await self._lookup(image)
+            if known is not None:
+                annotate(answered_by='cache')
+                return known
+            
+            # Identical uploads already waiting on Gemini share one call
+            return await self.in_flight.do(ticket[0], lambda: self._analyze_with_gemini(image, ticket))
+            
+        except Overloaded:
+            raise
         except Exception as e:
             logger.error(f"❌ Gemini analysis error: {e}")
             return self._fallback_analysis()
 
-    def _parse_gemini_response(self, response_text):
+    async def analyze_disease_many_async(self, images):
+        """
+        Analyze several images with one multi-image Gemini prompt (results in input order)
+        """
+        await registry.wait_until_warm()
+        images = [ensure_prepared(image) for image in images]
+        results = [self._prescreen(image) for image in images]
+        screened = [i for i, result in enumerate(results) if result is None]
+        for i, result in zip(screened, self._classify_locally([images[i] for i in screened])):
+            results[i] = result
+        if not self.model:
+            return [result or self._fallback_analysis() for result in results]
+        
+        tickets = [None] * len(images)
+        pending = []
+        for i, image in enumerate(images):
+            if results[i] is not None:
+                continue
+            results[i], tickets[i] = await self._lookup(image)
+            if results[i] is None:
+                pending.append(i)
+        
+        if len(pending) > 1:
+            logger.info(f"🔍 Sending {len(pending)} images to Gemini in one prompt...")
+            try:
+                contents = DISEASE_PROMPT.multi_contents([images[i].as_blob() for i in pending])
+                response = await self.policy.generate(contents,
+                                                      **self.parser.request_options(len(pending)))
+                with stage('parse'):
+                    items = self._parse_gemini_list(response.text, len(pending))
+                for i, result in zip(pending, items or []):
+                    if result is not None:
+                        results[i] = result
+                        self._remember(tickets[i], result, response.model_name)
+            except Overloaded:
+                raise
+            except Exception as e:
+                logger.error(f"Packed Gemini call failed: {e}")
+        
+        # Single image, or images the packed reply didn't cover: one call each
+        pending = [i for i in pending if results[i] is None]
+        singles = await asyncio.gather(*(
+            self.in_flight.do(tickets[i][0], lambda i=i: self._analyze_with_gemini(images[i], tickets[i]))
+            for i in pending
+        ))
+        for i, result in zip(pending, singles):
+            results[i] = result
+        
+        return results
+
+    def _classify_locally(self, images):
+        """
+        Batched offline inference: a result per confidently classified image, None elsewhere
+        """
+        if self.local_model is None or not images:
+            return [None] * len(images)
+        try:
+            with stage('local_classifier'):
+                results = self.local_model.classify_batch([image.thumbnail(FEATURE_SIZE) for image in images])
+        except Exception as e:
+            logger.error(f"Local classifier failed: {e}")
+            return [None] * len(images)
+        for result in results:
+            if result is not None:
+                logger.info(f"🧠 Local model: {result['disease']} ({result['confidence']*100:.1f}%)")
+        return results
+
+    def _prescreen(self, image):
+        """
+        Result for a photo the local pre-screen rejects, None if it should be analyzed
+        """
+        rejected = prescreener.screen(image, 'disease')
+        if rejected is None:
+            return None
+        return {
+            "success": False,
+            "disease": "Not a Plant Image" if rejected['reason'] == 'not_plant' else "Unclear Photo",
+            "confidence": 0.0,
+            "severity": "Error",
+            "description": rejected['message'],
+            "treatment": "N/A",
+            "prevention": "N/A",
+            "tips": list(rejected['tips']),
+            "prescreen": rejected['reason']
+        }
+
+    async def _lookup(self, image):
         """
-        Parse Gemini's JSON response
+        Result cache, then near-duplicate index. Returns (known result or None, ticket for _remember)
         """
+        with stage('cache_lookup'):
+            model_name = model_name_of(self.model)
+            cache_key, namespace = self._cache_keys(image.data, model_name)
+            cached = await self.cache.get_async(cache_key)
+            if cached is not None:
+                logger.info(f"⚡ Cache hit: {cached['disease']}")
+                return cached, None
+            
+            # Re-photographed or re-compressed copies of an image we've already analyzed
+            image_hash = image.perceptual_hash(self.near_duplicates.algorithm) if self.near_duplicates.enabled else None
+            ticket = (cache_key, namespace, image_hash, model_name, image.data)
+            return self.near_duplicates.lookup(image_hash, namespace), ticket
+
+    def _cache_keys(self, data, model_name):
+        return make_key(data, DISEASE_PROMPT.key, model_name), f"{model_name}:{DISEASE_PROMPT.key}"
+
+    def _remember(self, ticket, result, model_name):
+        # Only successful parses are cached, under the model that answered (not the primary after a failover)
+        if result.pop(SALVAGED, False):
+            # Recovered from a truncated reply: answer this request, but don't serve its defaults again
+            return
+        cache_key, namespace, image_hash, looked_up, data = ticket
+        if model_name != looked_up:
+            cache_key, namespace = self._cache_keys(data, model_name)
+        self.cache.set_behind(cache_key, result)
+        self.near_duplicates.add(image_hash, namespace, result)
+
+    async def _analyze_with_gemini(self, image, ticket):
+        logger.info("🔍 Sending image to Google Gemini Vision AI...")
+        
+        # Send to Gemini
         try:
-            # Extract JSON from response (handle markdown formatting)
-            json_text = response_text.strip()
+            response = await self.policy.generate(DISEASE_PROMPT.contents(image.as_blob()),
+                                                 **self.parser.request_options())
             
-            # Remove markdown code blocks if present
-            if '```' in json_text:
-                # Find content between ```json and ```
-                parts = json_text.split('```')
-                for part in parts:
-                    if part.strip().startswith('json'):
-                        json_text = part.strip()[4:].strip()
-                        break
-                    elif part.strip().startswith('{'):
-                        json_text = part.strip()
-                        break
+            if not response or not response.text:
+                logger.error("Empty response from Gemini")
+                return self._fallback_analysis()
             
-            json_text = json_text.strip()
+            logger.info(f"📥 Gemini raw response: {response.text[:300]}...")
             
-            # Parse JSON
-            data = json.loads(json_text)
+            # Parse JSON response
+            with stage('parse'):
+                result = self._parse_gemini_response(response.text)
+            if result is None:
+                return self._fallback_analysis()
             
-            # Validate and format
-            return {
-                "success": data.get('is_plant', True),
-                "disease": data.get('disease', 'Unknown'),
-                "confidence": float(data.get('confidence', 0.75)),
-                "severity": data.get('severity', 'Unknown'),
-                "description": data.get('description', 'Analysis completed'),
-                "treatment": data.get('treatment', 'Consult agricultural expert'),
-                "prevention": data.get('prevention', 'Monitor regularly')
-            }
+            logger.info(f"🔬 Analysis: {result['disease']} ({result['confidence']*100:.1f}%)")
             
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON parsing failed: {e}")
-            logger.error(f"Response text was: {json_text[:200]}")
-            return self._fallback_analysis()
-        except Exception as e:
-            logger.error(f"Failed to parse Gemini response: {e}")
+            self._remember(ticket, result, response.model_name)
+            return result
+            
+        except Overloaded:
+            raise
+        except Exception as api_error:
+            logger.error(f"Gemini API call failed: {api_error}")
             return self._fallback_analysis()
 
+    def _result_from_data(self, data):
+        # data is already validated and defaulted by DISEASE_SCHEMA
+        return {
+            "success": data['is_plant'],
+            "disease": data['disease'],
+            "confidence": data['confidence'],
+            "severity": data['severity'],
+            "description": data['description'],
+            "treatment": data['treatment'],
+            "prevention": data['prevention']
+        }
+
+    def _parse_gemini_response(self, response_text):
+        """
+        Parse Gemini's JSON response (returns None if it can't be parsed)
+        """
+        return self._result_from_parse(self.parser.parse_one(response_text))
+
+    def _parse_gemini_list(self, response_text, expected):
+        """
+        Parse a multi-image reply (JSON array, one object per image): a result or None per image, or None
+        """
+        items = self.parser.parse_many(response_text, expected)
+        if items is None:
+            return None
+        return [self._result_from_parse(item) for item in items]
+
+    def _result_from_parse(self, data):
+        if data is None:
+            return None
+        result = self._result_from_data(data)
+        if data.get(SALVAGED):
+            result[SALVAGED] = True
+        return result
+
     def _fallback_analysis(self):
         """
         Fallback if Gemini unavailable
         """
         logger.warning("⚠️ Using fallback analysis")
+        FALLBACKS.inc(service='disease')
         return {
             "success": False,
             "disease": "Service Unavailable",
@@ -0,0 +1,259 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Fake backend settings
+# "fixed:0.8", "uniform:0.3,1.5", "normal:0.8,0.2" or "lognormal:0.8,0.4" (median seconds, sigma)
+FAKE_LATENCY = os.getenv('FAKE_GEMINI_LATENCY', 'lognormal:0.8,0.4')
+FAKE_ERROR_RATE = float(os.getenv('FAKE_GEMINI_ERROR_RATE', '0'))
+# Comma-separated error class names to raise, picked at random
+FAKE_ERRORS = os.getenv('FAKE_GEMINI_ERRORS', 'ResourceExhausted,ServiceUnavailable')
+# Fraction of JSON replies wrapped in ```json fences, like the real model often does
+FAKE_FENCED_RATE = float(os.getenv('FAKE_GEMINI_FENCED_RATE', '0.5'))
+# Fraction of JSON replies cut off mid-object, like a reply that hit max_output_tokens
+FAKE_TRUNCATED_RATE = float(os.getenv('FAKE_GEMINI_TRUNCATED_RATE', '0'))
+FAKE_SEED = int(os.getenv('FAKE_GEMINI_SEED', '1234'))
+# Time between streamed chunks (seconds) and characters per chunk
+FAKE_STREAM_INTERVAL = float(os.getenv('FAKE_GEMINI_STREAM_INTERVAL', '0.05'))
+FAKE_STREAM_CHUNK = int(os.getenv('FAKE_GEMINI_STREAM_CHUNK', '40'))
+
+DISEASES = [
+    ("Healthy", "None", 0.93),
+    ("Leaf Blight", "Medium", 0.87),
+    ("Powdery Mildew", "Medium", 0.84),
+    ("Rust", "High", 0.81),
+    ("Leaf Spot", "Low", 0.78),
+]
+SOILS = [
+    ("Loamy", "Dark brown", 6.8, ["Wheat", "Maize", "Vegetables"]),
+    ("Clay", "Reddish brown", 7.4, ["Rice", "Sugarcane"]),
+    ("Sandy", "Light yellow", 6.1, ["Groundnut", "Millets"]),
+    ("Silty", "Grayish brown", 6.5, ["Rice", "Pulses"]),
+]
+CHAT_REPLY = (
+    "Great question, {name}! 🌾 For most field crops, test your soil before the season and add "
+    "well-rotted compost to improve structure and water holding. Water early in the morning at the "
+    "base of the plants, and scout leaves every few days for spots or yellowing so problems are caught "
+    "early. Rotating crops each season also breaks pest and disease cycles. Keep up the good work!"
+)
+
+
+class ResourceExhausted(Exception):
+    """Same class name as google.api_core's 429 error"""
+
+
+class ServiceUnavailable(Exception):
+    """Same class name as google.api_core's 503 error"""
+
+
+class InternalServerError(Exception):
+    """Same class name as google.api_core's 500 error"""
+
+
+class DeadlineExceeded(Exception):
+    """Same class name as google.api_core's 504 error"""
+
+
+ERROR_CLASSES = {cls.__name__: cls for cls in (ResourceExhausted, ServiceUnavailable, InternalServerError, DeadlineExceeded)}
+
+
+def parse_latency(spec):
+    """
+    "kind:arg1,arg2" -> function(rng) returning seconds
+    """
+    kind, _, args = spec.partition(':')
+    values = [float(value) for value in args.split(',') if value]
+    if kind == 'fixed':
+        return lambda rng: values[0]
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == 'normal':
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == 'lognormal':
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"unknown latency distribution {spec!r}")
+
+
+# Gemini bills a small image (<= 384px per side) as 258 tokens; larger ones are tiled
+IMAGE_TOKENS = 258
+
+
+class FakeUsage:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.cached_content_token_count = 0
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class FakeResponse:
+    def __init__(self, text, usage_metadata=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class FakeStream:
+    """
+    Iterable (sync) and async-iterable stream of FakeResponse chunks
+    """
+
+    def __init__(self, text, interval, chunk_size):
+        self.chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)] or ['']
+        self.interval = interval
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            time.sleep(self.interval)
+            yield FakeResponse(chunk)
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            await asyncio.sleep(self.interval)
+            yield FakeResponse(chunk)
+
+
+class FakeGenerativeModel:
+    """
+    Drop-in for genai.GenerativeModel (generate_content / generate_content_async, stream=True)
+    for load tests without API quota. Replies are canned but shaped like Gemini's:
+    disease/soil JSON (sometimes in ```json fences), arrays for multi-image prompts,
+    plain text for chat. Latency and errors come from a seeded RNG, so runs are reproducible.
+    """
+
+    def __init__(self, model_name, latency=FAKE_LATENCY, error_rate=FAKE_ERROR_RATE, errors=FAKE_ERRORS,
+                 fenced_rate=FAKE_FENCED_RATE, truncated_rate=FAKE_TRUNCATED_RATE, seed=FAKE_SEED,
+                 system_instruction=None, **kwargs):
+        self.model_name = model_name if model_name.startswith('models/') else f"models/{model_name}"
+        self.system_instruction = system_instruction
+        self._latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.errors = [ERROR_CLASSES[name.strip()] for name in errors.split(',') if name.strip()]
+        self.fenced_rate = fenced_rate
+        self.truncated_rate = truncated_rate
+        # Per-model stream of random numbers; the lock keeps executor threads from sharing state unsafely
+        self._rng = random.Random(f"{seed}:{self.model_name}")
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def _draw(self):
+        with self._lock:
+            self.calls += 1
+            latency = self._latency(self._rng)
+            error = self._rng.choice(self.errors) if self.errors and self._rng.random() < self.error_rate else None
+            fenced = self._rng.random() < self.fenced_rate
+            truncated = self._rng.random() < self.truncated_rate
+            pick = self._rng.random()
+        return latency, error, (fenced, truncated), pick
+
+    def _usage(self, contents, reply):
+        """
+        Token counts the way Gemini bills them: system instruction + every text part + images
+        """
+        if isinstance(contents, str):
+            contents = [contents]
+        elif contents and isinstance(contents[0], dict) and 'role' in contents[0]:
+            contents = [part for turn in contents for part in turn['parts']]
+        text = (self.system_instruction or '') + ''.join(part for part in contents if isinstance(part, str))
+        images = sum(1 for part in contents if not isinstance(part, str))
+        return FakeUsage(len(text) // 4 + 1 + IMAGE_TOKENS * images, len(reply) // 4 + 1)
+
+    def _reply(self, contents, shape, pick, generation_config=None):
+        if isinstance(contents, str):
+            prompt, images = contents, 0
+        elif contents and isinstance(contents[0], dict) and 'role' in contents[0]:
+            # Multi-turn chat: answer the latest user turn
+            prompt, images = contents[-1]['parts'][-1], 0
+        else:
+            prompt = next((part for part in contents if isinstance(part, str)), '')
+            images = sum(1 for part in contents if not isinstance(part, str))
+
+        # The JSON structure is in the system instruction (or, for older prompts, in the request itself)
+        instructions = f"{self.system_instruction or ''}\n{prompt}"
+        if '"is_soil"' in instructions:
+            items = [self._soil(pick, i) for i in range(max(1, images))]
+        elif '"is_plant"' in instructions:
+            items = [self._disease(pick, i) for i in range(max(1, images))]
+        else:
+            name = prompt.split("'s Question:")[0].rsplit('\n', 1)[-1].strip() or 'Farmer'
+            return CHAT_REPLY.format(name=name)
+
+        text = json.dumps(items if images > 1 else items[0], indent=2)
+        fenced, truncated = shape
+        if truncated:
+            text = text[:int(len(text) * (0.6 + 0.3 * pick))]
+        # JSON mode (response_mime_type) replies are bare JSON, as with the real API
+        if not fenced or (generation_config or {}).get('response_mime_type') == 'application/json':
+            return text
+        return f"```json\n{text}" if truncated else f"```json\n{text}\n```"
+
+    def _disease(self, pick, index):
+        disease, severity, confidence = DISEASES[int(pick * 1000 + index) % len(DISEASES)]
+        return {
+            "is_plant": True,
+            "disease": disease,
+            "confidence": confidence,
+            "severity": severity,
+            "description": f"Simulated finding: {disease.lower()}.",
+            "treatment": "N/A" if disease == "Healthy" else "Apply a recommended fungicide and remove affected leaves",
+            "prevention": "Rotate crops and avoid overhead irrigation"
+        }
+
+    def _soil(self, pick, index):
+        soil_type, color, ph, crops = SOILS[int(pick * 1000 + index) % len(SOILS)]
+        return {
+            "is_soil": True,
+            "soil_type": soil_type,
+            "color": color,
+            "texture": "Medium",
+            "moisture": "Moderate",
+            "ph_estimate": ph,
+            "nitrogen": "Medium",
+            "phosphorus": "Low",
+            "potassium": "Medium",
+            "organic_matter": "Medium",
+            "recommendations": "Add compost and a balanced NPK fertilizer before sowing",
+            "suitable_crops": crops,
+            "improvements": "Mulch to retain moisture"
+        }
+
+    def generate_content(self, contents, stream=False, generation_config=None, **kwargs):
+        latency, error, shape, pick = self._draw()
+        if stream:
+            # Latency becomes time-to-first-chunk
+            time.sleep(latency)
+            if error is not None:
+                raise error(f"fake {error.__name__}")
+            return FakeStream(self._reply(contents, shape, pick, generation_config), FAKE_STREAM_INTERVAL, FAKE_STREAM_CHUNK)
+        time.sleep(latency)
+        if error is not None:
+            raise error(f"fake {error.__name__}")
+        text = self._reply(contents, shape, pick, generation_config)
+        return FakeResponse(text, self._usage(contents, text))
+
+    async def generate_content_async(self, contents, stream=False, generation_config=None, **kwargs):
+        latency, error, shape, pick = self._draw()
+        await asyncio.sleep(latency)
+        if error is not None:
+            raise error(f"fake {error.__name__}")
+        text = self._reply(contents, shape, pick, generation_config)
+        if stream:
+            return FakeStream(text, FAKE_STREAM_INTERVAL, FAKE_STREAM_CHUNK)
+        return FakeResponse(text, self._usage(contents, text))
+
+
+class FakeGenAI:
+    """
+    The subset of the google.generativeai module the service uses
+    """
+
+    GenerativeModel = FakeGenerativeModel
+
+    def configure(self, **kwargs):
+        logger.info("🧪 Using the local fake Gemini backend (GEMINI_BACKEND=fake)")
@@ -0,0 +1,261 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from concurrency_limiter import Overloaded
+from image_preprocessing import prepare_image, prepare_image_compact
+from metrics import REGISTRY, stage
+from prescreen import prepare_measured, prescreener
+from shared_state import per_worker
+from uploads import UPLOAD_REJECTIONS, UploadRejected
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Image executor settings
+# "process" decodes/resizes/encodes uploads on a process pool, "inline" on the event loop (old behaviour)
+IMAGE_EXECUTOR = os.getenv('IMAGE_EXECUTOR', 'process')
+# Per app worker (BATCH_PREPROCESS_WORKERS is the older name); by default the cores are split between app workers
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', os.getenv('BATCH_PREPROCESS_WORKERS',
+                                                         str(per_worker(os.cpu_count() or 2)))))
+# Images waiting for a pool slot before new uploads get 503
+IMAGE_QUEUE_MAX = int(os.getenv('IMAGE_QUEUE_MAX', '64'))
+# Uploads above this are "large": they may only hold IMAGE_LARGE_SLOTS workers at once,
+# and small ones waiting at the same time go first (unless a large one has waited IMAGE_LARGE_MAX_WAIT)
+IMAGE_LARGE_BYTES = int(float(os.getenv('IMAGE_LARGE_MB', '2')) * 1024 * 1024)
+IMAGE_LARGE_SLOTS = int(os.getenv('IMAGE_LARGE_SLOTS', str(max(1, IMAGE_WORKERS - 1))))
+IMAGE_LARGE_MAX_WAIT = float(os.getenv('IMAGE_LARGE_MAX_WAIT', '2'))
+# "size" = the lanes above, "fifo" = plain arrival order (for comparison)
+IMAGE_SCHEDULING = os.getenv('IMAGE_SCHEDULING', 'size')
+
+IMAGE_QUEUE_SECONDS = REGISTRY.histogram('image_queue_wait_seconds', 'Time uploads waited for an image worker',
+                                         ('lane',))
+IMAGE_PROCESS_SECONDS = REGISTRY.histogram('image_processing_seconds', 'Decode/resize/encode time on the image pool',
+                                           ('lane',))
+
+LANES = ('small', 'large')
+# Imported once by the forkserver and inherited by every worker it forks. '__main__' must stay: workers
+# import the main script anyway (multiprocessing re-runs it as __mp_main__), and without it each worker would
+# run it again instead of inheriting it. So under "python main.py" the forkserver holds one copy of the app's
+# module-level state (nothing is started there: models, pools and tasks start in the lifespan, and the
+# SQLite handles opened at import are never used in it); "uvicorn main:app" and gunicorn keep it out entirely
+WORKER_PRELOAD = ['__main__', 'image_executor', 'image_preprocessing', 'prescreen']
+
+
+def _warm():
+    # Imports and first-use setup (PIL plugins, JPEG encoder) happen here instead of on the first upload
+    from PIL import Image
+    import io
+    Image.new('RGB', (64, 64)).save(io.BytesIO(), 'JPEG')
+    return os.getpid()
+
+
+def _size_of(contents):
+    if not hasattr(contents, 'read'):
+        return len(contents)
+    # Spooled uploads: seek, don't read (open_upload left it rewound)
+    position = contents.tell()
+    size = contents.seek(0, os.SEEK_END)
+    contents.seek(position)
+    return size - position
+
+
+class ImageExecutor:
+    """
+    Process pool for CPU-bound image work: upload bytes in, compact encoded
+    image out, so decoding never holds the event loop's GIL.
+
+    Dispatch is done here rather than by the pool's own queue, which keeps
+    the number of waiting images bounded (Overloaded beyond max_queue),
+    stops a few huge uploads from occupying every worker, and measures
+    queue wait separately from processing time.
+    """
+
+    def __init__(self, mode=IMAGE_EXECUTOR, workers=IMAGE_WORKERS, max_queue=IMAGE_QUEUE_MAX,
+                 large_bytes=IMAGE_LARGE_BYTES, large_slots=IMAGE_LARGE_SLOTS, scheduling=IMAGE_SCHEDULING):
+        self.mode = mode
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.large_bytes = large_bytes
+        self.large_slots = max(1, min(large_slots, self.workers))
+        self.scheduling = scheduling
+        self._pool = None
+        self._warm_task = None
+        self._waiting = {lane: deque() for lane in LANES}
+        self._running = {lane: 0 for lane in LANES}
+        self.completed = {lane: 0 for lane in LANES}
+        self.rejected = 0
+        self.failed = 0
+        self.warm_workers = 0
+        self._wait_total = 0.0
+        self._process_total = 0.0
+
+    def get_pool(self):
+        """
+        The process pool, created on first use
+        """
+        if self._pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            if context.get_start_method() == 'forkserver':
+                context.set_forkserver_preload(WORKER_PRELOAD)
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            logger.info(f"🏭 Started image pool ({self.workers} workers)")
+        return self._pool
+
+    async def _warm_up(self):
+        loop = asyncio.get_running_loop()
+        pool = self.get_pool()
+        # One task per worker at once, so the pool starts all of them now
+        pids = await asyncio.gather(*(loop.run_in_executor(pool, _warm) for _ in range(self.workers)),
+                                    return_exceptions=True)
+        self.warm_workers = len({pid for pid in pids if isinstance(pid, int)})
+        logger.info(f"🔥 Image pool warm ({self.warm_workers} workers)")
+
+    def start(self):
+        """
+        Start the pool's workers in the background (no-op in inline mode)
+        """
+        if self.mode == 'process' and self._warm_task is None:
+            self._warm_task = asyncio.get_running_loop().create_task(self._warm_up())
+
+    def shutdown(self):
+        if self._warm_task is not None:
+            self._warm_task.cancel()
+            self._warm_task = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    @property
+    def queued(self):
+        return sum(len(waiting) for waiting in self._waiting.values())
+
+    def _lane(self, size):
+        return 'large' if size > self.large_bytes else 'small'
+
+    def _next(self):
+        small, large = self._waiting['small'], self._waiting['large']
+        large_ok = large and self._running['large'] < self.large_slots
+        if large_ok and (not small or time.monotonic() - large[0][0] > IMAGE_LARGE_MAX_WAIT):
+            return 'large'
+        return 'small' if small else None
+
+    def _dispatch(self):
+        while sum(self._running.values()) < self.workers:
+            lane = self._next()
+            if lane is None:
+                return
+            _, waiter = self._waiting[lane].popleft()
+            if waiter.done():
+                continue
+            self._running[lane] += 1
+            waiter.set_result(None)
+
+    async def _slot(self, lane):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiting[lane].append((time.monotonic(), waiter))
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # Granted just as we were cancelled: hand the slot on
+            if waiter.done() and not waiter.cancelled():
+                self._release(lane)
+            raise
+
+    def _release(self, lane):
+        self._running[lane] -= 1
+        self._dispatch()
+
+    async def prepare(self, contents, admit=True):
+        """
+        PreparedImage from upload bytes (or a file object); admit=False skips the
+        queue limit for callers that bound their own concurrency (batches)
+        """
+        if self.mode != 'process':
+            return prepare_image(contents)
+        if prescreener.enabled:
+            return await self.run(prepare_measured, contents, prescreener.thresholds['size'], admit=admit)
+        return await self.run(prepare_image_compact, contents, admit=admit)
+
+    async def run(self, fn, contents, *args, admit=True):
+        """
+        fn(upload bytes, *args) on the pool, queued and scheduled like prepare();
+        inline mode calls it right here with the bytes or file object
+        """
+        if self.mode != 'process':
+            return fn(contents, *args)
+
+        if admit and self.queued >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded(f"{self.queued} images waiting for the image pool", retry_after=1)
+
+        # FIFO scheduling puts everything in one lane
+        lane = self._lane(_size_of(contents)) if self.scheduling == 'size' else 'small'
+        loop = asyncio.get_running_loop()
+        queued_at = time.perf_counter()
+        with stage('image_queue'):
+            await self._slot(lane)
+        waited = time.perf_counter() - queued_at
+        IMAGE_QUEUE_SECONDS.observe(waited, lane=lane)
+        self._wait_total += waited
+
+        started = time.perf_counter()
+        pool = None
+        try:
+            if hasattr(contents, 'read'):
+                # Only once a worker is free, so queued uploads stay spooled rather than copied into memory,
+                # and off the loop, since a large spooled upload is read from disk
+                with stage('image_read'):
+                    contents = await asyncio.to_thread(contents.read)
+            pool = self.get_pool()
+            with stage('image_process'):
+                return await loop.run_in_executor(pool, fn, contents, *args)
+        except UploadRejected as e:
+            # Raised in the worker process, where the counter isn't the one /metrics reads
+            UPLOAD_REJECTIONS.inc(reason=e.reason)
+            raise
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM-killed): start a fresh pool for the next upload
+            logger.error("❌ Image pool broken, restarting it")
+            self.failed += 1
+            # Concurrent uploads see the same broken pool; only the first replaces it
+            if self._pool is pool:
+                self._pool = None
+                pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            IMAGE_PROCESS_SECONDS.observe(elapsed, lane=lane)
+            self._process_total += elapsed
+            self.completed[lane] += 1
+            self._release(lane)
+
+    def stats(self):
+        completed = sum(self.completed.values())
+        return {
+            "mode": self.mode,
+            "scheduling": self.scheduling,
+            "workers": self.workers,
+            "warm_workers": self.warm_workers,
+            "running": dict(self._running),
+            "queued": {lane: len(waiting) for lane, waiting in self._waiting.items()},
+            "max_queue": self.max_queue,
+            "large_slots": self.large_slots,
+            "completed": dict(self.completed),
+            "rejected_queue_full": self.rejected,
+            "failed": self.failed,
+            "avg_queue_wait_ms": round(self._wait_total / completed * 1000, 1) if completed else 0.0,
+            "avg_processing_ms": round(self._process_total / completed * 1000, 1) if completed else 0.0
+        }
+
+
+image_executor = ImageExecutor()
@@ -0,0 +1,171 @@
+import io
+import logging
+import os
+
+from PIL import Image, ImageOps
+
+from metrics import stage
+from perceptual_index import PHASH_ALGORITHM, image_hash
+from uploads import ALLOWED_FORMATS, UPLOAD_MAX_PIXELS, ImageTooLarge, check_dimensions, reject
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Preprocessing settings
+MAX_IMAGE_SIZE = int(os.getenv('MAX_IMAGE_SIZE', '1024'))
+# JPEG or WEBP; sent to Gemini as an inline blob so the SDK doesn't re-encode (it defaults to lossless WebP)
+IMAGE_ENCODE_FORMAT = os.getenv('IMAGE_ENCODE_FORMAT', 'JPEG').upper()
+IMAGE_ENCODE_QUALITY = int(os.getenv('IMAGE_ENCODE_QUALITY', '85'))
+
+MIME_TYPES = {
+    'JPEG': 'image/jpeg',
+    'WEBP': 'image/webp',
+}
+
+# PIL's own bomb guard (error at 2x) as a backstop for paths that skip open_image
+Image.MAX_IMAGE_PIXELS = UPLOAD_MAX_PIXELS
+
+
+class PreparedImage:
+    """
+    Downscaled, orientation-corrected image plus its encoded bytes, ready to send to Gemini
+    """
+
+    __slots__ = ('data', 'mime_type', '_image', 'original_size', 'size', 'hashes', 'measurements')
+
+    def __init__(self, data, mime_type, image, original_size, size=None, hashes=None, measurements=None):
+        self.data = data
+        self.mime_type = mime_type
+        self._image = image
+        self.original_size = original_size
+        self.size = size or image.size
+        self.hashes = hashes or {}
+        # Pre-screen metrics by thumbnail size, when taken on the image pool
+        self.measurements = measurements or {}
+
+    @property
+    def image(self):
+        # Compact copies (e.g. returned from a worker process) decode the small encoded bytes on demand
+        if self._image is None:
+            self._image = Image.open(io.BytesIO(self.data))
+            self._image.load()
+        return self._image
+
+    def thumbnail(self, size):
+        """
+        Small RGB copy for cheap local models; decodes straight from the JPEG bytes at reduced scale if needed
+        """
+        if self._image is not None:
+            return draft_thumbnail(self._image.copy(), size)
+        return draft_thumbnail(Image.open(io.BytesIO(self.data)), size)
+
+    def perceptual_hash(self, algorithm=PHASH_ALGORITHM):
+        if algorithm not in self.hashes:
+            self.hashes[algorithm] = image_hash(self.image, algorithm)
+        return self.hashes[algorithm]
+
+    def compact(self):
+        """
+        Copy without the decoded pixels, cheap to pickle across processes
+        """
+        return PreparedImage(self.data, self.mime_type, None, self.original_size, self.size, dict(self.hashes),
+                             dict(self.measurements))
+
+    def as_blob(self):
+        """
+        Inline blob accepted by generate_content in place of a PIL image
+        """
+        return {"mime_type": self.mime_type, "data": self.data}
+
+
+def draft_thumbnail(img, size):
+    """
+    RGB copy no larger than size x size; JPEGs are decoded at the smallest DCT scale that still covers it
+    """
+    if img.format == 'JPEG':
+        # Ask for the thumbnail's own shape: a square request would force a scale that also fits the short side
+        scale = size / max(img.size)
+        img.draft('RGB', (max(1, int(img.width * scale)), max(1, int(img.height * scale))))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    img.thumbnail((size, size), Image.Resampling.BILINEAR)
+    return img
+
+
+def _downscale(img, max_size):
+    # JPEG: let the decoder scale in the DCT domain (1/2, 1/4, 1/8) before any pixels are materialized
+    if img.format == 'JPEG':
+        img.draft('RGB', (max_size, max_size))
+
+    img = ImageOps.exif_transpose(img)
+
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    if img.width > max_size or img.height > max_size:
+        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+
+    return img
+
+
+def _encode(img, fmt, quality):
+    buffer = io.BytesIO()
+    img.save(buffer, fmt, quality=quality)
+    return buffer.getvalue()
+
+
+def open_image(source):
+    """
+    Open uploaded bytes or a file object (e.g. the spooled upload) lazily: only the
+    header is parsed, and images outside the allowed formats or size are refused
+    before any pixels are decoded
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    try:
+        img = Image.open(source, formats=ALLOWED_FORMATS)
+    except Image.DecompressionBombError as e:
+        reject(ImageTooLarge(str(e)))
+    check_dimensions(*img.size)
+    return img
+
+
+def prepare_image(contents, max_size=MAX_IMAGE_SIZE, fmt=IMAGE_ENCODE_FORMAT, quality=IMAGE_ENCODE_QUALITY):
+    """
+    Decode uploaded bytes (or a file object), downscale to max_size and re-encode once
+    """
+    with stage('decode_resize'):
+        img = open_image(contents)
+        original_size = img.size
+        img = _downscale(img, max_size)
+    with stage('encode'):
+        data = _encode(img, fmt, quality)
+    return PreparedImage(data, MIME_TYPES[fmt], img, original_size)
+
+
+def prepare_pil_image(img, max_size=MAX_IMAGE_SIZE, fmt=IMAGE_ENCODE_FORMAT, quality=IMAGE_ENCODE_QUALITY):
+    """
+    Same as prepare_image for callers that already hold a PIL image
+    """
+    original_size = img.size
+    img = _downscale(img, max_size)
+    return PreparedImage(_encode(img, fmt, quality), MIME_TYPES[fmt], img, original_size)
+
+
+def prepare_image_compact(contents, max_size=MAX_IMAGE_SIZE, fmt=IMAGE_ENCODE_FORMAT, quality=IMAGE_ENCODE_QUALITY):
+    """
+    Worker-process entry point: bytes in, encoded bytes + perceptual hash out (no pixel buffer)
+    """
+    prepared = prepare_image(contents, max_size, fmt, quality)
+    prepared.perceptual_hash()
+    return prepared.compact()
+
+
+def ensure_prepared(image):
+    """
+    Accept a PreparedImage, raw upload bytes or a PIL image
+    """
+    if isinstance(image, PreparedImage):
+        return image
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return prepare_image(image)
+    return prepare_pil_image(image)
@@ -0,0 +1,287 @@
+import asyncio
+import functools
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from concurrency_limiter import AdaptiveLimiter
+from metrics import GEMINI_IN_FLIGHT, GEMINI_SECONDS, stage
+from shared_state import per_worker
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Concurrency settings (overridable per model, e.g. GEMINI_MAX_CONCURRENCY_GEMINI_2_5_FLASH=4);
+# the starting point for each model's adaptive limit (see concurrency_limiter), for the whole
+# deployment: with several workers each one starts from its share
+DEFAULT_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', '8'))
+EXECUTOR_WORKERS = int(os.getenv('GEMINI_EXECUTOR_WORKERS', '32'))
+# Max streamed chunks buffered between the SDK and a slow client before upstream reads pause
+STREAM_BUFFER_CHUNKS = int(os.getenv('GEMINI_STREAM_BUFFER_CHUNKS', '8'))
+
+# "executor" runs the blocking SDK call on a bounded thread pool,
+# "native" uses the SDK's own generate_content_async
+INFERENCE_MODE = os.getenv('GEMINI_INFERENCE_MODE', 'executor')
+
+
+def model_name_of(model):
+    """
+    Short model name used for limits and logging ("models/gemini-2.5-flash" -> "gemini-2.5-flash")
+    """
+    name = getattr(model, 'model_name', None) or type(model).__name__
+    return name.split('/')[-1]
+
+
+def run_sync(coro):
+    """
+    Run an inference coroutine from synchronous code (scripts, shells).
+    Must not be called from inside a running event loop.
+    """
+    return asyncio.run(coro)
+
+
+def _chunk_text(chunk):
+    # Chunks without text parts (e.g. the final one carrying finish_reason) raise on .text
+    try:
+        return chunk.text
+    except (ValueError, AttributeError):
+        return ''
+
+
+class InferenceGateway:
+    """
+    Shared async entry point for every Gemini call.
+
+    Keeps the event loop free while a request waits on the model and admits
+    calls through an adaptive limiter per model and service (chat and vision
+    calls to the same model have very different latencies), which queues by
+    priority and raises Overloaded when a request can't be served before its deadline.
+    """
+
+    def __init__(self, mode=INFERENCE_MODE, default_limit=DEFAULT_MAX_CONCURRENCY,
+                 executor_workers=EXECUTOR_WORKERS):
+        self.mode = mode
+        self.default_limit = default_limit
+        self.executor_workers = executor_workers
+        self._limits = {}
+        self._limiters = {}
+        self._in_flight = {}
+        self._completed = {}
+        self._executor = None
+
+    def limit_for(self, model_name):
+        """
+        Configured starting limit for a model, per service (the live limits are in limiter(model_name, service))
+        """
+        if model_name not in self._limits:
+            env_name = 'GEMINI_MAX_CONCURRENCY_' + re.sub(r'[^A-Z0-9]', '_', model_name.upper())
+            self._limits[model_name] = per_worker(os.getenv(env_name, self.default_limit))
+        return self._limits[model_name]
+
+    def set_limit(self, model_name, limit):
+        """
+        Override the concurrency limit for a model (takes effect for new calls)
+        """
+        self._limits[model_name] = max(1, int(limit))
+        for (name, _), limiter in self._limiters.items():
+            if name == model_name:
+                limiter.set_limit(limit)
+
+    def limiter(self, model_name, service=None):
+        key = (model_name, service)
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            limiter = AdaptiveLimiter(f"{model_name}/{service}" if service else model_name,
+                                      self.limit_for(model_name))
+            self._limiters[key] = limiter
+        return limiter
+
+    def check_admission(self, model, service=None):
+        """
+        Raise Overloaded early (before reading uploads) if a call at the current priority would be rejected
+        """
+        if model is not None:
+            self.limiter(model_name_of(model), service).check()
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.executor_workers,
+                thread_name_prefix='gemini'
+            )
+        return self._executor
+
+    async def generate(self, model, contents, service=None, timeout=None, **kwargs):
+        """
+        Awaitable equivalent of model.generate_content(contents, **kwargs), admitted by service's limiter.
+        timeout (seconds, queueing included) raises asyncio.TimeoutError and counts as congestion.
+        """
+        model_name = model_name_of(model)
+        limiter = self.limiter(model_name, service)
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+
+        with stage('gemini_queue'):
+            await asyncio.wait_for(limiter.acquire(), timeout)
+        self._started(model_name)
+        start = time.perf_counter()
+        outcome = 'error'
+        error = None
+        call = None
+        try:
+            remaining = None if deadline is None else max(0.0, deadline - loop.time())
+            with stage('gemini'):
+                if self.mode == 'native' and hasattr(model, 'generate_content_async'):
+                    response = await asyncio.wait_for(model.generate_content_async(contents, **kwargs), remaining)
+                else:
+                    call = loop.run_in_executor(self._get_executor(),
+                                                functools.partial(model.generate_content, contents, **kwargs))
+                    # Shielded: a timeout or cancellation can't stop the SDK thread, so its slot isn't freed early
+                    response = await asyncio.wait_for(asyncio.shield(call), remaining)
+            outcome = 'ok'
+            return response
+        except asyncio.TimeoutError as e:
+            # Gemini didn't answer within the caller's deadline: back off as for a 429
+            outcome = 'timeout'
+            error = e
+            raise
+        except asyncio.CancelledError:
+            # Hedge loser or client gone: says nothing about Gemini's health
+            outcome = 'cancelled'
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            latency = elapsed if outcome == 'ok' else None
+            if call is not None and not call.done():
+                call.add_done_callback(lambda future: self._call_done(future, limiter, model_name, outcome, error, start))
+            else:
+                limiter.release(latency, error)
+                self._finished(model_name, outcome, elapsed)
+
+    def _call_done(self, future, limiter, model_name, outcome, error, start):
+        # An abandoned executor call still held its slot; free it now that the thread is done
+        if not future.cancelled():
+            future.exception()
+        limiter.release(None, error)
+        self._finished(model_name, outcome, time.perf_counter() - start)
+
+    async def stream(self, model, contents, service=None, **kwargs):
+        """
+        Async iterator over text chunks of model.generate_content(contents, stream=True).
+
+        At most STREAM_BUFFER_CHUNKS chunks are buffered: a slow consumer pauses the
+        upstream read, and closing the iterator (e.g. client disconnect) stops it.
+        """
+        model_name = model_name_of(model)
+        limiter = self.limiter(model_name, service)
+
+        with stage('gemini_queue'):
+            await limiter.acquire()
+        self._started(model_name)
+        start = time.perf_counter()
+        outcome = 'error'
+        error = None
+        try:
+            if self.mode == 'native' and hasattr(model, 'generate_content_async'):
+                response = await model.generate_content_async(contents, stream=True, **kwargs)
+                async for chunk in response:
+                    text = _chunk_text(chunk)
+                    if text:
+                        yield text
+            else:
+                async for text in self._stream_in_executor(model, contents, kwargs):
+                    yield text
+            outcome = 'ok'
+        except (asyncio.CancelledError, GeneratorExit):
+            outcome = 'cancelled'
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # Stream duration depends on reply length, so only errors feed the limiter
+            limiter.release(None, error)
+            self._finished(model_name, outcome, time.perf_counter() - start)
+
+    def _started(self, model_name):
+        self._in_flight[model_name] = self._in_flight.get(model_name, 0) + 1
+        GEMINI_IN_FLIGHT.inc(model=model_name)
+
+    def _finished(self, model_name, outcome, seconds):
+        self._in_flight[model_name] -= 1
+        self._completed[model_name] = self._completed.get(model_name, 0) + 1
+        GEMINI_IN_FLIGHT.dec(model=model_name)
+        GEMINI_SECONDS.observe(seconds, model=model_name, outcome=outcome)
+
+    async def _stream_in_executor(self, model, contents, kwargs):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        slots = threading.Semaphore(STREAM_BUFFER_CHUNKS)
+        cancelled = threading.Event()
+
+        def emit(item):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                cancelled.set()  # event loop already closed
+
+        def produce():
+            try:
+                response = model.generate_content(contents, stream=True, **kwargs)
+                for chunk in response:
+                    # Backpressure: wait for the consumer to free a buffer slot
+                    while not slots.acquire(timeout=0.5):
+                        if cancelled.is_set():
+                            return
+                    if cancelled.is_set():
+                        return
+                    text = _chunk_text(chunk)
+                    if text:
+                        emit(('chunk', text))
+                    else:
+                        slots.release()
+                emit(('done', None))
+            except Exception as e:
+                emit(('error', e))
+
+        future = loop.run_in_executor(self._get_executor(), produce)
+        try:
+            while True:
+                kind, value = await queue.get()
+                if kind == 'done':
+                    break
+                if kind == 'error':
+                    raise value
+                slots.release()
+                yield value
+        finally:
+            cancelled.set()
+            if not future.done():
+                logger.info("🛑 Stream closed early, cancelling upstream read")
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "models": {
+                name: {
+                    "configured_limit": self.limit_for(name),
+                    "completed": self._completed.get(name, 0),
+                    "limiters": {service or "default": limiter.stats()
+                                 for (model_name, service), limiter in self._limiters.items() if model_name == name}
+                }
+                for name in set(self._in_flight) | set(self._completed)
+            }
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+gateway = InferenceGateway()
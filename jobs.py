@@ -0,0 +1,441 @@
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import urllib.parse
+import uuid
+
+import requests
+
+from concurrency_limiter import Overloaded, set_priority
+from metrics import REGISTRY
+from rate_limits import accounted_to
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Job queue settings
+# SQLite file holding queued work and finished results (empty = memory only, lost on restart)
+JOBS_DB = os.getenv('JOBS_DB', 'data/jobs.sqlite3')
+# Matches the default per-model Gemini concurrency (GEMINI_MAX_CONCURRENCY)
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '8'))
+# Finished jobs (and their results) are kept this long for polling, then purged
+JOB_RETENTION = float(os.getenv('JOB_RETENTION', '86400'))
+# Queued + running jobs beyond this are refused with 503
+JOB_MAX_PENDING = int(os.getenv('JOB_MAX_PENDING', '500'))
+# A job interrupted this many times (restarts while running) is marked failed instead of retried
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+JOB_WEBHOOK_TIMEOUT = float(os.getenv('JOB_WEBHOOK_TIMEOUT', '10'))
+JOB_WEBHOOK_RETRIES = int(os.getenv('JOB_WEBHOOK_RETRIES', '3'))
+# When set, webhooks carry X-Signature: sha256=<HMAC of the body>
+JOB_WEBHOOK_SECRET = os.getenv('JOB_WEBHOOK_SECRET', '')
+# Comma-separated hosts webhooks may be sent to (".example.com" also allows its subdomains); empty = any public host
+JOB_WEBHOOK_HOSTS = [host.strip().lower() for host in os.getenv('JOB_WEBHOOK_HOSTS', '').split(',') if host.strip()]
+# Loopback, private, link-local and reserved addresses are refused unless this is on (local development only)
+JOB_WEBHOOK_ALLOW_PRIVATE = os.getenv('JOB_WEBHOOK_ALLOW_PRIVATE', 'off') == 'on'
+
+JOB_STATES = ('queued', 'running', 'completed', 'failed')
+FINISHED_STATES = ('completed', 'failed')
+
+JOB_SECONDS = REGISTRY.histogram('job_duration_seconds', 'Analysis time by job kind and mode (sync or async)',
+                                 ('kind', 'mode'))
+JOB_WAIT_SECONDS = REGISTRY.histogram('job_queue_wait_seconds', 'Time async jobs spent queued', ('kind',))
+JOB_OUTCOMES = REGISTRY.counter('job_outcomes', 'Finished async jobs by kind and status', ('kind', 'status'))
+WEBHOOKS = REGISTRY.counter('job_webhooks', 'Webhook deliveries by outcome', ('outcome',))
+
+
+class QueueFull(Exception):
+    """
+    Raised by submit() when JOB_MAX_PENDING jobs are already waiting
+    """
+
+
+class WebhookRejected(Exception):
+    """
+    Raised by check_webhook() for a URL the server must not POST to
+    """
+
+
+def _process_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobStore:
+    """
+    SQLite table of jobs: the upload while queued, the result once finished
+    """
+
+    def __init__(self, path):
+        if path != ':memory:':
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL, payload BLOB, webhook TEXT, "
+            "result TEXT, error TEXT, attempts INTEGER NOT NULL DEFAULT 0, "
+            "created_at REAL NOT NULL, started_at REAL, finished_at REAL, expires_at REAL, owner INTEGER, client TEXT)"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+        if 'owner' not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN owner INTEGER")
+        if 'client' not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN client TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        self._conn.commit()
+
+    def create(self, kind, payload, webhook=None, client=None):
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, kind, status, payload, webhook, created_at, client) "
+                "VALUES (?, ?, 'queued', ?, ?, ?, ?)",
+                (job_id, kind, payload, webhook, time.time(), client)
+            )
+            self._conn.commit()
+        return job_id
+
+    def claim(self, job_id):
+        """
+        Mark a queued job running; returns (kind, payload, attempts, created_at, client) or None if it isn't queued.
+        The conditional UPDATE makes this atomic across worker processes sharing the file.
+        """
+        with self._lock:
+            claimed = self._conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1, owner = ? "
+                "WHERE id = ? AND status = 'queued'",
+                (time.time(), os.getpid(), job_id)
+            ).rowcount
+            row = self._conn.execute(
+                "SELECT kind, payload, attempts, created_at, client FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone() if claimed else None
+            self._conn.commit()
+        return row
+
+    def requeue(self, job_id):
+        """
+        Put a claimed job back deliberately (deferred, not interrupted): its claim doesn't count as an attempt
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL, owner = NULL, attempts = attempts - 1 "
+                "WHERE id = ? AND status = 'running'", (job_id,)
+            )
+            self._conn.commit()
+
+    def finish(self, job_id, status, result=None, error=None, retention=JOB_RETENTION):
+        """
+        Store the outcome and drop the upload, which is no longer needed
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, payload = NULL, finished_at = ?, expires_at = ? "
+                "WHERE id = ?",
+                (status, json.dumps(result) if result is not None else None, error, now, now + retention, job_id)
+            )
+            self._conn.commit()
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, kind, status, result, error, attempts, created_at, started_at, finished_at, expires_at, "
+                "webhook FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "jobId": row[0],
+            "kind": row[1],
+            "status": row[2],
+            "result": json.loads(row[3]) if row[3] else None,
+            "error": row[4],
+            "attempts": row[5],
+            "created_at": row[6],
+            "started_at": row[7],
+            "finished_at": row[8],
+            "expires_at": row[9],
+            "webhook": row[10]
+        }
+
+    def unfinished(self):
+        """
+        IDs of queued jobs, oldest first, after putting back jobs left 'running' by a process
+        that no longer exists; used to resume after a restart (other workers' jobs are left alone)
+        """
+        with self._lock:
+            running = self._conn.execute("SELECT id, owner FROM jobs WHERE status = 'running'").fetchall()
+            # Our own PID can only be a previous run's (e.g. PID 1 in a restarted container)
+            orphans = [(job_id,) for job_id, owner in running if owner == os.getpid() or not _process_alive(owner)]
+            self._conn.executemany("UPDATE jobs SET status = 'queued', owner = NULL WHERE id = ?", orphans)
+            self._conn.commit()
+            rows = self._conn.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at").fetchall()
+        return [row[0] for row in rows]
+
+    def purge_expired(self):
+        with self._lock:
+            deleted = self._conn.execute(
+                "DELETE FROM jobs WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),)
+            ).rowcount
+            self._conn.commit()
+        return deleted
+
+    def counts(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = dict.fromkeys(JOB_STATES, 0)
+        counts.update(rows)
+        return counts
+
+
+def _sign(body):
+    return "sha256=" + hmac.new(JOB_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+
+
+def check_webhook(url, hosts=JOB_WEBHOOK_HOSTS, allow_private=JOB_WEBHOOK_ALLOW_PRIVATE):
+    """
+    Raise WebhookRejected unless url is http(s) on an allowed host that resolves only to public addresses
+    (resolves DNS, so call it off the event loop)
+    """
+    parsed = urllib.parse.urlsplit(url)
+    host = (parsed.hostname or '').lower().rstrip('.')
+    if parsed.scheme not in ('http', 'https') or not host:
+        raise WebhookRejected("webhook must be an http(s) URL")
+    if hosts and not any(host == allowed or (allowed.startswith('.') and host.endswith(allowed)) for allowed in hosts):
+        raise WebhookRejected(f"webhook host {host} is not allowed")
+    try:
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)}
+    except (OSError, UnicodeError, ValueError):
+        raise WebhookRejected(f"webhook host {host} doesn't resolve")
+    if allow_private:
+        return
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split('%')[0])
+        # Metadata services (169.254.169.254), loopback, RFC 1918, CGNAT, IPv4-mapped forms of them...
+        if not ip.is_global or ip.is_multicast:
+            raise WebhookRejected(f"webhook host {host} resolves to a non-public address")
+
+
+def deliver_webhook(url, job, retries=JOB_WEBHOOK_RETRIES, timeout=JOB_WEBHOOK_TIMEOUT):
+    """
+    POST the finished job to the client's URL, retrying with backoff on errors and 5xx replies.
+    The URL is checked again before every attempt, since DNS can change after the job was submitted.
+    """
+    body = json.dumps(job).encode()
+    headers = {"Content-Type": "application/json", "X-Job-Id": job["jobId"]}
+    if JOB_WEBHOOK_SECRET:
+        headers["X-Signature"] = _sign(body)
+
+    for attempt in range(retries + 1):
+        try:
+            check_webhook(url)
+        except WebhookRejected as e:
+            logger.warning(f"⚠️ Webhook for job {job['jobId']} refused: {e}")
+            WEBHOOKS.inc(outcome='refused')
+            return False
+        try:
+            # No redirects: a public URL answering 307 -> http://169.254.169.254/ mustn't get the POST
+            response = requests.post(url, data=body, headers=headers, timeout=timeout, allow_redirects=False)
+            if response.status_code < 500:
+                delivered = 200 <= response.status_code < 300
+                WEBHOOKS.inc(outcome='delivered' if delivered else 'rejected')
+                return delivered
+            error = f"HTTP {response.status_code}"
+        except requests.RequestException as e:
+            error = str(e)
+        if attempt < retries:
+            time.sleep(min(30.0, 2 ** attempt))
+    logger.warning(f"⚠️ Webhook for job {job['jobId']} failed after {retries + 1} attempts: {error}")
+    WEBHOOKS.inc(outcome='failed')
+    return False
+
+
+class JobQueue:
+    """
+    In-process worker pool over a persistent job table.
+
+    Handlers are registered per kind ("disease", "soil") and take the raw upload.
+    Async jobs are stored, picked up by JOB_WORKERS workers, and polled by ID or
+    pushed to a webhook; run() executes the same handler inline for the
+    synchronous endpoints.
+    """
+
+    def __init__(self, store, workers=JOB_WORKERS, max_pending=JOB_MAX_PENDING, retention=JOB_RETENTION):
+        self.store = store
+        self.workers = workers
+        self.max_pending = max_pending
+        self.retention = retention
+        self._handlers = {}
+        self._queue = None
+        self._tasks = []
+        self._webhooks = set()
+        self.submitted = 0
+        self.resumed = 0
+        self.deferred = 0
+        self.purged = 0
+        self.sync_runs = 0
+
+    def register(self, kind, handler):
+        self._handlers[kind] = handler
+
+    @property
+    def pending(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def run(self, kind, payload):
+        """
+        Synchronous mode: analyze now and return the result
+        """
+        self.sync_runs += 1
+        start = time.perf_counter()
+        try:
+            return await self._handlers[kind](payload)
+        finally:
+            JOB_SECONDS.observe(time.perf_counter() - start, kind=kind, mode='sync')
+
+    async def submit(self, kind, payload, webhook=None, client=None):
+        """
+        Store the upload as a queued job and return its ID right away; its Gemini usage is accounted to client
+        """
+        if kind not in self._handlers:
+            raise ValueError(f"unknown job kind {kind!r}")
+        if self.pending >= self.max_pending:
+            raise QueueFull(f"{self.pending} jobs already queued (limit {self.max_pending})")
+        job_id = await asyncio.to_thread(self.store.create, kind, payload, webhook, client)
+        self.submitted += 1
+        if self._queue is not None:
+            self._queue.put_nowait(job_id)
+        return job_id
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    async def _process(self, job_id):
+        claimed = await asyncio.to_thread(self.store.claim, job_id)
+        if claimed is None:
+            return
+        kind, payload, attempts, created_at, client = claimed
+        if attempts > JOB_MAX_ATTEMPTS:
+            await self._finish(job_id, kind, 'failed', error=f"interrupted {attempts - 1} times")
+            return
+        JOB_WAIT_SECONDS.observe(max(0.0, time.time() - created_at), kind=kind)
+
+        start = time.perf_counter()
+        try:
+            # Workers run outside any request: charge the calls to the client that submitted the job
+            with accounted_to(client):
+                result = await self._handlers[kind](payload)
+        except Overloaded as e:
+            # Gemini is saturated: put the job back instead of failing it (the upload is still stored)
+            self.deferred += 1
+            await asyncio.to_thread(self.store.requeue, job_id)
+            await asyncio.sleep(e.retry_after)
+            self._queue.put_nowait(job_id)
+            return
+        except Exception as e:
+            logger.error(f"❌ Job {job_id} ({kind}) failed: {e}")
+            await self._finish(job_id, kind, 'failed', error=str(e))
+            return
+        finally:
+            del payload
+        JOB_SECONDS.observe(time.perf_counter() - start, kind=kind, mode='async')
+        await self._finish(job_id, kind, 'completed', result=result)
+
+    async def _finish(self, job_id, kind, status, result=None, error=None):
+        await asyncio.to_thread(self.store.finish, job_id, status, result, error, self.retention)
+        JOB_OUTCOMES.inc(kind=kind, status=status)
+        logger.info(f"📬 Job {job_id} ({kind}) {status}")
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if job and job["webhook"]:
+            # Delivered in the background so retries don't hold up the worker
+            task = asyncio.get_running_loop().create_task(asyncio.to_thread(deliver_webhook, job["webhook"], job))
+            self._webhooks.add(task)
+            task.add_done_callback(self._webhooks.discard)
+
+    async def _worker(self):
+        # Queued jobs yield to interactive requests when Gemini is busy
+        set_priority("low")
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._process(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Job worker error on {job_id}: {e}")
+
+    async def _purge_loop(self):
+        interval = max(60.0, min(3600.0, self.retention / 4))
+        while True:
+            await asyncio.sleep(interval)
+            self.purged += await asyncio.to_thread(self.store.purge_expired)
+
+    def start(self):
+        """
+        Start the workers and resume jobs left queued or running by the previous process
+        """
+        if self._tasks:
+            return
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self.purged += self.store.purge_expired()
+        resumed = self.store.unfinished()
+        for job_id in resumed:
+            self._queue.put_nowait(job_id)
+        self.resumed += len(resumed)
+        if resumed:
+            logger.info(f"📬 Resuming {len(resumed)} unfinished jobs")
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(loop.create_task(self._purge_loop()))
+
+    def stop(self):
+        # Jobs cut off mid-analysis stay 'running' in the table and are resumed on the next start
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._queue = None
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "retention_seconds": self.retention,
+            "jobs": self.store.counts(),
+            "submitted": self.submitted,
+            "resumed": self.resumed,
+            "deferred_overloaded": self.deferred,
+            "purged": self.purged,
+            "sync_runs": self.sync_runs,
+            "webhooks_in_flight": len(self._webhooks)
+        }
+
+
+def queue_from_env():
+    try:
+        store = JobStore(JOBS_DB or ':memory:')
+    except Exception as e:
+        logger.warning(f"⚠️ Job store unavailable ({JOBS_DB}), keeping jobs in memory: {e}")
+        store = JobStore(':memory:')
+    return JobQueue(store)
+
+
+jobs = queue_from_env()
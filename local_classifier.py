@@ -0,0 +1,138 @@
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Local classifier settings
+# Directory with weights.npy, bias.npy, feature_mean.npy, feature_std.npy and labels.json
+# (e.g. models/saved/disease_tiny); unset = Gemini only
+LOCAL_CLASSIFIER_DIR = os.getenv('LOCAL_CLASSIFIER_DIR', '')
+# Predictions at or above this probability are answered locally, anything lower escalates to Gemini
+LOCAL_CLASSIFIER_THRESHOLD = float(os.getenv('LOCAL_CLASSIFIER_THRESHOLD', '0.9'))
+
+FEATURE_SIZE = 64
+HUE_BINS = 12
+
+
+def extract_features(images):
+    """
+    Color features for a batch of small RGB PIL images -> (N, 18) float32 array:
+    saturation-masked hue histogram, white/dark/gray fractions, and saturation/value statistics
+    """
+    hsv = np.stack([
+        np.asarray(img.convert('HSV').resize((FEATURE_SIZE, FEATURE_SIZE)), dtype=np.float32) / 255.0
+        for img in images
+    ])
+    h, s, v = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+    n = h.shape[0]
+    pixels = FEATURE_SIZE * FEATURE_SIZE
+
+    colored = (s > 0.2) & (v > 0.15)
+    bins = np.minimum((h * HUE_BINS).astype(np.int64), HUE_BINS - 1)
+    flat_bins = (bins + np.arange(n)[:, None, None] * HUE_BINS)[colored]
+    hue_hist = np.bincount(flat_bins, minlength=n * HUE_BINS).reshape(n, HUE_BINS) / pixels
+
+    white = ((s <= 0.2) & (v > 0.75)).mean(axis=(1, 2))
+    dark = (v <= 0.15).mean(axis=(1, 2))
+    gray = ((s <= 0.2) & (v > 0.15) & (v <= 0.75)).mean(axis=(1, 2))
+
+    return np.column_stack([
+        hue_hist, white, dark, gray,
+        s.mean(axis=(1, 2)), v.mean(axis=(1, 2)), v.std(axis=(1, 2))
+    ]).astype(np.float32)
+
+
+class LocalDiseaseClassifier:
+    """
+    Softmax classifier over color features, evaluated with NumPy on CPU.
+    Weights are memory-mapped so several workers share one copy of the pages.
+    """
+
+    def __init__(self, model_dir, threshold=LOCAL_CLASSIFIER_THRESHOLD):
+        self.model_dir = model_dir
+        self.threshold = threshold
+        self.weights = np.load(os.path.join(model_dir, 'weights.npy'), mmap_mode='r')
+        self.bias = np.load(os.path.join(model_dir, 'bias.npy'), mmap_mode='r')
+        self.feature_mean = np.load(os.path.join(model_dir, 'feature_mean.npy'), mmap_mode='r')
+        self.feature_std = np.load(os.path.join(model_dir, 'feature_std.npy'), mmap_mode='r')
+        with open(os.path.join(model_dir, 'labels.json')) as f:
+            self.labels = json.load(f)
+
+        if self.weights.shape[1] != len(self.labels):
+            raise Exception(f"{model_dir}: {self.weights.shape[1]} outputs but {len(self.labels)} labels")
+
+        self.answered = 0
+        self.escalated = 0
+        self.inference_seconds = 0.0
+        self.images = 0
+
+    def predict_proba(self, images):
+        """
+        Class probabilities for a batch of small RGB images -> (N, classes)
+        """
+        start = time.perf_counter()
+        features = (extract_features(images) - self.feature_mean) / self.feature_std
+        logits = features @ self.weights + self.bias
+        logits -= logits.max(axis=1, keepdims=True)
+        probs = np.exp(logits)
+        probs /= probs.sum(axis=1, keepdims=True)
+        self.inference_seconds += time.perf_counter() - start
+        self.images += len(images)
+        return probs
+
+    def classify_batch(self, images):
+        """
+        One result dict per image when confident, None where Gemini should decide
+        """
+        probs = self.predict_proba(images)
+        results = []
+        for row in probs:
+            best = int(row.argmax())
+            confidence = float(row[best])
+            if confidence < self.threshold:
+                self.escalated += 1
+                results.append(None)
+                continue
+
+            self.answered += 1
+            label = self.labels[best]
+            results.append({
+                "success": label.get('is_plant', True),
+                "disease": label['disease'],
+                "confidence": round(confidence, 4),
+                "severity": label.get('severity', 'Unknown'),
+                "description": label.get('description', 'Analysis completed'),
+                "treatment": label.get('treatment', 'Consult agricultural expert'),
+                "prevention": label.get('prevention', 'Monitor regularly')
+            })
+        return results
+
+    def stats(self):
+        decided = self.answered + self.escalated
+        return {
+            "model_dir": self.model_dir,
+            "threshold": self.threshold,
+            "answered_locally": self.answered,
+            "escalated": self.escalated,
+            "local_rate": round(self.answered / decided, 4) if decided else 0.0,
+            "avg_inference_ms_per_image": round(self.inference_seconds / self.images * 1000, 3) if self.images else 0.0
+        }
+
+
+def load_local_classifier(model_dir=LOCAL_CLASSIFIER_DIR):
+    """
+    Load the configured local model once; None if disabled or unusable
+    """
+    if not model_dir:
+        return None
+    try:
+        classifier = LocalDiseaseClassifier(model_dir)
+        logger.info(f"🧠 Local disease classifier loaded from {model_dir} ({len(classifier.labels)} classes)")
+        return classifier
+    except Exception as e:
+        logger.error(f"❌ Local classifier unavailable ({model_dir}): {e}")
+        return None
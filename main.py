@@ -1,10 +1,12 @@
-from fastapi import FastAPI, File, UploadFile
+from fastapi import FastAPI, File, Form, Header, HTTPException, UploadFile, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from PIL import Image
-import io
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from contextlib import asynccontextmanager
+from typing import List, Optional
+import asyncio
 import logging
-import gc
+import os
 
 # Configure logging FIRST
 logging.basicConfig(
@@ -14,12 +16,54 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-# Import AI models (they initialize on startup for wake-up feature)
+# Import AI services (Gemini clients are built lazily by the model registry)
 from disease_model import detector
 from soil_analyzer import soil_analyzer
 from chatbot import chatbot
+from call_policy import breaker_stats
+from concurrency_limiter import Overloaded, set_priority
+from batch_analysis import BatchError, plan_batch, run_batch
+from image_executor import image_executor
+from image_preprocessing import open_image
+from inference import gateway
+from jobs import QueueFull, WebhookRejected, check_webhook, jobs
+from memory_governor import governor
+from metrics import CONTENT_TYPE, REGISTRY, MetricsMiddleware, stage
+from model_registry import SERVICES, registry
+from prescreen import prescreener, screen_upload
+from prompts import PROMPTS
+from rate_limits import (RATE_LIMIT_COSTS, RATE_LIMITED_REPLY, InvalidApiKey, RateLimitMiddleware, RateLimited,
+                         check_admin_key, current_client, rate_limiter, usage)
+from response_encoding import CompactResponse, CompressionMiddleware, FastJSONResponse, dumps
+from shared_state import SHARED_STATE_DIR, WORKERS
+from uploads import UploadLimitMiddleware, UploadRejected, open_upload, read_upload
 
-app = FastAPI(title="AgriSmart ML Service")
+@asynccontextmanager
+async def lifespan(app):
+    # Warm up Gemini clients in the background so /health answers immediately on cold start
+    registry.start_warm_up(SERVICES)
+    image_executor.start()
+    governor.start()
+    PROMPTS.start()
+    jobs.start()
+    REGISTRY.start()
+    rate_limiter.start()
+    usage.start()
+    yield
+    usage.stop()
+    rate_limiter.stop()
+    REGISTRY.stop()
+    jobs.stop()
+    PROMPTS.stop()
+    governor.stop()
+    chatbot.semantic_cache.save()
+    gateway.shutdown()
+    image_executor.shutdown()
+
+app = FastAPI(title="AgriSmart ML Service", lifespan=lifespan, default_response_class=FastJSONResponse)
+
+# 429 per API key / client IP and per end user before any work is done (inside CORS so browsers see it)
+app.add_middleware(RateLimitMiddleware)
 
 # Enable CORS
 app.add_middleware(
@@ -30,9 +74,70 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Cut off oversized request bodies while they stream in
+app.add_middleware(UploadLimitMiddleware)
+
+# gzip/brotli for large enough JSON bodies; MessagePack/CBOR on request for the analysis results
+app.add_middleware(CompressionMiddleware)
+
+# Request IDs, per-route latency and stage timings (see /metrics)
+app.add_middleware(MetricsMiddleware)
+
 class ChatMessage(BaseModel):
     message: str
     userName: str = "Farmer"
+    # Optional client-chosen conversation ID; the server keeps the history for follow-up questions
+    sessionId: Optional[str] = Field(None, max_length=128)
+
+def disease_error(e):
+    return {
+        "success": False,
+        "disease": "Processing Error",
+        "confidence": 0.0,
+        "severity": "Error",
+        "description": str(e),
+        "treatment": "Please try again",
+        "prevention": "Ensure image is valid"
+    }
+
+CHAT_STREAM_ERROR = "I'm sorry, I'm having trouble responding right now. Please try again!"
+CHAT_BUSY = "Lots of farmers are asking questions right now. Please try again in a moment!"
+
+def overloaded_response(e, content):
+    """503 with Retry-After: the request was shed instead of queueing past its deadline"""
+    logger.warning(f"🚦 Shedding request: {e} (retry after {e.retry_after}s)")
+    governor.after_request()
+    return FastJSONResponse(
+        status_code=503,
+        content=dict(content, retry_after=e.retry_after),
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+def rejected_response(e, content):
+    """4xx for uploads refused before decoding (too large, not an image, decompression bomb)"""
+    return FastJSONResponse(status_code=e.status_code, content=dict(content, success=False, error=str(e)))
+
+def admit(service):
+    """Fast 503 before an upload is decoded when the model's wait queue can't take it"""
+    if registry.ready:
+        gateway.check_admission(service.model, service.policy.service)
+
+def soil_error(e):
+    return {
+        "success": False,
+        "soil_type": "Processing Error",
+        "color": "Unknown",
+        "texture": "Unknown",
+        "moisture": "Unknown",
+        "ph_estimate": 6.5,
+        "nitrogen": "Unknown",
+        "phosphorus": "Unknown",
+        "potassium": "Unknown",
+        "organic_matter": "Unknown",
+        "recommendations": "Error processing image",
+        "suitable_crops": [],
+        "improvements": "Please try again"
+    }
 
 @app.get("/")
 async def root():
@@ -45,7 +150,18 @@ async def root():
         "endpoints": {
             "disease_detection": "/api/disease-detection",
             "soil_analysis": "/api/soil-analysis",
-            "chat": "/api/chat"
+            "disease_detection_batch": "/api/disease-detection/batch",
+            "soil_analysis_batch": "/api/soil-analysis/batch",
+            "chat": "/api/chat",
+            "chat_stream": "/api/chat/stream",
+            "chat_session": "/api/chat/sessions/{session_id}",
+            "disease_detection_job": "/api/jobs/disease-detection",
+            "soil_analysis_job": "/api/jobs/soil-analysis",
+            "job_status": "/api/jobs/{job_id}",
+            "health": "/health",
+            "ready": "/ready",
+            "stats": "/stats",
+            "metrics": "/metrics"
         }
     }
 
@@ -54,120 +170,378 @@ async def health_check():
     """Health check endpoint for wake-up calls"""
     return {"status": "healthy", "message": "ML Service is running"}
 
-@app.post("/api/disease-detection")
+@app.get("/ready")
+async def readiness_check():
+    """Readiness: 200 once the Gemini models are initialized, 503 while warming up or misconfigured"""
+    status = registry.status()
+    return FastJSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+def service_stats():
+    return {
+        "worker": {"pid": str(os.getpid()), "workers": WORKERS},
+        "inference": gateway.stats(),
+        "circuit_breakers": breaker_stats(),
+        "memory": governor.stats(),
+        "image_executor": image_executor.stats(),
+        "result_cache": {
+            "disease": detector.cache.stats(),
+            "soil": soil_analyzer.cache.stats()
+        },
+        "near_duplicates": {
+            "disease": detector.near_duplicates.stats(),
+            "soil": soil_analyzer.near_duplicates.stats()
+        },
+        "coalescing": {
+            "disease": detector.in_flight.stats(),
+            "soil": soil_analyzer.in_flight.stats(),
+            "chat": chatbot.in_flight.stats()
+        },
+        "parsing": {
+            "disease": detector.parser.stats(),
+            "soil": soil_analyzer.parser.stats()
+        },
+        "prompts": PROMPTS.stats(),
+        "chat_cache": chatbot.semantic_cache.stats(),
+        "chat_sessions": chatbot.sessions.stats(),
+        "chat_streaming": chatbot.streaming_stats(),
+        "jobs": jobs.stats(),
+        "prescreen": prescreener.stats(),
+        "rate_limits": rate_limiter.stats(),
+        "usage": usage.stats(),
+        "local_classifier": detector.local_model.stats() if detector.local_model else None
+    }
+
+# Every numeric stats() value is also exported as a gauge on /metrics
+REGISTRY.register_stats(service_stats)
+
+@app.get("/stats")
+async def stats():
+    """Cache, inference and memory counters"""
+    # jobs.stats() counts rows in the shared SQLite store; keep that off the event loop
+    return await asyncio.to_thread(service_stats)
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text exposition: request/stage histograms, counters and the /stats gauges"""
+    return PlainTextResponse(await asyncio.to_thread(REGISTRY.render), media_type=CONTENT_TYPE)
+
+@app.get("/admin/usage")
+async def admin_usage(limit: int = 50, sort: str = "prompt_tokens", x_admin_key: Optional[str] = Header(None)):
+    """Requests, Gemini calls and tokens per client (API key or IP), largest first; needs X-Admin-Key"""
+    if not check_admin_key(x_admin_key):
+        raise HTTPException(status_code=403, detail="Admin key required")
+    try:
+        clients = await asyncio.to_thread(usage.report, max(1, min(limit, 1000)), sort)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"clients": clients, "rate_limits": rate_limiter.stats()}
+
+async def analyze_disease_upload(contents):
+    """Decode and analyze one leaf photo (bytes or spooled upload); shared by the synchronous endpoint and queued jobs"""
+    with governor.image_buffer():
+        # Draft-mode decode, EXIF orientation, downscale and a single re-encode, on the image pool
+        img = await image_executor.prepare(contents)
+        del contents
+        logger.info(f"📊 Image: {img.original_size} -> {img.size}, {len(img.data)//1024}KB {img.mime_type}")
+        
+        result = await detector.analyze_disease_async(img)
+        del img
+    
+    logger.info(f"🎯 Result: {result['disease']} ({result['confidence']*100:.1f}%)")
+    return result
+
+async def analyze_soil_upload(contents):
+    """Decode and analyze one soil photo (bytes or spooled upload); shared by the synchronous endpoint and queued jobs"""
+    with governor.image_buffer():
+        # Draft-mode decode, EXIF orientation, downscale and a single re-encode, on the image pool
+        img = await image_executor.prepare(contents)
+        del contents
+        logger.info(f"📊 Image: {img.original_size} -> {img.size}, {len(img.data)//1024}KB {img.mime_type}")
+        
+        result = await soil_analyzer.analyze_soil_async(img)
+        del img
+    
+    logger.info(f"🌱 Soil: {result['soil_type']}, pH: {result['ph_estimate']}")
+    return result
+
+jobs.register('disease', analyze_disease_upload)
+jobs.register('soil', analyze_soil_upload)
+
+@app.post("/api/disease-detection", response_class=CompactResponse)
 async def analyze_disease(image: UploadFile = File(...)):
     try:
         logger.info("="*60)
         logger.info("📸 DISEASE DETECTION REQUEST")
         
-        contents = await image.read()
-        img = Image.open(io.BytesIO(contents))
+        admit(detector)
         
-        # Resize large images to save memory
-        max_size = 1024
-        if img.width > max_size or img.height > max_size:
-            img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-            logger.info(f"📊 Image resized to: {img.size}")
-        else:
-            logger.info(f"📊 Image: {img.size}, Mode: {img.mode}")
-        
-        result = detector.analyze_disease(img)
-        
-        logger.info(f"🎯 Result: {result['disease']} ({result['confidence']*100:.1f}%)")
+        # Validated in place; the image pool then gets its bytes (inline mode decodes the spooled file directly)
+        with stage('upload_read'):
+            upload = open_upload(image)
+        result = await jobs.run('disease', upload)
         logger.info("="*60)
         
-        # Clean up memory
-        del img
-        del contents
-        gc.collect()
+        # Collect only if the memory budget is exceeded
+        governor.after_request()
         
         return result
         
+    except Overloaded as e:
+        return overloaded_response(e, disease_error(e))
+    except UploadRejected as e:
+        return rejected_response(e, disease_error(e))
     except Exception as e:
         logger.error(f"❌ Error: {e}")
-        gc.collect()
-        return {
-            "success": False,
-            "disease": "Processing Error",
-            "confidence": 0.0,
-            "severity": "Error",
-            "description": str(e),
-            "treatment": "Please try again",
-            "prevention": "Ensure image is valid"
-        }
+        governor.after_request()
+        return disease_error(e)
 
-@app.post("/api/soil-analysis")
+@app.post("/api/soil-analysis", response_class=CompactResponse)
 async def analyze_soil(image: UploadFile = File(...)):
     try:
         logger.info("="*60)
         logger.info("🌱 SOIL ANALYSIS REQUEST")
         
-        contents = await image.read()
-        img = Image.open(io.BytesIO(contents))
-        
-        # Resize large images to save memory
-        max_size = 1024
-        if img.width > max_size or img.height > max_size:
-            img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-            logger.info(f"📊 Image resized to: {img.size}")
-        else:
-            logger.info(f"📊 Image: {img.size}, Mode: {img.mode}")
+        admit(soil_analyzer)
         
-        result = soil_analyzer.analyze_soil(img)
-        
-        logger.info(f"🌱 Soil: {result['soil_type']}, pH: {result['ph_estimate']}")
+        # Validated in place; the image pool then gets its bytes (inline mode decodes the spooled file directly)
+        with stage('upload_read'):
+            upload = open_upload(image)
+        result = await jobs.run('soil', upload)
         logger.info("="*60)
         
-        # Clean up memory
-        del img
-        del contents
-        gc.collect()
+        # Collect only if the memory budget is exceeded
+        governor.after_request()
         
         return result
         
+    except Overloaded as e:
+        return overloaded_response(e, soil_error(e))
+    except UploadRejected as e:
+        return rejected_response(e, soil_error(e))
     except Exception as e:
         logger.error(f"❌ Error: {e}")
-        gc.collect()
-        return {
-            "success": False,
-            "soil_type": "Processing Error",
-            "color": "Unknown",
-            "texture": "Unknown",
-            "moisture": "Unknown",
-            "ph_estimate": 6.5,
-            "nitrogen": "Unknown",
-            "phosphorus": "Unknown",
-            "potassium": "Unknown",
-            "organic_matter": "Unknown",
-            "recommendations": "Error processing image",
-            "suitable_crops": [],
-            "improvements": "Please try again"
-        }
+        governor.after_request()
+        return soil_error(e)
+
+@app.post("/api/prevalidate", response_class=CompactResponse)
+async def prevalidate(image: UploadFile = File(...), kind: str = Form("disease")):
+    """
+    Local check a client can run before uploading for analysis: is the photo well exposed, sharp
+    and plausibly a leaf (kind=disease) or soil (kind=soil)? Answers in milliseconds, no model call.
+    """
+    if kind not in ("disease", "soil"):
+        return FastJSONResponse(status_code=400, content={"success": False, "error": "kind must be disease or soil"})
+    try:
+        with stage('upload_read'):
+            upload = open_upload(image)
+        result = await image_executor.run(screen_upload, upload, kind)
+    except Overloaded as e:
+        return overloaded_response(e, {"success": False, "ok": False})
+    except UploadRejected as e:
+        return rejected_response(e, {"ok": False})
+    except Exception as e:
+        logger.error(f"❌ Prevalidate Error: {e}")
+        return FastJSONResponse(status_code=400, content={"success": False, "ok": False, "error": "unreadable image"})
+    prescreener.record(kind, result["reason"], result["elapsed_ms"] / 1000)
+    return dict(result, success=True)
+
+async def _submit_job(kind, image, webhook):
+    if webhook:
+        try:
+            await asyncio.to_thread(check_webhook, webhook)
+        except WebhookRejected as e:
+            return FastJSONResponse(status_code=400, content={"success": False, "error": str(e)})
+    try:
+        with stage('upload_read'):
+            contents = await asyncio.to_thread(read_upload, image)
+        # Header check now, so a decompression bomb is refused instead of becoming a failed job
+        open_image(contents)
+        job_id = await jobs.submit(kind, contents, webhook, current_client())
+    except UploadRejected as e:
+        return rejected_response(e, {})
+    except QueueFull as e:
+        logger.warning(f"🚦 Refusing {kind} job: {e}")
+        return FastJSONResponse(status_code=503, content={"success": False, "error": str(e), "retry_after": 30},
+                            headers={"Retry-After": "30"})
+    logger.info(f"📬 Queued {kind} job {job_id}")
+    return FastJSONResponse(status_code=202, content={
+        "success": True,
+        "jobId": job_id,
+        "status": "queued",
+        "statusUrl": f"/api/jobs/{job_id}"
+    })
+
+@app.post("/api/jobs/disease-detection")
+async def submit_disease_job(image: UploadFile = File(...), webhook: Optional[str] = Form(None)):
+    """
+    Queue a disease analysis and return 202 with a job ID right away.
+    Poll /api/jobs/{jobId}, or pass "webhook" to have the finished job POSTed there.
+    """
+    return await _submit_job('disease', image, webhook)
+
+@app.post("/api/jobs/soil-analysis")
+async def submit_soil_job(image: UploadFile = File(...), webhook: Optional[str] = Form(None)):
+    """
+    Queue a soil analysis, same request/response format as /api/jobs/disease-detection
+    """
+    return await _submit_job('soil', image, webhook)
+
+@app.get("/api/jobs/{job_id}", response_class=CompactResponse)
+async def job_status(job_id: str):
+    """Status of a queued job: queued, running, completed (with "result") or failed (with "error")"""
+    job = await asyncio.to_thread(jobs.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    job.pop("webhook")
+    return job
 
 @app.post("/api/chat")
 async def chat(message: ChatMessage):
+    # Chat stays responsive under load; batch surveys absorb the backpressure
+    set_priority("high")
     try:
         logger.info("="*60)
         logger.info(f"💬 CHAT REQUEST from {message.userName}: {message.message[:50]}...")
         
-        result = chatbot.get_response(message.message, message.userName)
+        result = await chatbot.get_response_async(message.message, message.userName, message.sessionId)
+        if message.sessionId:
+            result["sessionId"] = message.sessionId
         
         logger.info(f"🤖 Response: {result['reply'][:50]}...")
         logger.info("="*60)
         
-        # Clean up memory
-        gc.collect()
+        governor.after_request()
         
         return result
         
+    except Overloaded as e:
+        return overloaded_response(e, {"reply": CHAT_BUSY, "success": False})
     except Exception as e:
         logger.error(f"❌ Chat Error: {e}")
-        gc.collect()
+        governor.after_request()
         return {
             "reply": "I'm sorry, I'm having trouble responding right now. Please try again!",
             "success": False
         }
 
+@app.delete("/api/chat/sessions/{session_id}")
+async def end_chat_session(session_id: str):
+    """Forget a conversation's history"""
+    found = await asyncio.to_thread(chatbot.sessions.delete, session_id)
+    return {"success": found, "sessionId": session_id}
+
+def _batch_response(images, archive, analyze_one, analyze_many, error_result, pack):
+    set_priority("low")
+    try:
+        entries = plan_batch(images, archive)
+    except BatchError as e:
+        return FastJSONResponse(status_code=400, content={"success": False, "error": str(e)})
+    
+    async def lines():
+        try:
+            async for line in run_batch(entries, analyze_one, analyze_many, error_result, pack):
+                yield line
+        finally:
+            governor.after_request()
+    
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@app.post("/api/disease-detection/batch")
+async def analyze_disease_batch(images: List[UploadFile] = File(None), archive: UploadFile = File(None),
+                                pack: int = Form(1)):
+    """
+    Multi-image survey: send several "images" parts and/or a zip "archive".
+    Streams NDJSON lines {"index", "filename", "result"} in upload order.
+    pack > 1 sends up to that many images per Gemini prompt.
+    """
+    logger.info("📸 BATCH DISEASE DETECTION REQUEST")
+    return _batch_response(images, archive, detector.analyze_disease_async,
+                           detector.analyze_disease_many_async, disease_error, pack)
+
+@app.post("/api/soil-analysis/batch")
+async def analyze_soil_batch(images: List[UploadFile] = File(None), archive: UploadFile = File(None),
+                             pack: int = Form(1)):
+    """
+    Multi-image soil survey, same request/response format as /api/disease-detection/batch
+    """
+    logger.info("🌱 BATCH SOIL ANALYSIS REQUEST")
+    return _batch_response(images, archive, soil_analyzer.analyze_soil_async,
+                           soil_analyzer.analyze_soil_many_async, soil_error, pack)
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {dumps(data)}\n\n"
+
+@app.post("/api/chat/stream")
+async def chat_stream(message: ChatMessage):
+    """
+    Server-Sent Events: "token" events carry text deltas, then a final "done" or "error" event.
+    Starlette cancels the generator when the client disconnects, which stops the upstream stream.
+    """
+    logger.info(f"💬 STREAM CHAT REQUEST from {message.userName}: {message.message[:50]}...")
+    set_priority("high")
+    try:
+        admit(chatbot)
+    except Overloaded as e:
+        return overloaded_response(e, {"reply": CHAT_BUSY, "success": False})
+    
+    async def events():
+        try:
+            async for text in chatbot.stream_response(message.message, message.userName, message.sessionId):
+                yield _sse("token", {"delta": text})
+            yield _sse("done", {"success": True})
+        except Overloaded as e:
+            yield _sse("error", {"reply": CHAT_BUSY, "success": False, "retry_after": e.retry_after})
+        except Exception as e:
+            logger.error(f"❌ Stream Chat Error: {e}")
+            yield _sse("error", {"reply": CHAT_STREAM_ERROR, "success": False})
+        finally:
+            governor.after_request()
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket):
+    """
+    WebSocket variant: send {"message": ..., "userName": ...}, receive {"delta": ...} frames then {"done": true}
+    """
+    try:
+        rate_limiter.identify(websocket.scope)
+    except InvalidApiKey:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    set_priority("high")
+    try:
+        while True:
+            payload = ChatMessage(**await websocket.receive_json())
+            logger.info(f"💬 WS CHAT REQUEST from {payload.userName}: {payload.message[:50]}...")
+            # Every message counts against the limits, like a POST to /api/chat
+            try:
+                rate_limiter.hit(websocket.scope, RATE_LIMIT_COSTS['chat'], payload.userName)
+            except RateLimited as e:
+                await websocket.send_json({"done": True, "success": False, "reply": RATE_LIMITED_REPLY,
+                                           "retry_after": e.retry_after})
+                continue
+            try:
+                async for text in chatbot.stream_response(payload.message, payload.userName, payload.sessionId):
+                    await websocket.send_json({"delta": text})
+                await websocket.send_json({"done": True, "success": True})
+            except WebSocketDisconnect:
+                raise
+            except Overloaded as e:
+                await websocket.send_json({"done": True, "success": False, "reply": CHAT_BUSY,
+                                           "retry_after": e.retry_after})
+            except Exception as e:
+                logger.error(f"❌ WS Chat Error: {e}")
+                await websocket.send_json({"done": True, "success": False, "reply": CHAT_STREAM_ERROR})
+            governor.after_request()
+    except WebSocketDisconnect:
+        logger.info("🔌 WebSocket chat client disconnected")
+
 if __name__ == "__main__":
     import uvicorn
     
@@ -181,7 +555,13 @@ if __name__ == "__main__":
     print("="*60)
     print("📡 Port: 8000")
     print("🌐 Docs: http://localhost:8000/docs")
+    if WORKERS > 1:
+        print(f"👷 Workers: {WORKERS} (shared state in {SHARED_STATE_DIR})")
     print("="*60)
     print()
     
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    if WORKERS > 1:
+        # Each worker imports main:app itself; caches, sessions, jobs and metrics go through SHARED_STATE_DIR
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
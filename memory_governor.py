@@ -0,0 +1,164 @@
+import asyncio
+import ctypes
+import ctypes.util
+import gc
+import logging
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Memory governor settings
+MEMORY_BUDGET_MB = float(os.getenv('MEMORY_BUDGET_MB', '400'))
+MAX_LIVE_IMAGE_BUFFERS = int(os.getenv('MAX_LIVE_IMAGE_BUFFERS', '16'))
+GC_IDLE_SECONDS = float(os.getenv('GC_IDLE_SECONDS', '30'))
+GC_MIN_INTERVAL = float(os.getenv('GC_MIN_INTERVAL', '5'))
+# "governor" collects on budget/idle, "always" restores the old per-request gc.collect(), "off" never collects
+GC_MODE = os.getenv('GC_MODE', 'governor')
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def _load_malloc_trim():
+    # glibc only: hands freed arenas (e.g. decoded PIL buffers) back to the OS
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+        return libc.malloc_trim
+    except (OSError, AttributeError):
+        return None
+
+
+_malloc_trim = _load_malloc_trim()
+
+
+def current_rss_bytes():
+    """
+    Resident set size of this process (peak RSS where /proc is unavailable)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryGovernor:
+    """
+    Replaces per-request gc.collect(): collects only when RSS or the number of
+    live image buffers exceeds its budget, or once the service has been idle
+    """
+
+    def __init__(self, mode=GC_MODE, budget_mb=MEMORY_BUDGET_MB, max_live_buffers=MAX_LIVE_IMAGE_BUFFERS,
+                 idle_seconds=GC_IDLE_SECONDS, min_interval=GC_MIN_INTERVAL):
+        self.mode = mode
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        self.max_live_buffers = max_live_buffers
+        self.idle_seconds = idle_seconds
+        self.min_interval = min_interval
+        self.live_buffers = 0
+        self.peak_live_buffers = 0
+        self.last_activity = time.monotonic()
+        self.last_collection = 0.0
+        self._dirty = False
+        self._idle_task = None
+        self.checks = 0
+        self.collections = {}
+        self.skipped = 0
+        self.last_pause_ms = 0.0
+        self.total_pause_ms = 0.0
+        self.last_freed_mb = 0.0
+
+    @contextmanager
+    def image_buffer(self):
+        """
+        Track an image buffer that is alive for the duration of the block
+        """
+        self.live_buffers += 1
+        self.peak_live_buffers = max(self.peak_live_buffers, self.live_buffers)
+        try:
+            yield
+        finally:
+            self.live_buffers -= 1
+            self.last_activity = time.monotonic()
+            self._dirty = True
+
+    def after_request(self):
+        """
+        Called at the end of each request; decides whether a collection is warranted
+        """
+        self.last_activity = time.monotonic()
+        self._dirty = True
+        self.checks += 1
+
+        if self.mode == 'off':
+            return
+        if self.mode == 'always':
+            self.collect('per_request')
+            return
+
+        if current_rss_bytes() > self.budget_bytes:
+            reason = 'rss_budget'
+        elif self.live_buffers > self.max_live_buffers:
+            reason = 'live_buffers'
+        else:
+            return
+
+        if time.monotonic() - self.last_collection < self.min_interval:
+            self.skipped += 1
+            return
+        self.collect(reason)
+
+    def collect(self, reason):
+        rss_before = current_rss_bytes()
+        start = time.perf_counter()
+        gc.collect()
+        if _malloc_trim is not None and reason != 'per_request':
+            _malloc_trim(0)
+        pause_ms = (time.perf_counter() - start) * 1000
+
+        self.last_collection = time.monotonic()
+        self._dirty = False
+        self.collections[reason] = self.collections.get(reason, 0) + 1
+        self.last_pause_ms = pause_ms
+        self.total_pause_ms += pause_ms
+        self.last_freed_mb = (rss_before - current_rss_bytes()) / (1024 * 1024)
+
+        if reason != 'per_request':
+            logger.info(f"🧹 GC ({reason}): {pause_ms:.1f}ms, freed {self.last_freed_mb:.1f}MB")
+
+    async def _idle_loop(self):
+        interval = max(1.0, self.idle_seconds / 2)
+        while True:
+            await asyncio.sleep(interval)
+            idle_for = time.monotonic() - self.last_activity
+            if self.mode == 'governor' and self._dirty and idle_for >= self.idle_seconds:
+                self.collect('idle')
+
+    def start(self):
+        if self._idle_task is None and self.mode == 'governor':
+            self._idle_task = asyncio.get_running_loop().create_task(self._idle_loop())
+
+    def stop(self):
+        if self._idle_task is not None:
+            self._idle_task.cancel()
+            self._idle_task = None
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "rss_mb": round(current_rss_bytes() / (1024 * 1024), 1),
+            "budget_mb": round(self.budget_bytes / (1024 * 1024), 1),
+            "live_image_buffers": self.live_buffers,
+            "peak_live_image_buffers": self.peak_live_buffers,
+            "checks": self.checks,
+            "collections": dict(self.collections),
+            "skipped_min_interval": self.skipped,
+            "last_pause_ms": round(self.last_pause_ms, 2),
+            "total_pause_ms": round(self.total_pause_ms, 2),
+            "last_freed_mb": round(self.last_freed_mb, 2)
+        }
+
+
+governor = MemoryGovernor()
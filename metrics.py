@@ -0,0 +1,449 @@
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from shared_state import shared_path
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Metrics settings
+METRICS_PREFIX = os.getenv('METRICS_PREFIX', 'agrismart')
+# Seconds; covers cache hits (ms) up to slow multi-image Gemini calls
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Requests to these paths are measured but not logged
+QUIET_PATHS = ('/health', '/ready', '/metrics')
+# Any other method token is counted as OTHER, so request labels stay bounded
+HTTP_METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS')
+
+# With several workers each one publishes its samples here and /metrics (on any worker)
+# reports their sum; unset with a single worker
+METRICS_DB = os.getenv('METRICS_DB', shared_path('metrics.sqlite3'))
+METRICS_PUBLISH_SECONDS = float(os.getenv('METRICS_PUBLISH_SECONDS', '5'))
+# Samples of a worker that stopped publishing are dropped after this long
+METRICS_STALE_SECONDS = float(os.getenv('METRICS_STALE_SECONDS', '600'))
+
+# Starlette appends the charset for text/ media types
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = f"{METRICS_PREFIX}_{name}"
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self, values):
+        raise NotImplementedError
+
+    def snapshot(self):
+        """
+        JSON-serializable copy of this process's samples
+        """
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def _combine(self, total, value):
+        return (total or 0) + value
+
+    def merge(self, snapshots):
+        """
+        Sum of several processes' snapshots, in the same shape as _values
+        """
+        merged = {}
+        for samples in snapshots:
+            for key, value in samples:
+                key = tuple(key)
+                merged[key] = self._combine(merged.get(key), value)
+        return merged
+
+    def render(self, values=None):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            samples = list(self._samples(self._values if values is None else values))
+        for suffix, labels, value in samples:
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self, values):
+        for key, value in values.items():
+            yield '_total', list(zip(self.labelnames, key)), value
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self, values):
+        for key, value in values.items():
+            yield '', list(zip(self.labelnames, key)), value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, then sum and count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), [list(counts), total, count]] for key, (counts, total, count) in self._values.items()]
+
+    def _combine(self, total, value):
+        if total is None:
+            return [list(value[0]), value[1], value[2]]
+        return [[a + b for a, b in zip(total[0], value[0])], total[1] + value[1], total[2] + value[2]]
+
+    def _samples(self, values):
+        for key, (counts, total, count) in values.items():
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield '_bucket', labels + [('le', _format_value(float(bound)))], cumulative
+            yield '_sum', labels, total
+            yield '_count', labels, count
+
+
+class MetricsRegistry:
+    """
+    Metrics owned by this process plus collectors that turn existing stats() dicts
+    into gauges at scrape time, rendered in the Prometheus text format
+    """
+
+    def __init__(self, shared_path=None):
+        self._metrics = []
+        self._collectors = []
+        self.shared_path = shared_path
+        self._shared = None
+        self._publish_task = None
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._add(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, func):
+        """
+        func() returns {section: stats dict}; every numeric leaf becomes a gauge
+        named <prefix>_<section>_<leaf> with the path in between as the "name" label
+        """
+        self._collectors.append(func)
+
+    def _collect_stats(self):
+        """
+        {gauge name: [(name label, value)]} from the registered stats() functions
+        """
+        families = {}
+
+        def walk(section, path, value):
+            if isinstance(value, dict):
+                for key, child in value.items():
+                    walk(section, path + [str(key)], child)
+                return
+            if isinstance(value, bool):
+                value = int(value)
+            if not isinstance(value, (int, float)) or not path:
+                return
+            name = f"{METRICS_PREFIX}_{section}_{path[-1]}".replace('-', '_').replace('.', '_')
+            families.setdefault(name, []).append(('/'.join(path[:-1]), value))
+
+        for func in self._collectors:
+            try:
+                for section, stats in func().items():
+                    walk(section, [], stats)
+            except Exception as e:
+                logger.error(f"❌ Stats collector failed: {e}")
+        return families
+
+    def _render_stats(self, workers):
+        """
+        workers: [(pid or None, families)]; with several workers each sample gets a "worker" label
+        """
+        merged = {}
+        for pid, families in workers:
+            for name, samples in families.items():
+                for label, value in samples:
+                    labels = [('name', label)] if label else []
+                    if pid is not None:
+                        labels.append(('worker', pid))
+                    merged.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name, samples in merged.items():
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+    def _store(self):
+        if self._shared is None and self.shared_path:
+            from result_cache import DiskTier
+            self._shared = DiskTier(self.shared_path)
+        return self._shared
+
+    def publish(self):
+        """
+        Write this worker's samples to the shared store (no-op with a single worker)
+        """
+        store = self._store()
+        if store is None:
+            return
+        snapshot = {
+            "metrics": {metric.name: metric.snapshot() for metric in self._metrics},
+            "stats": self._collect_stats()
+        }
+        store.set(f"metrics:{os.getpid()}", snapshot, time.time() + METRICS_STALE_SECONDS)
+
+    def _worker_snapshots(self):
+        try:
+            self.publish()
+            return [(key.split(':', 1)[1], snapshot) for key, snapshot in self._store().items("metrics:")]
+        except Exception as e:
+            logger.warning(f"⚠️ Shared metrics unavailable, reporting this worker only: {e}")
+            return None
+
+    def render(self):
+        snapshots = self._worker_snapshots() if self.shared_path else None
+        lines = []
+        if snapshots is None:
+            for metric in self._metrics:
+                lines.extend(metric.render())
+            lines.extend(self._render_stats([(None, self._collect_stats())]))
+        else:
+            for metric in self._metrics:
+                lines.extend(metric.render(metric.merge(s["metrics"].get(metric.name, []) for _, s in snapshots)))
+            # stats() values (hit rates, queue sizes...) don't add up across workers, so they're kept apart
+            lines.extend(self._render_stats([(pid, s["stats"]) for pid, s in snapshots]))
+        return '\n'.join(lines) + '\n'
+
+    async def _publish_loop(self):
+        while True:
+            await asyncio.sleep(METRICS_PUBLISH_SECONDS)
+            try:
+                await asyncio.to_thread(self.publish)
+            except Exception as e:
+                logger.warning(f"⚠️ Metrics publish failed: {e}")
+
+    def start(self):
+        if self.shared_path and self._publish_task is None:
+            self._publish_task = asyncio.get_running_loop().create_task(self._publish_loop())
+
+    def stop(self):
+        if self._publish_task is not None:
+            self._publish_task.cancel()
+            self._publish_task = None
+            try:
+                self.publish()
+            except Exception as e:
+                logger.warning(f"⚠️ Metrics publish failed: {e}")
+
+
+REGISTRY = MetricsRegistry(METRICS_DB or None)
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route (until the last body byte)',
+    ('method', 'endpoint', 'status'))
+REQUESTS_IN_FLIGHT = REGISTRY.gauge('http_requests_in_flight', 'HTTP requests currently being served')
+STAGE_SECONDS = REGISTRY.histogram(
+    'stage_duration_seconds', 'Time spent per processing stage and route', ('stage', 'endpoint'))
+GEMINI_SECONDS = REGISTRY.histogram(
+    'gemini_request_duration_seconds', 'Gemini round-trip time by model and outcome', ('model', 'outcome'))
+GEMINI_IN_FLIGHT = REGISTRY.gauge('gemini_requests_in_flight', 'Gemini calls currently in flight', ('model',))
+FALLBACKS = REGISTRY.counter('fallbacks', 'Requests answered with a fallback result', ('service',))
+PARSE_FAILURES = REGISTRY.counter('parse_failures', 'Gemini replies that could not be parsed', ('service',))
+CACHE_LOOKUPS = REGISTRY.counter('cache_lookups', 'Result cache lookups by outcome', ('cache', 'result'))
+
+
+# 🧭 Tracing context: one Trace per HTTP request, reachable from any module via contextvars
+
+class Trace:
+    """
+    Request ID plus per-stage timings for one request
+    """
+
+    def __init__(self, request_id, scope=None):
+        self.request_id = request_id
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.attributes = {}
+        self._scope = scope
+
+    @property
+    def endpoint(self):
+        # Route template once routing has happened; never the raw path, which scanners and typos make unbounded
+        if self._scope is None:
+            return 'background'
+        return getattr(self._scope.get('route'), 'path', None) or 'unmatched'
+
+    def add(self, stage_name, seconds):
+        self.stages[stage_name] = self.stages.get(stage_name, 0.0) + seconds
+
+    def server_timing(self):
+        return ', '.join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items())
+
+    def summary(self):
+        parts = [f"{name}={seconds * 1000:.0f}ms" for name, seconds in self.stages.items()]
+        parts += [f"{key}={value}" for key, value in self.attributes.items()]
+        return ' '.join(parts)
+
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def current_request_id():
+    trace = _current_trace.get()
+    return trace.request_id if trace is not None else None
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a block as a named stage of the current request (works around awaits too)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        trace = _current_trace.get()
+        STAGE_SECONDS.observe(elapsed, stage=name, endpoint=trace.endpoint if trace else 'background')
+        if trace is not None:
+            trace.add(name, elapsed)
+
+
+def annotate(**attributes):
+    """
+    Attach key/value details (cache=hit, model=...) to the current request's trace
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes.update(attributes)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware: assigns/propagates X-Request-ID, opens a Trace for the request,
+    and records latency, status and in-flight count per route
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get('headers') or [])
+        request_id = headers.get(b'x-request-id', b'').decode('latin-1')[:64] or uuid.uuid4().hex[:16]
+        trace = Trace(request_id, scope)
+        token = _current_trace.set(trace)
+        status = [500]
+
+        async def send_with_trace(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+                extra = [(b'x-request-id', request_id.encode('latin-1'))]
+                if trace.stages:
+                    extra.append((b'server-timing', trace.server_timing().encode('latin-1')))
+                message['headers'] = list(message.get('headers', [])) + extra
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            elapsed = time.perf_counter() - trace.start
+            method = scope['method'] if scope['method'] in HTTP_METHODS else 'OTHER'
+            REQUEST_SECONDS.observe(elapsed, method=method, endpoint=trace.endpoint, status=status[0])
+            if scope['path'] not in QUIET_PATHS:
+                # The log line can name the raw path; only metric labels need to stay bounded
+                logger.info(f"⏱️ [{request_id}] {scope['method']} {scope['path']} {status[0]} "
+                            f"in {elapsed * 1000:.0f}ms {trace.summary()}".rstrip())
+            _current_trace.reset(token)
@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 🔑 Gemini API Key from environment variable ONLY (no hardcoded fallback)
+GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+# "gemini" = google.generativeai, "fake" = local stand-in for load tests (see fake_backend)
+GEMINI_BACKEND = os.getenv('GEMINI_BACKEND', 'gemini')
+
+# Model names per service, in order of preference
+DISEASE_MODEL_NAMES = [
+    'gemini-2.5-flash',           # Latest stable
+    'gemini-flash-latest',        # Always latest
+    'gemini-2.0-flash',           # Stable alternative
+]
+SOIL_MODEL_NAMES = ['gemini-2.5-flash']
+CHAT_MODEL_NAMES = ['gemini-2.5-flash']
+
+
+class ModelRegistry:
+    """
+    One configured Gemini client and a shared GenerativeModel per model name
+    (and per set of model options, e.g. a service's system_instruction).
+
+    Nothing is imported or built at import time: models are created on first
+    use, or concurrently by warm_up() from the app lifespan while /health is
+    already answering.
+    """
+
+    def __init__(self, api_key=GEMINI_API_KEY, backend=GEMINI_BACKEND):
+        self.api_key = api_key
+        self.backend = backend
+        self._genai = None
+        # _lock guards the dicts only; building happens under a lock per service / model (and one for
+        # the client), so warm-up builds run in parallel and a request never waits on an unrelated build
+        self._lock = threading.Lock()
+        self._client_lock = threading.Lock()
+        self._build_locks = {}
+        self._models = {}
+        self._by_name = {}
+        self._options = {}
+        self._warm_task = None
+        self.errors = {}
+        self.init_seconds = {}
+        self.ready = False
+
+    def _client(self):
+        # google.generativeai (and grpc/protobuf behind it) is the slowest import in the service
+        with self._client_lock:
+            if self._genai is None:
+                start = time.perf_counter()
+                if self.backend == 'fake':
+                    from fake_backend import FakeGenAI
+                    genai = FakeGenAI()
+                else:
+                    if not self.api_key:
+                        raise Exception("GEMINI_API_KEY environment variable is missing")
+                    import google.generativeai as genai
+                genai.configure(api_key=self.api_key)
+                self._genai = genai
+                self.init_seconds['client'] = time.perf_counter() - start
+                logger.info(f"✅ Gemini client configured in {self.init_seconds['client']:.2f}s")
+            return self._genai
+
+    def configure(self, service, **options):
+        """
+        GenerativeModel keyword arguments (e.g. system_instruction) for a service's models,
+        or builder=function(genai, model_name) to construct them
+        """
+        with self._lock:
+            self._options[service] = options
+            self._models.pop(service, None)
+
+    def options(self, service):
+        return dict(self._options.get(service, {}))
+
+    def _construct(self, genai, model_name, options):
+        builder = options.get('builder')
+        if builder is not None:
+            return builder(genai, model_name)
+        return genai.GenerativeModel(model_name, **options)
+
+    def _key(self, model_name, options):
+        return (model_name, tuple(sorted((name, repr(value)) for name, value in options.items())))
+
+    def _build_lock(self, key):
+        with self._lock:
+            return self._build_locks.setdefault(key, threading.Lock())
+
+    def _shared(self, key, build):
+        """
+        The model for key from _by_name, built by build() (outside _lock) if it isn't there yet
+        """
+        with self._lock:
+            if key in self._by_name:
+                return self._by_name[key]
+        with self._build_lock(key):
+            with self._lock:
+                if key in self._by_name:
+                    return self._by_name[key]
+            model = build()
+            with self._lock:
+                self._by_name[key] = model
+            return model
+
+    def get(self, service, model_names):
+        """
+        Shared model for the first name in model_names that can be built, or None
+        """
+        with self._lock:
+            if service in self._models:
+                return self._models[service]
+
+        with self._build_lock(('service', service)):
+            with self._lock:
+                if service in self._models:
+                    return self._models[service]
+                options = self._options.get(service, {})
+
+            start = time.perf_counter()
+            model = None
+            try:
+                genai = self._client()
+                for model_name in model_names:
+                    try:
+                        model = self._shared(self._key(model_name, options),
+                                             lambda: self._construct_logged(genai, service, model_name, options))
+                        if model is not None:
+                            break
+                    except Exception as e:
+                        logger.warning(f"❌ Model {model_name} failed: {e}")
+                if model is None:
+                    raise Exception("No valid Gemini model found")
+                self.errors.pop(service, None)
+            except Exception as e:
+                logger.error(f"❌ {service} model initialization failed: {e}")
+                self.errors[service] = str(e)
+
+            self.init_seconds[service] = time.perf_counter() - start
+            with self._lock:
+                self._models[service] = model
+            return model
+
+    def _construct_logged(self, genai, service, model_name, options):
+        logger.info(f"🔍 Trying model: {model_name}...")
+        model = self._construct(genai, model_name, options)
+        logger.info(f"✅ {service} using model: {model_name}")
+        return model
+
+    def model(self, model_name, **options):
+        """
+        Shared model by name (and options), for runtime failover; None if it can't be built
+        """
+        return self._shared(self._key(model_name, options), lambda: self._construct_or_none(model_name, options))
+
+    def _construct_or_none(self, model_name, options):
+        # Construction is local (no network), so a failure here is configuration: remember it
+        try:
+            return self._construct(self._client(), model_name, options)
+        except Exception as e:
+            logger.warning(f"❌ Model {model_name} unavailable: {e}")
+            return None
+
+    async def warm_up(self, services):
+        """
+        Build every service's model concurrently off the event loop
+        """
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            asyncio.to_thread(self.get, service, model_names)
+            for service, model_names in services.items()
+        ))
+        self.ready = not self.errors
+        logger.info(f"🚀 Models warmed up in {time.perf_counter() - start:.2f}s (ready={self.ready})")
+
+    def start_warm_up(self, services):
+        if self._warm_task is None:
+            self._warm_task = asyncio.get_running_loop().create_task(self.warm_up(services))
+        return self._warm_task
+
+    async def wait_until_warm(self):
+        """
+        Requests that arrive during cold start wait for the warm-up instead of blocking the loop
+        """
+        if self._warm_task is not None and not self._warm_task.done():
+            await asyncio.shield(self._warm_task)
+
+    def status(self):
+        return {
+            "ready": self.ready,
+            "backend": self.backend,
+            "warming_up": self._warm_task is not None and not self._warm_task.done(),
+            "models": {
+                service: model.model_name.split('/')[-1] if model is not None else None
+                for service, model in self._models.items()
+            },
+            "errors": dict(self.errors),
+            "init_seconds": {name: round(seconds, 3) for name, seconds in self.init_seconds.items()}
+        }
+
+
+registry = ModelRegistry()
+
+SERVICES = {
+    'disease': DISEASE_MODEL_NAMES,
+    'soil': SOIL_MODEL_NAMES,
+    'chat': CHAT_MODEL_NAMES,
+}
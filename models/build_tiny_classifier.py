@@ -0,0 +1,156 @@
+"""
+Build the tiny offline disease classifier checked in at models/saved/disease_tiny
+
+Trains a softmax-regression model on synthetic leaf images (healthy green,
+brown blight patches, dark spots, white mildew, non-plant colors) using the
+same features local_classifier uses at runtime. It exists so the local tier,
+its benchmark and CI run without network access; it is not meant for
+production traffic. Output is deterministic for a given --seed.
+
+Usage:
+    python models/build_tiny_classifier.py [--out models/saved/disease_tiny] [--per-class 300]
+"""
+import argparse
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+from PIL import Image
+
+from local_classifier import extract_features
+
+SIZE = 64
+
+LABELS = [
+    {
+        "disease": "Healthy",
+        "is_plant": True,
+        "severity": "None",
+        "description": "Leaf tissue looks uniformly green with no visible lesions.",
+        "treatment": "No treatment needed",
+        "prevention": "Keep monitoring regularly and maintain balanced irrigation"
+    },
+    {
+        "disease": "Leaf Blight",
+        "is_plant": True,
+        "severity": "Medium",
+        "description": "Large brown necrotic patches spreading across the leaf.",
+        "treatment": "Remove infected leaves and apply a copper-based or mancozeb fungicide",
+        "prevention": "Avoid overhead irrigation, rotate crops and space plants for airflow"
+    },
+    {
+        "disease": "Leaf Spot",
+        "is_plant": True,
+        "severity": "Low",
+        "description": "Small dark spots scattered over the leaf surface.",
+        "treatment": "Prune spotted leaves and apply a protective fungicide",
+        "prevention": "Water at the base of the plant and clear fallen debris"
+    },
+    {
+        "disease": "Powdery Mildew",
+        "is_plant": True,
+        "severity": "Medium",
+        "description": "White powdery patches on the leaf surface.",
+        "treatment": "Spray sulfur or potassium bicarbonate; neem oil for mild cases",
+        "prevention": "Improve air circulation and avoid excess nitrogen fertilizer"
+    },
+    {
+        "disease": "Not a Plant Image",
+        "is_plant": False,
+        "severity": "Error",
+        "description": "This image doesn't show plant vegetation",
+        "treatment": "N/A",
+        "prevention": "N/A"
+    }
+]
+
+
+def _leaf(rng):
+    h = rng.uniform(0.22, 0.36) + rng.normal(0, 0.015, (SIZE, SIZE))
+    s = rng.uniform(0.45, 0.85) + rng.normal(0, 0.05, (SIZE, SIZE))
+    v = rng.uniform(0.35, 0.8) + rng.normal(0, 0.06, (SIZE, SIZE))
+    return h, s, v
+
+
+def _blobs(rng, count, radius):
+    y, x = np.mgrid[0:SIZE, 0:SIZE]
+    mask = np.zeros((SIZE, SIZE), dtype=bool)
+    for _ in range(count):
+        cy, cx = rng.uniform(0, SIZE, 2)
+        r = rng.uniform(*radius)
+        mask |= (y - cy) ** 2 + (x - cx) ** 2 < r ** 2
+    return mask
+
+
+def synth(label, rng):
+    h, s, v = _leaf(rng)
+    if label == 1:
+        mask = _blobs(rng, rng.integers(2, 5), (8, 16))
+        h[mask], s[mask], v[mask] = rng.uniform(0.04, 0.1), rng.uniform(0.5, 0.8), rng.uniform(0.25, 0.5)
+    elif label == 2:
+        mask = _blobs(rng, rng.integers(15, 40), (1, 3))
+        h[mask], s[mask], v[mask] = rng.uniform(0.05, 0.12), 0.6, rng.uniform(0.05, 0.14)
+    elif label == 3:
+        mask = _blobs(rng, rng.integers(3, 8), (5, 12))
+        s[mask], v[mask] = rng.uniform(0.0, 0.12), rng.uniform(0.82, 0.98)
+    elif label == 4:
+        if rng.random() < 0.5:
+            h = (rng.uniform(0.45, 1.0) + rng.normal(0, 0.02, (SIZE, SIZE))) % 1.0
+        else:
+            s = rng.uniform(0.0, 0.15) + rng.normal(0, 0.03, (SIZE, SIZE))
+    hsv = np.clip(np.dstack([h % 1.0, s, v]), 0, 1)
+    return Image.fromarray((hsv * 255).astype(np.uint8), 'HSV').convert('RGB')
+
+
+def train(features, labels, classes, epochs=600, lr=0.5, l2=1e-3):
+    n, f = features.shape
+    weights = np.zeros((f, classes), dtype=np.float64)
+    bias = np.zeros(classes, dtype=np.float64)
+    onehot = np.eye(classes)[labels]
+    for _ in range(epochs):
+        logits = features @ weights + bias
+        logits -= logits.max(axis=1, keepdims=True)
+        probs = np.exp(logits)
+        probs /= probs.sum(axis=1, keepdims=True)
+        grad = probs - onehot
+        weights -= lr * (features.T @ grad / n + l2 * weights)
+        bias -= lr * grad.mean(axis=0)
+    return weights.astype(np.float32), bias.astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default=os.path.join(ROOT, 'models', 'saved', 'disease_tiny'))
+    parser.add_argument('--per-class', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=2024)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    labels = np.repeat(np.arange(len(LABELS)), args.per_class)
+    images = [synth(int(label), rng) for label in labels]
+    features = extract_features(images)
+
+    mean = features.mean(axis=0)
+    std = features.std(axis=0) + 1e-6
+    weights, bias = train((features - mean) / std, labels, len(LABELS))
+
+    logits = ((features - mean) / std) @ weights + bias
+    accuracy = (logits.argmax(axis=1) == labels).mean()
+
+    os.makedirs(args.out, exist_ok=True)
+    np.save(os.path.join(args.out, 'weights.npy'), weights)
+    np.save(os.path.join(args.out, 'bias.npy'), bias)
+    np.save(os.path.join(args.out, 'feature_mean.npy'), mean.astype(np.float32))
+    np.save(os.path.join(args.out, 'feature_std.npy'), std.astype(np.float32))
+    with open(os.path.join(args.out, 'labels.json'), 'w') as f:
+        json.dump(LABELS, f, indent=2)
+
+    print(f"✅ Saved {len(LABELS)}-class model to {args.out} (train accuracy {accuracy:.3f})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+import copy
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Near-duplicate settings
+PHASH_ALGORITHM = os.getenv('PHASH_ALGORITHM', 'dhash')
+# Max Hamming distance (out of 64 bits) to treat two images as the same photo; 0 disables the index
+NEAR_DUPLICATE_DISTANCE = int(os.getenv('NEAR_DUPLICATE_DISTANCE', '4'))
+NEAR_DUPLICATE_MAX_ENTRIES = int(os.getenv('NEAR_DUPLICATE_MAX_ENTRIES', '5000'))
+
+
+def _grayscale(image, width, height):
+    if image.mode != 'L':
+        image = image.convert('L')
+    small = image.resize((width, height), Image.Resampling.BILINEAR)
+    return np.asarray(small, dtype=np.float32)
+
+
+def _bits_to_int(bits):
+    return int.from_bytes(np.packbits(bits.ravel().astype(np.uint8)).tobytes(), 'big')
+
+
+def average_hash(image, hash_size=8):
+    pixels = _grayscale(image, hash_size, hash_size)
+    return _bits_to_int(pixels > pixels.mean())
+
+
+def difference_hash(image, hash_size=8):
+    pixels = _grayscale(image, hash_size + 1, hash_size)
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix.astype(np.float32)
+
+
+_DCT_32 = _dct_matrix(32)
+
+
+def perceptual_hash(image, hash_size=8):
+    pixels = _grayscale(image, 32, 32)
+    dct = _DCT_32 @ pixels @ _DCT_32.T
+    low = dct[:hash_size, :hash_size]
+    return _bits_to_int(low > np.median(low.ravel()[1:]))
+
+
+HASH_FUNCTIONS = {
+    'ahash': average_hash,
+    'dhash': difference_hash,
+    'phash': perceptual_hash,
+}
+
+
+def image_hash(image, algorithm=PHASH_ALGORITHM):
+    return HASH_FUNCTIONS[algorithm](image)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over 64-bit hashes for Hamming-distance range queries
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value):
+        if self.root is None:
+            self.root = (value, {})
+            self.size = 1
+            return
+
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (value, {})
+                self.size += 1
+                return
+            node = child
+
+    def nearest(self, value, max_distance):
+        """
+        Closest stored hash within max_distance, as (hash, distance), or None
+        """
+        if self.root is None:
+            return None
+
+        best = None
+        stack = [self.root]
+        while stack:
+            node_value, children = stack.pop()
+            distance = hamming(value, node_value)
+            if distance <= max_distance and (best is None or distance < best[1]):
+                best = (node_value, distance)
+                if distance == 0:
+                    break
+            low, high = distance - max_distance, distance + max_distance
+            for edge, child in children.items():
+                if low <= edge <= high:
+                    stack.append(child)
+        return best
+
+
+class NearDuplicateIndex:
+    """
+    Maps perceptual hashes of analyzed images to their results so re-photographed
+    or re-compressed copies can be answered without calling Gemini
+    """
+
+    def __init__(self, name, max_distance=NEAR_DUPLICATE_DISTANCE, max_entries=NEAR_DUPLICATE_MAX_ENTRIES,
+                 algorithm=PHASH_ALGORITHM):
+        self.name = name
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.algorithm = algorithm
+        self._lock = threading.Lock()
+        self._trees = {}
+        self._results = OrderedDict()
+        self.lookups = 0
+        self.hits = 0
+        self.lookup_seconds = 0.0
+        self.max_lookup_seconds = 0.0
+
+    @property
+    def enabled(self):
+        return self.max_distance > 0
+
+    def hash_image(self, image):
+        return image_hash(image, self.algorithm)
+
+    def lookup(self, image_hash_value, namespace):
+        """
+        Stored result for the closest known image within max_distance, or None
+        """
+        if not self.enabled:
+            return None
+
+        start = time.perf_counter()
+        with self._lock:
+            tree = self._trees.get(namespace)
+            match = tree.nearest(image_hash_value, self.max_distance) if tree else None
+            result = None
+            if match is not None:
+                result = self._results.get((namespace, match[0]))
+                if result is not None:
+                    self._results.move_to_end((namespace, match[0]))
+
+            elapsed = time.perf_counter() - start
+            self.lookups += 1
+            self.lookup_seconds += elapsed
+            self.max_lookup_seconds = max(self.max_lookup_seconds, elapsed)
+            if result is None:
+                return None
+            self.hits += 1
+
+        logger.info(f"🪞 Near-duplicate of a known image (distance {match[1]})")
+        return copy.deepcopy(result)
+
+    def add(self, image_hash_value, namespace, result):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            key = (namespace, image_hash_value)
+            self._results[key] = copy.deepcopy(result)
+            self._results.move_to_end(key)
+            if len(self._results) > self.max_entries:
+                self._evict()
+            else:
+                self._trees.setdefault(namespace, BKTree()).add(image_hash_value)
+
+    def _evict(self):
+        # BK-trees don't support deletion: drop the oldest 10% and rebuild
+        keep = int(self.max_entries * 0.9)
+        while len(self._results) > keep:
+            self._results.popitem(last=False)
+
+        self._trees = {}
+        for namespace, value in self._results:
+            self._trees.setdefault(namespace, BKTree()).add(value)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "algorithm": self.algorithm,
+            "max_distance": self.max_distance,
+            "entries": len(self._results),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+            "avg_lookup_ms": round(self.lookup_seconds / self.lookups * 1000, 4) if self.lookups else 0.0,
+            "max_lookup_ms": round(self.max_lookup_seconds * 1000, 4)
+        }
@@ -0,0 +1,234 @@
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from image_preprocessing import draft_thumbnail, open_image, prepare_image
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Pre-screen settings
+# "on" answers obviously unusable photos locally, "shadow" only logs and counts what it would reject, "off" skips it
+PRESCREEN_MODE = os.getenv('PRESCREEN_MODE', 'on')
+# JSON file overriding any of DEFAULT_THRESHOLDS (tune it with benchmarks/eval_prescreen.py)
+PRESCREEN_THRESHOLDS = os.getenv('PRESCREEN_THRESHOLDS', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'models', 'prescreen_thresholds.json'))
+
+HUE_BINS = 12
+
+# Deliberately loose: only photos that are clearly unusable are rejected, anything doubtful goes to Gemini
+DEFAULT_THRESHOLDS = {
+    # Longest side of the copy that is measured; the sharpness threshold only holds for this size
+    "size": 256,
+    "exposure": {"min_mean_luma": 0.07, "max_dark_fraction": 0.9, "max_clipped_fraction": 0.8},
+    "blur": {"min_sharpness": 6.0},
+    "disease": {"min_plant_tone": 0.05, "max_artificial": 0.6},
+    "soil": {"min_soil_tone": 0.25, "max_green": 0.85, "max_artificial": 0.5},
+}
+
+REASONS = {
+    "too_dark": ("The photo is too dark to analyze.",
+                 ["Take the photo in daylight", "Avoid your own shadow falling on the subject",
+                  "Turn on the flash if there is no daylight"]),
+    "overexposed": ("The photo is too bright and washed out to analyze.",
+                    ["Avoid pointing the camera towards the sun", "Shade the subject with your body or a hat",
+                     "Try again in softer light, e.g. morning or late afternoon"]),
+    "blurry": ("The photo is too blurry to analyze.",
+               ["Hold the phone steady with both hands", "Tap the screen on the subject to focus",
+                "Move back a little if the camera can't focus this close"]),
+    "not_plant": ("This photo doesn't seem to show a plant.",
+                  ["Photograph a leaf of the affected plant", "Fill most of the frame with the leaf",
+                   "Use a plain background, such as the ground or your hand"]),
+    "not_soil": ("This photo doesn't seem to show soil.",
+                 ["Take a photo of actual ground soil", "Ensure good lighting", "Remove any debris or objects",
+                  "Focus on the soil surface"]),
+}
+
+PRESCREEN_OUTCOMES = REGISTRY.counter('prescreen_outcomes', 'Pre-screened images by service and outcome',
+                                      ('service', 'outcome'))
+PRESCREEN_SECONDS = REGISTRY.histogram(
+    'prescreen_duration_seconds', 'Time to measure and judge one image locally', ('service',),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+
+
+def load_thresholds(path=PRESCREEN_THRESHOLDS):
+    """
+    DEFAULT_THRESHOLDS with the file's values on top (the defaults alone if there is no file)
+    """
+    thresholds = {key: dict(value) if isinstance(value, dict) else value for key, value in DEFAULT_THRESHOLDS.items()}
+    if not path or not os.path.exists(path):
+        return thresholds
+    with open(path) as f:
+        overrides = json.load(f)
+    for key, value in overrides.items():
+        if isinstance(value, dict):
+            thresholds.setdefault(key, {}).update(value)
+        else:
+            thresholds[key] = value
+    return thresholds
+
+
+def measure_image(img):
+    """
+    Color, tone, sharpness and exposure statistics of a small RGB PIL image, all vectorized
+    """
+    # Thresholds are compared on the 0-255 integer planes; only luma needs floats
+    hsv = np.asarray(img.convert('HSV'))
+    h, s, v = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+    luma = np.asarray(img.convert('L'), dtype=np.float32) / 255.0
+
+    # 4-neighbour Laplacian; its variance drops sharply when edges are smeared
+    laplacian = (luma[:-2, 1:-1] + luma[2:, 1:-1] + luma[1:-1, :-2] + luma[1:-1, 2:]
+                 - 4 * luma[1:-1, 1:-1]) * 255
+
+    colored = (s > 51) & (v > 38)
+    hue_histogram = np.bincount(h[colored] // (256 // HUE_BINS + 1), minlength=HUE_BINS) / h.size
+    # Hue 0-255 maps to 0-360 degrees: yellow ~43, green ~85, blue ~170
+    green = colored & (h >= 43) & (h < 120)
+    # Yellowing and browning leaves are still plants, so yellow counts too
+    plant_tone = colored & (h >= 20) & (h < 120)
+    earth = (s > 30) & (v > 20) & ((h < 43) | (h >= 235))
+    gray = (s <= 30) & (v > 20) & (v < 230)
+    # Blues, purples and magentas: fabric, paint, plastic, screens - rare in leaves and soil
+    artificial = colored & (h >= 120) & (h < 235)
+
+    return {
+        "mean_luma": round(float(luma.mean()), 4),
+        "luma_std": round(float(luma.std()), 4),
+        "dark_fraction": round(float((luma < 0.1).mean()), 4),
+        "clipped_fraction": round(float((luma > 0.97).mean()), 4),
+        "sharpness": round(float(laplacian.var()), 2),
+        "green_ratio": round(float(green.mean()), 4),
+        "plant_tone_ratio": round(float(plant_tone.mean()), 4),
+        "soil_tone_ratio": round(float((earth | gray).mean()), 4),
+        "artificial_ratio": round(float(artificial.mean()), 4),
+        "hue_histogram": [round(float(x), 4) for x in hue_histogram],
+    }
+
+
+def judge(metrics, service, thresholds):
+    """
+    First reason the image is unusable for service ('disease' or 'soil'), or None
+    """
+    exposure = thresholds['exposure']
+    if metrics['mean_luma'] < exposure['min_mean_luma'] or metrics['dark_fraction'] > exposure['max_dark_fraction']:
+        return 'too_dark'
+    if metrics['clipped_fraction'] > exposure['max_clipped_fraction']:
+        return 'overexposed'
+    if metrics['sharpness'] < thresholds['blur']['min_sharpness']:
+        return 'blurry'
+    rules = thresholds[service]
+    if service == 'disease':
+        if metrics['plant_tone_ratio'] < rules['min_plant_tone'] or metrics['artificial_ratio'] > rules['max_artificial']:
+            return 'not_plant'
+    elif (metrics['soil_tone_ratio'] < rules['min_soil_tone'] or metrics['green_ratio'] > rules['max_green']
+          or metrics['artificial_ratio'] > rules['max_artificial']):
+        return 'not_soil'
+    return None
+
+
+def verdict(reason, metrics, elapsed):
+    message, tips = REASONS.get(reason, ("The photo looks usable.", []))
+    return {
+        "ok": reason is None,
+        "reason": reason,
+        "message": message,
+        "tips": list(tips),
+        "metrics": metrics,
+        "elapsed_ms": round(elapsed * 1000, 2)
+    }
+
+
+class PreScreener:
+    """
+    Local check that runs before any model call: photos that are too dark,
+    washed out, blurry, or whose colors are nothing like a leaf (or soil)
+    are answered here instead of costing a Gemini round-trip to be rejected.
+    """
+
+    def __init__(self, mode=PRESCREEN_MODE, thresholds_path=PRESCREEN_THRESHOLDS):
+        self.mode = mode
+        self.thresholds_path = thresholds_path
+        self.thresholds = DEFAULT_THRESHOLDS
+        if mode != 'off':
+            try:
+                self.thresholds = load_thresholds(thresholds_path)
+            except Exception as e:
+                logger.error(f"❌ Pre-screen thresholds unreadable ({thresholds_path}), using defaults: {e}")
+        self.outcomes = {}
+        self.seconds = 0.0
+
+    @property
+    def enabled(self):
+        return self.mode in ('on', 'shadow')
+
+    def record(self, service, reason, elapsed):
+        outcome = reason or 'ok'
+        PRESCREEN_OUTCOMES.inc(service=service, outcome=outcome)
+        PRESCREEN_SECONDS.observe(elapsed, service=service)
+        counts = self.outcomes.setdefault(service, {})
+        counts[outcome] = counts.get(outcome, 0) + 1
+        self.seconds += elapsed
+
+    def screen(self, image, service):
+        """
+        verdict() for a PreparedImage if it should be rejected, None if it should go on to the model
+        """
+        if not self.enabled:
+            return None
+        start = time.perf_counter()
+        try:
+            size = self.thresholds['size']
+            # Taken on the image pool with the upload's other CPU work when it came through there
+            metrics = image.measurements.get(size) or measure_image(image.thumbnail(size))
+            reason = judge(metrics, service, self.thresholds)
+        except Exception as e:
+            logger.error(f"Pre-screen failed, passing the image on: {e}")
+            return None
+        elapsed = time.perf_counter() - start
+        self.record(service, reason, elapsed)
+        if reason is None:
+            return None
+        if self.mode == 'shadow':
+            logger.info(f"👀 Pre-screen would reject {service} image: {reason} ({metrics})")
+            return None
+        logger.info(f"🚫 Pre-screen rejected {service} image: {reason}")
+        return verdict(reason, metrics, elapsed)
+
+    def stats(self):
+        screened = sum(sum(counts.values()) for counts in self.outcomes.values())
+        return {
+            "mode": self.mode,
+            "thresholds": self.thresholds_path if os.path.exists(self.thresholds_path or '') else "defaults",
+            "outcomes": {service: dict(counts) for service, counts in self.outcomes.items()},
+            "avg_ms": round(self.seconds / screened * 1000, 3) if screened else 0.0
+        }
+
+
+def screen_upload(contents, service, thresholds=None):
+    """
+    Image-pool entry point for /api/prevalidate: upload bytes in, verdict() out (always, ok or not)
+    """
+    start = time.perf_counter()
+    thresholds = thresholds or prescreener.thresholds
+    size = thresholds['size']
+    img = draft_thumbnail(open_image(contents), size)
+    metrics = measure_image(img)
+    return verdict(judge(metrics, service, thresholds), metrics, time.perf_counter() - start)
+
+
+def prepare_measured(contents, size):
+    """
+    Image-pool entry point for analysis uploads: prepare_image_compact() plus the pre-screen's
+    metrics for a size x size thumbnail, so neither runs on the event loop
+    """
+    prepared = prepare_image(contents)
+    prepared.perceptual_hash()
+    prepared.measurements[size] = measure_image(prepared.thumbnail(size))
+    return prepared.compact()
+
+
+prescreener = PreScreener()
@@ -0,0 +1,166 @@
+import asyncio
+import datetime
+import logging
+import os
+import threading
+
+from metrics import REGISTRY
+from rate_limits import usage
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Prompt settings
+# Explicit Gemini context caching of system instructions (billed at the cached-token rate).
+# Only used for instructions long enough for the API to accept (GEMINI_CONTEXT_CACHE_MIN_TOKENS).
+CONTEXT_CACHE = os.getenv('GEMINI_CONTEXT_CACHE', 'off').lower() in ('1', 'on', 'true', 'yes')
+CONTEXT_CACHE_TTL = float(os.getenv('GEMINI_CONTEXT_CACHE_TTL', '3600'))
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv('GEMINI_CONTEXT_CACHE_MIN_TOKENS', '1024'))
+
+TOKENS = REGISTRY.counter('gemini_tokens', 'Gemini tokens by service and kind (prompt, cached, output)',
+                          ('service', 'kind'))
+
+
+def estimate_tokens(text):
+    # ~4 characters per token for English text; the API's count_tokens is exact but a network call
+    return len(text) // 4 + 1
+
+
+class Prompt:
+    """
+    One versioned prompt: a static system instruction set once on the model,
+    and the short text sent with each request (plus a multi-image variant).
+    The version goes into result-cache keys, so bump it whenever the text changes.
+    """
+
+    def __init__(self, service, version, system_instruction, request_text=None, multi_image_text=None):
+        self.service = service
+        self.version = version
+        self.system_instruction = system_instruction.strip()
+        self.request_text = request_text
+        self.multi_image_text = multi_image_text
+        self.instruction_tokens = estimate_tokens(self.system_instruction)
+        self._multi = {}
+        self._cached_contents = []
+
+    @property
+    def key(self):
+        return f"{self.service}-{self.version}"
+
+    def contents(self, *parts):
+        """
+        Request contents: the per-request text (if any) followed by the images
+        """
+        return ([self.request_text] if self.request_text else []) + list(parts)
+
+    def multi_contents(self, parts):
+        count = len(parts)
+        if count not in self._multi:
+            self._multi[count] = self.multi_image_text.format(count=count).strip()
+        return [self._multi[count]] + list(parts)
+
+    def build_model(self, genai, model_name):
+        """
+        GenerativeModel with this prompt's system instruction, served from an explicit
+        context cache when enabled and the instruction is long enough to be cached
+        """
+        if CONTEXT_CACHE and self.instruction_tokens >= CONTEXT_CACHE_MIN_TOKENS and hasattr(genai, 'caching'):
+            try:
+                cached = genai.caching.CachedContent.create(
+                    model=model_name if model_name.startswith('models/') else f"models/{model_name}",
+                    display_name=f"{self.key}-{model_name}",
+                    system_instruction=self.system_instruction,
+                    ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL)
+                )
+                self._cached_contents.append(cached)
+                logger.info(f"🗄️ {self.key} instruction cached for {model_name} ({self.instruction_tokens} tokens)")
+                return genai.GenerativeModel.from_cached_content(cached)
+            except Exception as e:
+                logger.warning(f"⚠️ Context cache for {self.key} on {model_name} unavailable, using system_instruction: {e}")
+        return genai.GenerativeModel(model_name, system_instruction=self.system_instruction)
+
+    def refresh_cached_contents(self):
+        for cached in self._cached_contents:
+            try:
+                cached.update(ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL))
+            except Exception as e:
+                logger.warning(f"⚠️ Could not extend context cache {cached.name}: {e}")
+
+
+class PromptRegistry:
+    """
+    Every service's prompt, the model options built from them, and per-service
+    token usage as reported by Gemini (usage_metadata)
+    """
+
+    def __init__(self):
+        self._prompts = {}
+        self._lock = threading.Lock()
+        self._usage = {}
+        self._refresh_task = None
+
+    def register(self, prompt):
+        self._prompts[prompt.service] = prompt
+        return prompt
+
+    def get(self, service):
+        return self._prompts[service]
+
+    def configure(self, model_registry, service):
+        """
+        Build the service's models with its system instruction (and context cache)
+        """
+        model_registry.configure(service, builder=self._prompts[service].build_model)
+
+    def record_usage(self, service, response):
+        metadata = getattr(response, 'usage_metadata', None)
+        if metadata is None:
+            return
+        prompt = getattr(metadata, 'prompt_token_count', 0) or 0
+        cached = getattr(metadata, 'cached_content_token_count', 0) or 0
+        output = getattr(metadata, 'candidates_token_count', 0) or 0
+        TOKENS.inc(prompt, service=service, kind='prompt')
+        TOKENS.inc(cached, service=service, kind='cached')
+        TOKENS.inc(output, service=service, kind='output')
+        with self._lock:
+            totals = self._usage.setdefault(service, [0, 0, 0, 0])
+            totals[0] += 1
+            totals[1] += prompt
+            totals[2] += cached
+            totals[3] += output
+        usage.record_call(prompt, cached, output)
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(CONTEXT_CACHE_TTL / 2)
+            for prompt in self._prompts.values():
+                await asyncio.to_thread(prompt.refresh_cached_contents)
+
+    def start(self):
+        """
+        Keep explicit context caches alive while the app runs (no-op unless enabled)
+        """
+        if CONTEXT_CACHE and self._refresh_task is None:
+            self._refresh_task = asyncio.get_running_loop().create_task(self._refresh_loop())
+
+    def stop(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+    def stats(self):
+        stats = {}
+        for service, prompt in self._prompts.items():
+            calls, prompt_tokens, cached, output = self._usage.get(service, (0, 0, 0, 0))
+            stats[service] = {
+                "version": prompt.key,
+                "instruction_tokens_est": prompt.instruction_tokens,
+                "context_cached": bool(prompt._cached_contents),
+                "calls": calls,
+                "avg_prompt_tokens": round(prompt_tokens / calls, 1) if calls else 0.0,
+                "avg_cached_tokens": round(cached / calls, 1) if calls else 0.0,
+                "avg_output_tokens": round(output / calls, 1) if calls else 0.0
+            }
+        return stats
+
+
+PROMPTS = PromptRegistry()
@@ -0,0 +1,484 @@
+import asyncio
+import contextlib
+import contextvars
+import hmac
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import REGISTRY
+from shared_state import WORKERS, shared_path
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Rate limit settings
+RATE_LIMITS = os.getenv('RATE_LIMITS', 'on') == 'on'
+# name=requests_per_minute/burst; "anonymous" applies per client IP when no API key is sent, 0 = unlimited
+RATE_LIMIT_TIERS = os.getenv('RATE_LIMIT_TIERS', 'anonymous=30/10,standard=300/60,partner=3000/300,internal=0')
+# name:key:tier entries, comma-separated; clients send the key as X-API-Key
+RATE_LIMIT_KEYS = os.getenv('RATE_LIMIT_KEYS', '')
+# Per end user (chat userName or X-User-Id) within whichever client sent the request
+RATE_LIMIT_USER = os.getenv('RATE_LIMIT_USER', '12/6')
+# Bucket tokens taken per request; a batch is charged up front since its image count isn't known yet.
+# A pre-validation decodes the upload on the image pool but never calls Gemini, so it costs less than an analysis
+RATE_LIMIT_COSTS = {'chat': 1, 'prevalidate': 1, 'image': 2, 'batch': 10}
+# Proxies in front of us that append to X-Forwarded-For (0 = use the socket peer address)
+RATE_LIMIT_TRUSTED_PROXIES = int(os.getenv('RATE_LIMIT_TRUSTED_PROXIES', '0'))
+# Idle buckets are dropped every sweep; beyond max keys the least recently used go first
+RATE_LIMIT_SWEEP_SECONDS = float(os.getenv('RATE_LIMIT_SWEEP_SECONDS', '60'))
+RATE_LIMIT_MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', '100000'))
+# Per-client call/token totals: SQLite file shared by workers (empty = this process only, lost on restart)
+USAGE_DB = os.getenv('USAGE_DB', shared_path('usage.sqlite3'))
+USAGE_FLUSH_SECONDS = float(os.getenv('USAGE_FLUSH_SECONDS', '10'))
+USAGE_RETENTION = float(os.getenv('USAGE_RETENTION', str(30 * 86400)))
+USAGE_MAX_CLIENTS = int(os.getenv('USAGE_MAX_CLIENTS', '10000'))
+# GET /admin/usage needs X-Admin-Key with this value (unset = endpoint disabled)
+ADMIN_API_KEY = os.getenv('ADMIN_API_KEY', '')
+
+# userName the chat model defaults to: shared by every anonymous user, so not a user identity
+ANONYMOUS_USER_NAMES = ('', 'Farmer')
+
+LIMITED_ROUTES = {
+    '/api/chat': 'chat',
+    '/api/chat/stream': 'chat',
+    '/api/disease-detection': 'image',
+    '/api/soil-analysis': 'image',
+    '/api/prevalidate': 'prevalidate',
+    '/api/jobs/disease-detection': 'image',
+    '/api/jobs/soil-analysis': 'image',
+    '/api/disease-detection/batch': 'batch',
+    '/api/soil-analysis/batch': 'batch',
+}
+# Bodies we read for the userName; bigger ones are passed through unread
+MAX_USER_BODY = 64 * 1024
+
+RATE_LIMITED = REGISTRY.counter('rate_limited_requests', 'Requests refused with 429', ('tier', 'scope'))
+
+_client = contextvars.ContextVar('rate_limit_client', default=None)
+
+
+class RateLimited(Exception):
+    def __init__(self, message, retry_after, tier):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.tier = tier
+
+
+class InvalidApiKey(Exception):
+    pass
+
+
+def _parse_rate(spec):
+    # "30/10" -> (per_minute, burst); "0" -> unlimited
+    per_minute, _, burst = spec.partition('/')
+    per_minute = float(per_minute)
+    return per_minute, int(burst or max(1, per_minute / 6))
+
+
+def parse_tiers(spec):
+    tiers = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, rate = entry.partition('=')
+        tiers[name.strip()] = _parse_rate(rate.strip())
+    tiers.setdefault('anonymous', _parse_rate('30/10'))
+    return tiers
+
+
+def parse_keys(spec, tiers):
+    keys = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        name, key, tier = entry.split(':', 2)
+        if tier not in tiers:
+            raise ValueError(f"API key {name!r} uses unknown tier {tier!r}")
+        keys[key] = (name, tier)
+    return keys
+
+
+def current_client():
+    """
+    Client (key:<name> or ip:<address>) the current request is accounted to
+    """
+    return _client.get()
+
+
+@contextlib.contextmanager
+def accounted_to(client):
+    """
+    Make client current for accounting outside its request (a queued job's Gemini calls)
+    """
+    token = _client.set(client)
+    try:
+        yield
+    finally:
+        _client.reset(token)
+
+
+def client_ip(scope, trusted_proxies=RATE_LIMIT_TRUSTED_PROXIES):
+    if trusted_proxies:
+        forwarded = dict(scope.get('headers') or []).get(b'x-forwarded-for', b'').decode('latin-1')
+        hops = [hop.strip() for hop in forwarded.split(',') if hop.strip()]
+        if len(hops) >= trusted_proxies:
+            return hops[-trusted_proxies]
+    client = scope.get('client')
+    return client[0] if client else 'unknown'
+
+
+class RateLimiter:
+    """
+    GCRA (the token bucket expressed as a single timestamp): each bucket is
+    one float, the theoretical arrival time, so a check is a dict lookup and
+    a compare. A bucket whose TAT has passed is full, which is the same as
+    not existing, so the sweep simply drops those.
+
+    Limits are per process: with several workers each gets its share of the
+    rate, which holds as long as connections spread evenly between them.
+    """
+
+    def __init__(self, tiers=None, keys=None, user_rate=RATE_LIMIT_USER, workers=WORKERS,
+                 max_keys=RATE_LIMIT_MAX_KEYS, enabled=RATE_LIMITS):
+        self.tiers = tiers if tiers is not None else parse_tiers(RATE_LIMIT_TIERS)
+        self.keys = keys if keys is not None else parse_keys(RATE_LIMIT_KEYS, self.tiers)
+        self.user_rate = _parse_rate(user_rate)
+        self.workers = max(1, workers)
+        self.max_keys = max_keys
+        self.enabled = enabled
+        self._tat = OrderedDict()
+        self._lock = threading.Lock()
+        self._sweep_task = None
+        self.allowed = 0
+        self.limited = 0
+        self.evicted = 0
+
+    def _limit(self, rate):
+        # (seconds per token, burst) for this worker's share, or None when unlimited
+        per_minute, burst = rate
+        if per_minute <= 0:
+            return None
+        return 60.0 * self.workers / per_minute, max(1, burst // self.workers)
+
+    def identify(self, scope):
+        """
+        (client, tier) from X-API-Key, else the caller's IP; InvalidApiKey for unknown keys
+        """
+        key = dict(scope.get('headers') or []).get(b'x-api-key')
+        if key is None:
+            return f"ip:{client_ip(scope)}", 'anonymous'
+        key = key.decode('latin-1')
+        for known, (name, tier) in self.keys.items():
+            if hmac.compare_digest(known, key):
+                return f"key:{name}", tier
+        raise InvalidApiKey("unknown API key")
+
+    def _take(self, buckets):
+        # All or nothing: a refused request uses no tokens from any of its buckets.
+        # Returns (seconds until the request would fit, the bucket that refused it)
+        now = time.monotonic()
+        updates = []
+        retry_after, refused = 0.0, None
+        with self._lock:
+            for key, (interval, burst), cost in buckets:
+                tat = max(self._tat.get(key, now), now)
+                new_tat = tat + interval * min(cost, burst)
+                wait = new_tat - interval * burst - now
+                if wait > retry_after:
+                    retry_after, refused = wait, key
+                updates.append((key, new_tat))
+            if refused is not None:
+                return retry_after, refused
+            for key, new_tat in updates:
+                self._tat[key] = new_tat
+                self._tat.move_to_end(key)
+            while len(self._tat) > self.max_keys:
+                self._tat.popitem(last=False)
+                self.evicted += 1
+        return 0.0, None
+
+    def hit(self, scope, cost=1, user=None):
+        """
+        Charge cost to the client's bucket (and the end user's, if known) and make
+        the client current for accounting; raises RateLimited or InvalidApiKey
+        """
+        client, tier = self.identify(scope)
+        _client.set(client)
+        buckets = []
+        client_limit = self._limit(self.tiers[tier])
+        if client_limit is not None:
+            buckets.append((client, client_limit, cost))
+        user_limit = self._limit(self.user_rate)
+        if user and user not in ANONYMOUS_USER_NAMES and user_limit is not None:
+            buckets.append((f"user:{client}/{user[:64]}", user_limit, cost))
+
+        if self.enabled and buckets:
+            retry_after, refused = self._take(buckets)
+            if refused is not None:
+                self.limited += 1
+                RATE_LIMITED.inc(tier=tier, scope='client' if refused == client else 'user')
+                usage.record_request(client, tier, limited=True)
+                who = f"{client} over the {tier}" if refused == client else f"user {user!r} of {client} over the user"
+                raise RateLimited(f"{who} rate limit", retry_after, tier)
+        self.allowed += 1
+        usage.record_request(client, tier)
+        return client
+
+    def sweep(self):
+        """
+        Drop buckets that have refilled completely
+        """
+        now = time.monotonic()
+        with self._lock:
+            idle = [key for key, tat in self._tat.items() if tat <= now]
+            for key in idle:
+                del self._tat[key]
+        return len(idle)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(RATE_LIMIT_SWEEP_SECONDS)
+            dropped = self.sweep()
+            if dropped:
+                logger.debug(f"🧹 Dropped {dropped} idle rate limit buckets")
+
+    def start(self):
+        if self._sweep_task is None:
+            self._sweep_task = asyncio.get_running_loop().create_task(self._sweep_loop())
+
+    def stop(self):
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+            self._sweep_task = None
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "tiers": {name: {"per_minute": rate[0], "burst": rate[1]} for name, rate in self.tiers.items()},
+            "api_keys": len(self.keys),
+            "buckets": len(self._tat),
+            "allowed": self.allowed,
+            "limited": self.limited,
+            "evicted": self.evicted
+        }
+
+
+USAGE_FIELDS = ('requests', 'limited', 'calls', 'prompt_tokens', 'cached_tokens', 'output_tokens')
+
+
+class UsageLedger:
+    """
+    Requests and Gemini calls/tokens per client. Counts build up in memory;
+    with a USAGE_DB they are added to its totals every flush, so every worker
+    contributes to the same table and nothing is lost on restart.
+    """
+
+    def __init__(self, path=USAGE_DB, max_clients=USAGE_MAX_CLIENTS):
+        self.path = path
+        self.max_clients = max_clients
+        # client -> [tier, requests, limited, calls, prompt, cached, output, last_seen]
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._flush_task = None
+
+    def _entry(self, client, tier=None):
+        entry = self._pending.get(client)
+        if entry is None:
+            entry = self._pending[client] = [tier, 0, 0, 0, 0, 0, 0, 0.0]
+            if not self.path:
+                while len(self._pending) > self.max_clients:
+                    self._pending.popitem(last=False)
+        else:
+            self._pending.move_to_end(client)
+        if tier is not None:
+            entry[0] = tier
+        entry[7] = time.time()
+        return entry
+
+    def record_request(self, client, tier, limited=False):
+        with self._lock:
+            entry = self._entry(client, tier)
+            entry[1] += 1
+            entry[2] += limited
+
+    def record_call(self, prompt, cached, output):
+        """
+        Gemini usage for the current request's or job's client (ignored outside either)
+        """
+        client = current_client()
+        if client is None:
+            return
+        with self._lock:
+            entry = self._entry(client)
+            entry[3] += 1
+            entry[4] += prompt
+            entry[5] += cached
+            entry[6] += output
+
+    def _db(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "client TEXT PRIMARY KEY, tier TEXT, requests INTEGER NOT NULL DEFAULT 0, "
+                "limited INTEGER NOT NULL DEFAULT 0, calls INTEGER NOT NULL DEFAULT 0, "
+                "prompt_tokens INTEGER NOT NULL DEFAULT 0, cached_tokens INTEGER NOT NULL DEFAULT 0, "
+                "output_tokens INTEGER NOT NULL DEFAULT 0, last_seen REAL NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def flush(self):
+        """
+        Add pending counts to the shared totals (no-op without a USAGE_DB)
+        """
+        if not self.path:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+            if not pending:
+                return
+            conn = self._db()
+            conn.executemany(
+                "INSERT INTO usage (client, tier, requests, limited, calls, prompt_tokens, cached_tokens, "
+                "output_tokens, last_seen) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(client) DO UPDATE SET tier = COALESCE(excluded.tier, tier), "
+                "requests = requests + excluded.requests, limited = limited + excluded.limited, "
+                "calls = calls + excluded.calls, prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "cached_tokens = cached_tokens + excluded.cached_tokens, "
+                "output_tokens = output_tokens + excluded.output_tokens, "
+                "last_seen = MAX(last_seen, excluded.last_seen)",
+                [(client, *entry) for client, entry in pending.items()]
+            )
+            conn.execute("DELETE FROM usage WHERE last_seen < ?", (time.time() - USAGE_RETENTION,))
+            conn.commit()
+
+    def report(self, limit=50, sort='prompt_tokens'):
+        """
+        Clients with the highest totals, largest first
+        """
+        if sort not in USAGE_FIELDS:
+            raise ValueError(f"can't sort by {sort!r}")
+        self.flush()
+        if self.path:
+            with self._lock:
+                rows = self._db().execute(
+                    f"SELECT client, tier, {', '.join(USAGE_FIELDS)}, last_seen FROM usage "
+                    f"ORDER BY {sort} DESC LIMIT ?", (limit,)
+                ).fetchall()
+        else:
+            with self._lock:
+                rows = [(client, *entry) for client, entry in self._pending.items()]
+            rows = sorted(rows, key=lambda row: row[2 + USAGE_FIELDS.index(sort)], reverse=True)[:limit]
+        return [
+            dict(client=row[0], tier=row[1], last_seen=round(row[-1], 3), **dict(zip(USAGE_FIELDS, row[2:-1])))
+            for row in rows
+        ]
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_SECONDS)
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                logger.warning(f"⚠️ Usage flush failed: {e}")
+
+    def start(self):
+        if self.path and self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    def stop(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        try:
+            self.flush()
+        except Exception as e:
+            logger.warning(f"⚠️ Usage flush failed: {e}")
+
+    def stats(self):
+        return {"clients_pending": len(self._pending), "shared": bool(self.path)}
+
+
+def check_admin_key(key):
+    return bool(ADMIN_API_KEY) and key is not None and hmac.compare_digest(ADMIN_API_KEY, key)
+
+
+async def _send_json(send, status, content, headers=()):
+    body = json.dumps(content).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode()), *headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+RATE_LIMITED_REPLY = "You're sending requests faster than we can answer them. Please wait a moment and try again!"
+
+
+class RateLimitMiddleware:
+    """
+    ASGI middleware: 429 with Retry-After before a limited route does any work.
+    Chat bodies are small, so they are read here for the userName and replayed.
+    """
+
+    def __init__(self, app, limiter=None):
+        self.app = app
+        self.limiter = limiter or rate_limiter
+
+    async def __call__(self, scope, receive, send):
+        kind = LIMITED_ROUTES.get(scope['path']) if scope['type'] == 'http' else None
+        if kind is None or scope['method'] != 'POST':
+            await self.app(scope, receive, send)
+            return
+
+        user = dict(scope['headers']).get(b'x-user-id', b'').decode('latin-1') or None
+        if kind == 'chat' and user is None:
+            receive, user = await self._peek_user(receive)
+
+        try:
+            self.limiter.hit(scope, RATE_LIMIT_COSTS[kind], user)
+        except InvalidApiKey as e:
+            await _send_json(send, 401, {"success": False, "error": str(e)})
+            return
+        except RateLimited as e:
+            logger.warning(f"🚧 {e} (retry after {e.retry_after}s)")
+            await _send_json(send, 429, {"success": False, "reply": RATE_LIMITED_REPLY,
+                                         "error": "rate limit exceeded", "retry_after": e.retry_after},
+                             [(b'retry-after', str(e.retry_after).encode())])
+            return
+        await self.app(scope, receive, send)
+
+    async def _peek_user(self, receive):
+        # Returns a receive that replays what was read, and the body's userName if it had one
+        chunks = []
+        message = await receive()
+        while message['type'] == 'http.request':
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body') or sum(map(len, chunks)) > MAX_USER_BODY:
+                break
+            message = await receive()
+
+        user = None
+        if message['type'] == 'http.request':
+            message = dict(message, body=b''.join(chunks))
+            if not message.get('more_body'):
+                try:
+                    user = json.loads(message['body']).get('userName')
+                except (ValueError, AttributeError):
+                    pass
+        pending = [message]
+
+        async def replay():
+            return pending.pop() if pending else await receive()
+
+        return replay, user if isinstance(user, str) else None
+
+
+rate_limiter = RateLimiter()
+usage = UsageLedger()
@@ -0,0 +1,241 @@
+import contextvars
+import json
+import os
+import zlib
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+from starlette.datastructures import MutableHeaders
+
+from metrics import REGISTRY
+
+try:
+    import orjson
+except ImportError:  # optional: ~3-5x faster dumps
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only without it
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:  # optional: application/msgpack not offered without it
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:  # optional: application/cbor not offered without it
+    cbor2 = None
+
+# ⚙️ Response encoding settings
+# gzip/brotli for clients that send Accept-Encoding (most mobile HTTP stacks do)
+RESPONSE_COMPRESSION = os.getenv('RESPONSE_COMPRESSION', 'on') == 'on'
+# Bodies smaller than this go out as they are: the framing overhead would eat the saving
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', '512'))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', '6'))
+# 0-11; 4-5 compresses better than gzip -6 at similar speed, 11 is far too slow per request
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', '5'))
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'application/msgpack', 'application/cbor', 'text/')
+# Streamed bodies of these types are compressed chunk by chunk, each chunk flushed so lines arrive as
+# they're produced; others (Server-Sent Events) pass through, since proxies and EventSource handle them badly
+STREAMING_TYPES = ('application/x-ndjson',)
+
+COMPACT_ENCODERS = {}
+if msgpack is not None:
+    COMPACT_ENCODERS['application/msgpack'] = msgpack.packb
+    COMPACT_ENCODERS['application/x-msgpack'] = msgpack.packb
+if cbor2 is not None:
+    COMPACT_ENCODERS['application/cbor'] = cbor2.dumps
+
+RESPONSE_BYTES = REGISTRY.counter('response_body_bytes', 'Response body bytes before and after compression',
+                                  ('encoding', 'stage'))
+
+_accept = contextvars.ContextVar('response_accept', default='')
+
+# Default response class: orjson when installed (same output, several times faster)
+FastJSONResponse = ORJSONResponse if orjson is not None else JSONResponse
+
+
+def dumps(content):
+    """
+    Compact JSON text (for NDJSON lines and SSE events)
+    """
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode()
+    return json.dumps(content, ensure_ascii=False, separators=(',', ':'))
+
+
+def preferences(header):
+    """
+    {value: q} from an Accept or Accept-Encoding header
+    """
+    prefs = {}
+    for part in header.split(','):
+        value, *params = part.split(';')
+        value = value.strip().lower()
+        if not value:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, number = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(number)
+                except ValueError:
+                    q = 0.0
+        prefs[value] = q
+    return prefs
+
+
+def compact_media_type(accept):
+    """
+    MessagePack/CBOR type the client prefers over JSON, or None
+    """
+    prefs = preferences(accept)
+    json_q = prefs.get('application/json', 0.0)
+    best, best_q = None, json_q
+    for media_type in COMPACT_ENCODERS:
+        q = prefs.get(media_type, 0.0)
+        if q > best_q:
+            best, best_q = media_type, q
+    return best
+
+
+def content_coding(accept_encoding):
+    """
+    'br' or 'gzip' per Accept-Encoding (brotli wins ties), or None
+    """
+    prefs = preferences(accept_encoding)
+    best, best_q = None, 0.0
+    for coding in ('br', 'gzip'):
+        if coding == 'br' and brotli is None:
+            continue
+        q = prefs.get(coding, prefs.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class CompactResponse(FastJSONResponse):
+    """
+    JSON, or MessagePack/CBOR when the request's Accept prefers one of them
+    (for the image-analysis results mobile clients fetch over slow links)
+    """
+
+    def __init__(self, content, *args, **kwargs):
+        media_type = compact_media_type(_accept.get())
+        if media_type is not None:
+            self.media_type = media_type
+        super().__init__(content, *args, **kwargs)
+        self.headers.add_vary_header('Accept')
+
+    def render(self, content):
+        encoder = COMPACT_ENCODERS.get(self.media_type)
+        if encoder is None:
+            return super().render(content)
+        return encoder(content)
+
+
+class _Compressor:
+    def __init__(self, coding):
+        self.coding = coding
+        if coding == 'br':
+            self._brotli = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._zlib = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data, last):
+        # Non-final chunks are flushed so the client can decode everything sent so far
+        if self.coding == 'br':
+            out = self._brotli.process(data)
+            return out + (self._brotli.finish() if last else self._brotli.flush())
+        out = self._zlib.compress(data)
+        return out + self._zlib.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware: gzip/brotli per Accept-Encoding for JSON-like bodies over
+    COMPRESS_MIN_BYTES, and the request's Accept for CompactResponse routes
+    """
+
+    def __init__(self, app, enabled=RESPONSE_COMPRESSION, min_bytes=COMPRESS_MIN_BYTES):
+        self.app = app
+        self.enabled = enabled
+        self.min_bytes = min_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope['headers'])
+        token = _accept.set(headers.get(b'accept', b'').decode('latin-1'))
+        coding = content_coding(headers.get(b'accept-encoding', b'').decode('latin-1')) if self.enabled else None
+        try:
+            if coding is None:
+                await self.app(scope, receive, send)
+            else:
+                await self.app(scope, receive, self._compressing_send(send, coding))
+        finally:
+            _accept.reset(token)
+
+    def _compressing_send(self, send, coding):
+        start = None
+        compressor = None
+
+        async def compressing_send(message):
+            nonlocal start, compressor
+            if message['type'] == 'http.response.start':
+                start = message
+                return
+            if message['type'] != 'http.response.body':
+                await send(message)
+                return
+
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if start is not None:
+                # First body chunk: decide now, while the headers can still change
+                response_headers = MutableHeaders(raw=start['headers'])
+                if self._should_compress(response_headers, body, more_body):
+                    compressor = _Compressor(coding)
+                    response_headers['Content-Encoding'] = coding
+                    response_headers.add_vary_header('Accept-Encoding')
+                    if more_body:
+                        del response_headers['Content-Length']
+                    else:
+                        compressed = compressor.compress(body, True)
+                        self._count(coding, len(body), len(compressed))
+                        response_headers['Content-Length'] = str(len(compressed))
+                        await send(start)
+                        start = None
+                        await send({'type': 'http.response.body', 'body': compressed})
+                        return
+                await send(start)
+                start = None
+
+            if compressor is None:
+                await send(message)
+                return
+            compressed = compressor.compress(body, not more_body)
+            self._count(coding, len(body), len(compressed))
+            await send({'type': 'http.response.body', 'body': compressed, 'more_body': more_body})
+
+        return compressing_send
+
+    def _should_compress(self, headers, body, more_body):
+        if 'content-encoding' in headers:
+            return False
+        content_type = headers.get('content-type', '').split(';')[0].strip().lower()
+        if not content_type.startswith(COMPRESSIBLE_TYPES):
+            return False
+        if more_body:
+            return content_type in STREAMING_TYPES
+        return len(body) >= self.min_bytes
+
+    def _count(self, coding, raw, sent):
+        RESPONSE_BYTES.inc(raw, encoding=coding, stage='raw')
+        RESPONSE_BYTES.inc(sent, encoding=coding, stage='sent')
@@ -0,0 +1,298 @@
+import json
+import logging
+import os
+import time
+
+from metrics import PARSE_FAILURES, REGISTRY
+
+try:
+    import orjson
+except ImportError:  # optional: ~3-5x faster loads, same results
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Structured output settings
+# Ask Gemini for application/json with a response_schema instead of free text
+JSON_MODE = os.getenv('GEMINI_JSON_MODE', 'on').lower() in ('1', 'on', 'true', 'yes')
+# Try to recover usable fields from truncated or slightly malformed JSON before giving up
+SALVAGE = os.getenv('GEMINI_JSON_SALVAGE', 'on').lower() in ('1', 'on', 'true', 'yes')
+# Set on objects recovered from a truncated reply: usable once, but their defaulted fields mustn't be cached
+SALVAGED = '_salvaged'
+
+PARSE_SECONDS = REGISTRY.histogram(
+    'parse_duration_seconds', 'Time to parse and validate a Gemini reply', ('service',),
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05))
+PARSE_OUTCOMES = REGISTRY.counter('parse_outcomes', 'Gemini replies by parse outcome', ('service', 'outcome'))
+
+
+def loads(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def extract_json(text):
+    """
+    The JSON object/array inside a reply, without markdown fences or surrounding prose (one pass, no split)
+    """
+    starts = [i for i in (text.find('{'), text.find('[')) if i != -1]
+    if not starts:
+        return text.strip()
+    body = text[min(starts):]
+    fence = body.find('```')
+    if fence != -1:
+        body = body[:fence]
+    body = body.rstrip()
+    end = max(body.rfind('}'), body.rfind(']'))
+    tail = body[end + 1:]
+    # Prose after the last bracket is dropped; JSON-looking leftovers mean a truncated reply, kept for salvage
+    if end != -1 and not any(ch in tail for ch in '":,'):
+        return body[:end + 1]
+    return body
+
+
+def repair_json(text):
+    """
+    Candidates for closing truncated JSON: the whole text with its open strings and
+    brackets closed, then the text cut back to the last complete member
+    """
+    stack = []
+    in_string = False
+    escaped = False
+    safe_end = 0
+    safe_stack = []
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch == '{' or ch == '[':
+            stack.append('}' if ch == '{' else ']')
+        elif ch == '}' or ch == ']':
+            if stack:
+                stack.pop()
+            if not stack:
+                return [text[:i + 1]]
+            safe_end, safe_stack = i + 1, list(stack)
+        elif ch == ',':
+            safe_end, safe_stack = i, list(stack)
+
+    candidates = []
+    body = text.rstrip()
+    if in_string:
+        body += '"'
+    if body.endswith((',', ':')):
+        body = body[:-1]
+    candidates.append(body + ''.join(reversed(stack)))
+    if safe_end:
+        candidates.append(text[:safe_end] + ''.join(reversed(safe_stack)))
+    return candidates
+
+
+def _string(default):
+    def coerce(value):
+        if value is None:
+            return default
+        return value if isinstance(value, str) else str(value)
+    return coerce
+
+
+def _number(default, low=None, high=None):
+    def coerce(value):
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return default
+        if number != number:  # NaN
+            return default
+        if low is not None and number < low:
+            number = low
+        if high is not None and number > high:
+            number = high
+        return number
+    return coerce
+
+
+def _boolean(default):
+    def coerce(value):
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str):
+            return value.strip().lower() in ('true', 'yes', '1')
+        return default if value is None else bool(value)
+    return coerce
+
+
+def _string_list(default):
+    def coerce(value):
+        if isinstance(value, list):
+            return [str(item) for item in value if item is not None]
+        if isinstance(value, str) and value.strip():
+            return [item.strip() for item in value.split(',') if item.strip()]
+        return list(default)
+    return coerce
+
+
+COERCERS = {'string': _string, 'number': _number, 'boolean': _boolean, 'string_list': _string_list}
+GEMINI_TYPES = {
+    'string': {'type': 'string'},
+    'number': {'type': 'number'},
+    'boolean': {'type': 'boolean'},
+    'string_list': {'type': 'array', 'items': {'type': 'string'}},
+}
+
+
+class Schema:
+    """
+    Field types and defaults for one kind of reply, compiled once into per-field
+    coercion functions and the equivalent Gemini response_schema.
+
+    fields: {name: (kind, default) or (kind, default, low, high)} with kind one of
+    string / number / boolean / string_list. complete(data) decides whether a
+    (possibly salvaged) object has enough to be used.
+    """
+
+    def __init__(self, name, fields, required=(), complete=None):
+        self.name = name
+        self.required = tuple(required)
+        self._complete = complete
+        self._coercers = []
+        properties = {}
+        for field, spec in fields.items():
+            kind, default = spec[0], spec[1]
+            bounds = spec[2:]
+            self._coercers.append((field, COERCERS[kind](default, *bounds)))
+            properties[field] = dict(GEMINI_TYPES[kind])
+        self.gemini = {'type': 'object', 'properties': properties, 'required': list(self.required)}
+
+    def complete(self, data):
+        if self._complete is not None:
+            return self._complete(data)
+        return all(field in data for field in self.required)
+
+    def validate(self, data):
+        """
+        Normalized copy of data (every field present, typed, defaulted) or None if unusable
+        """
+        if not isinstance(data, dict) or not self.complete(data):
+            return None
+        return {field: coerce(data.get(field)) for field, coerce in self._coercers}
+
+
+class StructuredParser:
+    """
+    Shared reply parsing for the image analyzers: JSON-mode request options,
+    fence stripping, fast loads, schema validation and salvage of truncated JSON
+    """
+
+    def __init__(self, service, schema):
+        self.service = service
+        self.schema = schema
+        self.parsed = 0
+        self.salvaged = 0
+        self.failed = 0
+        self.seconds = 0.0
+
+    def request_options(self, count=1):
+        """
+        generate_content kwargs asking for JSON that matches the schema (one object, or an array of count)
+        """
+        if not JSON_MODE:
+            return {}
+        schema = self.schema.gemini if count == 1 else {'type': 'array', 'items': self.schema.gemini}
+        return {'generation_config': {'response_mime_type': 'application/json', 'response_schema': schema}}
+
+    def _load(self, text):
+        """
+        (data, salvaged) or (None, False)
+        """
+        json_text = extract_json(text)
+        try:
+            return loads(json_text), False
+        except ValueError:
+            if not SALVAGE:
+                return None, False
+        for candidate in repair_json(json_text):
+            try:
+                return loads(candidate), True
+            except ValueError:
+                continue
+        return None, False
+
+    def _record(self, start, outcome):
+        elapsed = time.perf_counter() - start
+        self.seconds += elapsed
+        PARSE_SECONDS.observe(elapsed, service=self.service)
+        PARSE_OUTCOMES.inc(service=self.service, outcome=outcome)
+        if outcome == 'failed':
+            self.failed += 1
+            PARSE_FAILURES.inc(service=self.service)
+        elif outcome == 'salvaged':
+            self.salvaged += 1
+        else:
+            self.parsed += 1
+
+    def parse_one(self, text):
+        """
+        Validated object from a single-image reply, or None
+        """
+        start = time.perf_counter()
+        data, salvaged = self._load(text or '')
+        if isinstance(data, list) and len(data) == 1:
+            data = data[0]
+        result = self.schema.validate(data)
+        if result is None:
+            logger.error(f"❌ Unparseable {self.service} reply: {(text or '')[:200]}")
+            self._record(start, 'failed')
+            return None
+        if salvaged:
+            logger.warning(f"🩹 Salvaged truncated {self.service} reply")
+            result[SALVAGED] = True
+        self._record(start, 'salvaged' if salvaged else 'ok')
+        return result
+
+    def parse_many(self, text, expected):
+        """
+        Multi-image reply -> list of `expected` validated objects, None for items
+        that are missing or unusable; None if nothing could be used
+        """
+        start = time.perf_counter()
+        data, salvaged = self._load(text or '')
+        if isinstance(data, dict):
+            data = [data]
+        if not isinstance(data, list):
+            logger.error(f"❌ Unparseable multi-image {self.service} reply: {(text or '')[:200]}")
+            self._record(start, 'failed')
+            return None
+        if len(data) != expected:
+            logger.warning(f"⚠️ Expected {expected} {self.service} results, got {len(data)}")
+        items = [self.schema.validate(item) for item in data[:expected]]
+        if salvaged and len(data) <= expected and items[-1] is not None:
+            # Only the object the reply was cut off in was repaired; the ones before it are complete
+            items[-1][SALVAGED] = True
+        items += [None] * (expected - len(items))
+        usable = sum(item is not None for item in items)
+        if not usable:
+            self._record(start, 'failed')
+            return None
+        self._record(start, 'salvaged' if salvaged or usable < expected else 'ok')
+        return items
+
+    def stats(self):
+        total = self.parsed + self.salvaged + self.failed
+        return {
+            "parser": "orjson" if orjson is not None else "json",
+            "json_mode": JSON_MODE,
+            "parsed": self.parsed,
+            "salvaged": self.salvaged,
+            "failed": self.failed,
+            "failure_rate": round(self.failed / total, 4) if total else 0.0,
+            "avg_parse_us": round(self.seconds / total * 1e6, 1) if total else 0.0
+        }
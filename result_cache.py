@@ -0,0 +1,239 @@
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import CACHE_LOOKUPS
+from shared_state import shared_path
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Cache settings
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', '512'))
+RESULT_CACHE_TTL = float(os.getenv('RESULT_CACHE_TTL', '86400'))
+# Optional on-disk tier, e.g. RESULT_CACHE_DB=data/result_cache.sqlite3 (unset = memory only,
+# or a file in SHARED_STATE_DIR when running several workers so they share results)
+RESULT_CACHE_DB = os.getenv('RESULT_CACHE_DB', shared_path('result_cache.sqlite3'))
+
+
+def image_digest(image):
+    """
+    SHA-256 of the normalized image: encoded bytes are hashed as-is,
+    PIL images are hashed over their RGB pixels and size
+    """
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(image).hexdigest()
+
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    digest = hashlib.sha256(f"{image.width}x{image.height}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def make_key(image, prompt_version, model_name):
+    """
+    Content-addressed cache key: image hash + prompt version + model name
+    """
+    return f"{model_name}:{prompt_version}:{image_digest(image)}"
+
+
+class DiskTier:
+    """
+    SQLite-backed second tier that survives restarts
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < time.time():
+                self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires_at)
+            )
+            self._conn.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def items(self, prefix):
+        """
+        Unexpired (key, value) pairs whose key starts with prefix
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, value FROM results WHERE key >= ? AND key < ? AND expires_at >= ?",
+                (prefix, prefix + '\uffff', time.time())
+            ).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def purge_expired(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM results WHERE expires_at < ?", (time.time(),))
+            self._conn.commit()
+
+
+class ResultCache:
+    """
+    Two-tier cache for image analysis results: in-memory LRU with TTL,
+    optionally backed by a SQLite file
+    """
+
+    def __init__(self, name, max_entries=RESULT_CACHE_SIZE, ttl_seconds=RESULT_CACHE_TTL, disk_path=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.disk = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if disk_path:
+            try:
+                self.disk = DiskTier(disk_path)
+                self.disk.purge_expired()
+                logger.info(f"💾 {name} result cache persisted to {disk_path}")
+            except Exception as e:
+                logger.warning(f"⚠️ Disk cache unavailable ({disk_path}): {e}")
+                self.disk = None
+
+    def _remember(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _get_memory(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] >= now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    CACHE_LOOKUPS.inc(cache=self.name, result='hit')
+                    return copy.deepcopy(entry[1])
+                del self._entries[key]
+        return None
+
+    def _get_disk(self, key):
+        try:
+            return self.disk.get(key)
+        except Exception as e:
+            logger.warning(f"⚠️ Disk cache read failed: {e}")
+            return None
+
+    def _found(self, key, stored):
+        if stored is None:
+            self.misses += 1
+            CACHE_LOOKUPS.inc(cache=self.name, result='miss')
+            return None
+        value, expires_at = stored
+        self._remember(key, value, expires_at)
+        self.hits += 1
+        self.disk_hits += 1
+        CACHE_LOOKUPS.inc(cache=self.name, result='disk_hit')
+        return copy.deepcopy(value)
+
+    def get(self, key):
+        key = f"{self.name}:{key}"
+        value = self._get_memory(key, time.time())
+        if value is not None:
+            return value
+        return self._found(key, self._get_disk(key) if self.disk is not None else None)
+
+    async def get_async(self, key):
+        """
+        get() for the event loop: the memory tier inline, the SQLite tier on a thread
+        """
+        key = f"{self.name}:{key}"
+        value = self._get_memory(key, time.time())
+        if value is not None:
+            return value
+        stored = await asyncio.to_thread(self._get_disk, key) if self.disk is not None else None
+        return self._found(key, stored)
+
+    def _set_memory(self, key, value):
+        key = f"{self.name}:{key}"
+        expires_at = time.time() + self.ttl_seconds
+        value = copy.deepcopy(value)
+        self._remember(key, value, expires_at)
+        return key, value, expires_at
+
+    def _set_disk(self, key, value, expires_at):
+        try:
+            self.disk.set(key, value, expires_at)
+        except Exception as e:
+            logger.warning(f"⚠️ Disk cache write failed: {e}")
+
+    def set(self, key, value):
+        """
+        Store a successfully parsed result (never call this with fallback results)
+        """
+        stored = self._set_memory(key, value)
+        if self.disk is not None:
+            self._set_disk(*stored)
+
+    def set_behind(self, key, value):
+        """
+        set() for the event loop: memory now, the SQLite write behind it on a thread
+        (the memory tier answers repeat lookups until it lands)
+        """
+        stored = self._set_memory(key, value)
+        if self.disk is not None:
+            asyncio.get_running_loop().run_in_executor(None, self._set_disk, *stored)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "disk": self.disk is not None,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+def cache_from_env(name):
+    return ResultCache(name, disk_path=RESULT_CACHE_DB or None)
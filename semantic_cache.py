@@ -0,0 +1,405 @@
+import asyncio
+import difflib
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from metrics import CACHE_LOOKUPS, REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Semantic chat cache settings
+# Cosine similarity above which a stored answer is reused (0 disables the cache)
+CHAT_CACHE_THRESHOLD = float(os.getenv('CHAT_CACHE_THRESHOLD', '0.86'))
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv('CHAT_CACHE_MAX_ENTRIES', '5000'))
+CHAT_CACHE_TTL = float(os.getenv('CHAT_CACHE_TTL', str(7 * 86400)))
+# Snapshot file (vectors + answers), reloaded on start-up; empty = memory only. With several
+# workers every one loads it but only the one holding its lock file writes it
+CHAT_CACHE_PATH = os.getenv('CHAT_CACHE_PATH', 'data/chat_cache.npz')
+# Snapshot after this many new answers (and on shutdown)
+CHAT_CACHE_SAVE_EVERY = int(os.getenv('CHAT_CACHE_SAVE_EVERY', '50'))
+
+# Hashed feature space; bump VECTORIZER_VERSION whenever features() changes so old snapshots are ignored
+DIMENSIONS = 1024
+VECTORIZER_VERSION = 1
+NAME_PLACEHOLDER = '\x00user\x00'
+# Default and generic names are ordinary words in replies ("Farmers should rotate..."), never replaced
+GENERIC_NAMES = frozenset(('farmer', 'user', 'guest', 'friend', 'anonymous'))
+
+# Words that carry no meaning for matching (negations and numbers are deliberately kept)
+STOPWORDS = frozenset("""
+a an the i me my we our you your he she it its they them this that these those is are was were be been
+am do does did doing have has had of in on at to for from by with about into over under and or but so
+if then than can could should would will shall may might must please tell explain know want need give
+what which who whom how why when where any some there here just also very really kindly sir madam ji
+""".split())
+
+# A question with one of these and one without ask opposite things, however alike their vectors are
+NEGATIONS = frozenset("""
+not no never nor without cannot cant dont doesnt didnt shouldnt wont wouldnt isnt arent neither
+""".split())
+# Two differing content words this alike (difflib ratio) are one word misspelled, not two different words
+TYPO_SIMILARITY = 0.8
+
+LOOKUP_SECONDS = REGISTRY.histogram(
+    'chat_cache_lookup_seconds', 'Semantic chat cache lookup time',
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05))
+SIMILARITY = REGISTRY.histogram(
+    'chat_cache_similarity', 'Best cosine similarity per chat cache lookup',
+    buckets=(0.5, 0.6, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95, 0.98, 1.0))
+
+_NON_WORD = re.compile(r"[^\w]+")
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+
+def normalize(text):
+    return ' '.join(_NON_WORD.sub(' ', text.lower().replace("'", '')).split())
+
+
+# Spelling variants and irregular forms folded together before stemming
+SYNONYMS = {
+    'leaves': 'leaf', 'leafs': 'leaf', 'paddy': 'rice', 'fertiliser': 'fertilizer', 'fertilisers': 'fertilizer',
+    'insects': 'pest', 'insect': 'pest', 'pests': 'pest', 'sowing': 'sow', 'sown': 'sow', 'plantation': 'plant',
+}
+# (suffix, replacement), first match wins: "treatment" -> "treat", "irrigation" -> "irrigat", "tomatoes" -> "tomato"
+SUFFIXES = (('ically', 'ic'), ('ation', 'at'), ('ment', ''), ('ing', ''), ('ies', 'y'), ('es', ''),
+            ('ed', ''), ('ly', ''), ('s', ''), ('e', ''))
+
+
+def _stem(word):
+    word = SYNONYMS.get(word, word)
+    for suffix, replacement in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)] + replacement
+    return word
+
+
+def content_words(text):
+    """
+    Stemmed words of a question minus stopwords (what its features are built from)
+    """
+    return [_stem(word) for word in normalize(text).split() if word not in STOPWORDS]
+
+
+def features(text):
+    """
+    Weighted hashed features of a normalized question: stemmed content words,
+    word bigrams and character trigrams (the last tolerate typos and inflections)
+    """
+    words = content_words(text)
+    weights = {}
+    for word in words:
+        weights['w:' + word] = weights.get('w:' + word, 0.0) + 1.0
+        padded = f" {word} "
+        for i in range(len(padded) - 2):
+            gram = 'c:' + padded[i:i + 3]
+            weights[gram] = weights.get(gram, 0.0) + 0.3
+    for first, second in zip(words, words[1:]):
+        weights[f"b:{first} {second}"] = weights.get(f"b:{first} {second}", 0.0) + 0.25
+    return weights
+
+
+def embed(text, dimensions=DIMENSIONS):
+    """
+    Unit-length float32 vector via the signed hashing trick (crc32, so stable across processes)
+    """
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for feature, weight in features(text).items():
+        h = zlib.crc32(feature.encode())
+        vector[h % dimensions] += weight if h & 0x80000000 else -weight
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else vector
+
+
+def _misspelled(word, others):
+    return any(difflib.SequenceMatcher(None, word, other).ratio() >= TYPO_SIMILARITY for other in others)
+
+
+def same_question(question, other):
+    """
+    Exact check behind a vector match. Similar vectors aren't enough: "should I (not) apply urea", spraying
+    "before"/"after" the rain and tomato/potato leaves all score above the threshold. So both must be negated
+    or neither, and no content word of one may be replaced by a different one in the other. Words only one
+    of them has ("plants", "turning") and misspellings are tolerated.
+    """
+    words, other_words = set(content_words(question)), set(content_words(other))
+    if bool(words & NEGATIONS) != bool(other_words & NEGATIONS):
+        return False
+    only, other_only = words - other_words, other_words - words
+    replaced = [word for word in only if not _misspelled(word, other_only)]
+    replacements = [word for word in other_only if not _misspelled(word, only)]
+    return not (replaced and replacements)
+
+
+def numbers_in(text):
+    # "2 acres" and "5 acres" look alike to the vectorizer but need different answers
+    return sorted(set(_NUMBER.findall(text)))
+
+
+def depersonalize(reply, user_name):
+    """
+    reply with the asker's name as a placeholder; unchanged for a generic name, or one the reply
+    also uses as a common word ("Rose" asking about rose bushes), since those uses aren't the name
+    """
+    if not user_name or user_name.strip().lower() in GENERIC_NAMES:
+        return reply
+    if user_name != user_name.lower() and re.search(rf"\b{re.escape(user_name.lower())}\b", reply):
+        return reply
+    return re.sub(rf"\b{re.escape(user_name)}\b", NAME_PLACEHOLDER, reply)
+
+
+def personalize(template, user_name):
+    return template.replace(NAME_PLACEHOLDER, user_name or 'Farmer')
+
+
+class SemanticCache:
+    """
+    Answers to previously asked chat questions, found by cosine similarity over
+    hashed n-gram vectors in a flat NumPy matrix (one row per answer; a
+    matrix-vector product scores every entry).
+
+    Answers are stored with the asker's name replaced by a placeholder and
+    re-personalized on every hit. Entries expire after ttl_seconds; when full,
+    the least recently used one is overwritten.
+    """
+
+    def __init__(self, name, threshold=CHAT_CACHE_THRESHOLD, max_entries=CHAT_CACHE_MAX_ENTRIES,
+                 ttl_seconds=CHAT_CACHE_TTL, path=None, save_every=CHAT_CACHE_SAVE_EVERY, shared=False):
+        self.name = name
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.path = path
+        self.save_every = save_every
+        self._lock = threading.Lock()
+        # One snapshot write at a time (background saves and the one on shutdown share the temp file)
+        self._save_lock = threading.Lock()
+        self._saving = None
+        # Rows grow by doubling up to max_entries; _entries and _last_used are parallel to them
+        self._vectors = np.zeros((0, DIMENSIONS), dtype=np.float32)
+        self._last_used = np.zeros(0, dtype=np.float64)
+        self._entries = []
+        self._unsaved = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lookup_seconds = 0.0
+
+        self._writer_lock = None
+        self.writer = bool(path) and (not shared or self._claim_writer())
+
+        if path:
+            self.load()
+
+    def _claim_writer(self):
+        # Workers sharing the snapshot would overwrite each other's entries: one holds the lock and writes
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            handle = open(f"{self.path}.lock", 'w')
+        except OSError as e:
+            logger.warning(f"⚠️ {self.name} cache snapshot lock unavailable: {e}")
+            return False
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            logger.info(f"📂 {self.name} cache snapshot is written by another worker")
+            return False
+        self._writer_lock = handle
+        return True
+
+    @property
+    def enabled(self):
+        return self.threshold > 0 and self.max_entries > 0
+
+    def lookup(self, question, user_name, namespace):
+        """
+        Cached reply for a similar enough question, personalized for user_name, or None
+        """
+        if not self.enabled:
+            return None
+
+        start = time.perf_counter()
+        query = embed(question)
+        numbers = numbers_in(question)
+        now = time.time()
+        with self._lock:
+            count = len(self._entries)
+            match = None
+            best = 0.0
+            if count:
+                scores = self._vectors[:count] @ query
+                # Best candidate first; skip the (rare) ones that fail the exact checks
+                top = min(5, count)
+                candidates = np.argpartition(-scores, top - 1)[:top]
+                for row in candidates[np.argsort(-scores[candidates])]:
+                    score = float(scores[row])
+                    best = max(best, score)
+                    if score < self.threshold:
+                        break
+                    entry = self._entries[row]
+                    if entry['namespace'] == namespace and entry['numbers'] == numbers \
+                            and entry['expires_at'] >= now and same_question(question, entry['question']):
+                        match = (row, entry, score)
+                        break
+            if match is not None:
+                row, entry, score = match
+                self._last_used[row] = now
+                entry['hits'] += 1
+                self.hits += 1
+            else:
+                self.misses += 1
+            elapsed = time.perf_counter() - start
+            self.lookup_seconds += elapsed
+
+        LOOKUP_SECONDS.observe(elapsed)
+        SIMILARITY.observe(best)
+        CACHE_LOOKUPS.inc(cache=self.name, result='hit' if match else 'miss')
+        if match is None:
+            return None
+        logger.info(f"🧭 Semantic cache hit ({score:.2f}): {question[:40]!r} ~ {entry['question'][:40]!r}")
+        return personalize(entry['template'], user_name)
+
+    def add(self, question, user_name, reply, namespace):
+        """
+        Store a successful reply (never a fallback or error message)
+        """
+        if not self.enabled or not reply:
+            return
+
+        vector = embed(question)
+        now = time.time()
+        entry = {
+            'question': question,
+            'template': depersonalize(reply, user_name),
+            'namespace': namespace,
+            'numbers': numbers_in(question),
+            'expires_at': now + self.ttl_seconds,
+            'hits': 0
+        }
+        with self._lock:
+            row = self._free_row(vector, namespace, now)
+            if row == len(self._entries):
+                self._reserve(row + 1)
+                self._entries.append(entry)
+            else:
+                self._entries[row] = entry
+            self._vectors[row] = vector
+            self._last_used[row] = now
+            self._unsaved += 1
+            save = self.writer and self._unsaved >= self.save_every
+        if save:
+            self._save_behind()
+
+    def _save_behind(self):
+        # Called from the event loop: write the snapshot on a thread, one at a time (later adds catch up next time)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        if self._saving is None or self._saving.done():
+            self._saving = loop.run_in_executor(None, self.save)
+
+    def _reserve(self, rows):
+        if rows <= len(self._vectors):
+            return
+        capacity = min(self.max_entries, max(rows, 2 * len(self._vectors), 64))
+        vectors = np.zeros((capacity, DIMENSIONS), dtype=np.float32)
+        vectors[:len(self._vectors)] = self._vectors
+        last_used = np.zeros(capacity, dtype=np.float64)
+        last_used[:len(self._last_used)] = self._last_used
+        self._vectors, self._last_used = vectors, last_used
+
+    def _free_row(self, vector, namespace, now):
+        count = len(self._entries)
+        if count:
+            # Same question asked again: refresh its row rather than storing a twin
+            scores = self._vectors[:count] @ vector
+            row = int(np.argmax(scores))
+            if scores[row] > 0.999 and self._entries[row]['namespace'] == namespace:
+                return row
+        if count < self.max_entries:
+            return count
+        expired = [i for i, entry in enumerate(self._entries) if entry['expires_at'] < now]
+        self.evictions += 1
+        return expired[0] if expired else int(np.argmin(self._last_used[:count]))
+
+    def save(self):
+        """
+        Write a snapshot atomically (temp file + rename) if anything was added since the last one
+        """
+        if not self.writer or not self._unsaved:
+            return
+        with self._save_lock:
+            with self._lock:
+                count = len(self._entries)
+                vectors = self._vectors[:count].copy()
+                last_used = self._last_used[:count].copy()
+                meta = json.dumps({'version': VECTORIZER_VERSION, 'dimensions': DIMENSIONS, 'entries': self._entries})
+                self._unsaved = 0
+            try:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                temp = f"{self.path}.{os.getpid()}.tmp.npz"
+                np.savez(temp, vectors=vectors, last_used=last_used, meta=np.array(meta))
+                os.replace(temp, self.path)
+                logger.info(f"💾 Saved {count} {self.name} cache entries to {self.path}")
+            except Exception as e:
+                logger.warning(f"⚠️ Could not save {self.name} cache to {self.path}: {e}")
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path) as snapshot:
+                meta = json.loads(str(snapshot['meta']))
+                vectors = snapshot['vectors']
+                last_used = snapshot['last_used']
+        except Exception as e:
+            logger.warning(f"⚠️ Ignoring unreadable {self.name} cache snapshot {self.path}: {e}")
+            return
+        if meta.get('version') != VECTORIZER_VERSION or meta.get('dimensions') != DIMENSIONS:
+            logger.info(f"♻️ {self.name} cache snapshot is from another vectorizer version, starting empty")
+            return
+
+        now = time.time()
+        live = [i for i, entry in enumerate(meta['entries']) if entry['expires_at'] >= now]
+        # Most recently used first, so a smaller max_entries keeps the useful ones
+        live.sort(key=lambda i: last_used[i], reverse=True)
+        live = live[:self.max_entries]
+        with self._lock:
+            self._reserve(len(live))
+            self._entries = [meta['entries'][i] for i in live]
+            self._vectors[:len(live)] = vectors[live]
+            self._last_used[:len(live)] = last_used[live]
+        logger.info(f"📂 Loaded {len(live)} {self.name} cache entries from {self.path}")
+
+    def clear(self):
+        with self._lock:
+            self._entries = []
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "threshold": self.threshold,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "snapshot_writer": self.writer,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "avg_lookup_ms": round(self.lookup_seconds / lookups * 1000, 4) if lookups else 0.0
+        }
@@ -0,0 +1,22 @@
+import os
+
+# ⚙️ Multi-worker settings
+# Number of worker processes serving the app (python main.py starts them); WEB_CONCURRENCY is
+# what gunicorn reads, so `gunicorn -k uvicorn.workers.UvicornWorker main:app` works the same way
+WORKERS = max(1, int(os.getenv('WORKERS', os.getenv('WEB_CONCURRENCY', '1'))))
+# SQLite files every worker opens for state that must not be duplicated per process
+SHARED_STATE_DIR = os.getenv('SHARED_STATE_DIR', 'data/shared')
+
+
+def shared_path(filename):
+    """
+    Default SQLite path for state shared between workers; '' (per-process memory) with a single worker
+    """
+    return os.path.join(SHARED_STATE_DIR, filename) if WORKERS > 1 else ''
+
+
+def per_worker(total):
+    """
+    This worker's share of a deployment-wide budget (e.g. Gemini concurrency), rounded up
+    """
+    return max(1, -(-int(total) // WORKERS))
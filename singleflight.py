@@ -0,0 +1,45 @@
+import asyncio
+import copy
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one upstream call.
+
+    The first caller starts the work as a task; callers arriving while it is
+    still running await the same task and get a copy of its result. The task is
+    shielded, so one caller disconnecting doesn't cancel it for the others.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._tasks = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key, func):
+        """
+        Run func() (a coroutine factory) once per key among concurrent callers
+        """
+        task = self._tasks.get(key)
+        if task is not None:
+            self.coalesced += 1
+            logger.info(f"🔗 Joined in-flight {self.name} request")
+            result = await asyncio.shield(task)
+            return copy.deepcopy(result)
+
+        task = asyncio.ensure_future(func())
+        self._tasks[key] = task
+        self.leaders += 1
+        task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            "in_flight": len(self._tasks),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced
+        }
@@ -1,45 +1,27 @@
-import google.generativeai as genai
 from PIL import Image
+import asyncio
 import logging
-import json
-import os
 
-logger = logging.getLogger(__name__)
-
-# 🔑 Gemini API Key from environment variable ONLY (no hardcoded fallback)
-GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+from call_policy import CallPolicy
+from concurrency_limiter import Overloaded
+from image_preprocessing import ensure_prepared
+from inference import model_name_of, run_sync
+from metrics import FALLBACKS, annotate, stage
+from model_registry import SOIL_MODEL_NAMES, registry
+from perceptual_index import NearDuplicateIndex
+from prescreen import prescreener
+from prompts import PROMPTS, Prompt
+from response_schema import SALVAGED, Schema, StructuredParser
+from result_cache import cache_from_env, make_key
+from singleflight import SingleFlight
 
-if not GEMINI_API_KEY:
-    logger.error("❌ GEMINI_API_KEY environment variable not set!")
+logger = logging.getLogger(__name__)
 
-class SoilAnalyzer:
-    def __init__(self):
-        logger.info("🌱 Initializing Soil Analysis AI...")
-        try:
-            if not GEMINI_API_KEY:
-                raise Exception("GEMINI_API_KEY environment variable is missing")
-            
-            genai.configure(api_key=GEMINI_API_KEY)
-            self.model = genai.GenerativeModel('gemini-2.5-flash')
-            logger.info("✅ Soil Analyzer ready!")
-        except Exception as e:
-            logger.error(f"❌ Soil Analyzer initialization failed: {e}")
-            self.model = None
-    
-    def analyze_soil(self, image):
-        """
-        Analyze soil image using Gemini AI
-        """
-        try:
-            if not self.model:
-                return self._fallback_analysis()
-            
-            logger.info("🔍 Analyzing soil with Gemini AI...")
-            
-            prompt = """
+# Instructions for soil analysis, set once as the model's system instruction
+SOIL_INSTRUCTION = """
 You are an expert agricultural soil scientist with image recognition capabilities.
 
-FIRST, determine if this image shows SOIL or something else.
+FIRST, determine if each image you receive shows SOIL or something else.
 
 If this is SOIL, analyze it and provide:
 {
@@ -92,8 +74,208 @@ ANALYSIS RULES FOR SOIL:
 
 Respond with ONLY valid JSON.
 """
+
+# Sent instead of "Analyze this image." when several images are packed into one request
+MULTI_IMAGE_INSTRUCTIONS = """
+You will receive {count} images. Analyze each one independently and respond with ONLY a JSON array
+containing exactly {count} objects (soil or not-soil structure from your instructions), in the same order as the images.
+"""
+
+# Bump the version whenever the texts change (it is part of the result-cache key)
+SOIL_PROMPT = PROMPTS.register(Prompt('soil', 'v2', SOIL_INSTRUCTION, "Analyze this image.", MULTI_IMAGE_INSTRUCTIONS))
+
+NOT_SOIL_TIPS = [
+    "Take a photo of actual ground soil",
+    "Ensure good lighting",
+    "Remove any debris or objects",
+    "Focus on the soil surface"
+]
+
+# Soil and not-soil replies share one schema; also sent to Gemini as the response_schema in JSON mode
+SOIL_SCHEMA = Schema('soil', {
+    'is_soil': ('boolean', True),
+    'soil_type': ('string', 'Unknown'),
+    'color': ('string', 'Not determined'),
+    'texture': ('string', 'Medium'),
+    'moisture': ('string', 'Unknown'),
+    'ph_estimate': ('number', 6.5, 0.0, 14.0),
+    'nitrogen': ('string', 'Medium'),
+    'phosphorus': ('string', 'Medium'),
+    'potassium': ('string', 'Medium'),
+    'organic_matter': ('string', 'Medium'),
+    'recommendations': ('string', 'Consult local agricultural expert'),
+    'suitable_crops': ('string_list', ['Rice', 'Wheat', 'Vegetables']),
+    'improvements': ('string', 'Add organic compost'),
+    'detected_object': ('string', 'Unknown object'),
+    'message': ('string', 'This does not appear to be soil. Please upload a soil image.'),
+    'tips': ('string_list', NOT_SOIL_TIPS),
+}, required=('is_soil',),
+    # A salvaged soil reply must at least say which soil it is
+    complete=lambda data: data.get('is_soil') in (False, 'false') or 'soil_type' in data)
+
+class SoilAnalyzer:
+    def __init__(self):
+        logger.info("🌱 Initializing Soil Analysis AI...")
+        self.cache = cache_from_env('soil')
+        self.near_duplicates = NearDuplicateIndex('soil')
+        self.in_flight = SingleFlight('soil')
+        self._model = None
+        PROMPTS.configure(registry, 'soil')
+        # Deadline, retries and failover to the other Gemini models
+        self.policy = CallPolicy('soil', lambda: self.model)
+        self.parser = StructuredParser('soil', SOIL_SCHEMA)
+
+    @property
+    def model(self):
+        # Built lazily by the shared registry (or already warmed up by the app lifespan)
+        if self._model is None:
+            self._model = registry.get('soil', SOIL_MODEL_NAMES)
+        return self._model
+
+    @model.setter
+    def model(self, value):
+        self._model = value
+    
+    def analyze_soil(self, image):
+        """
+        Analyze soil image using Gemini AI
+        """
+        return run_sync(self.analyze_soil_async(image))
+
+    async def analyze_soil_async(self, image):
+        """
+        Non-blocking variant used by the API (Gemini call goes through the shared inference gateway)
+        """
+        await registry.wait_until_warm()
+        try:
+            # Downscaled, encoded once; the same bytes are hashed and sent to Gemini
+            image = ensure_prepared(image)
+            
+            # Obviously unusable photos (too dark, blurry, no soil colors) never reach a model
+            rejected = self._prescreen(image)
+            if rejected is not None:
+                annotate(answered_by='prescreen')
+                return rejected
             
-            response = self.model.generate_content([prompt, image])
+            if not self.model:
+                logger.error("Model not initialized")
+                return self._fallback_analysis()
+            
+            # Repeat uploads and near-duplicates are answered without calling Gemini
+            known, ticket = await self._lookup(image)
+            if known is not None:
+                annotate(answered_by='cache')
+                return known
+            
+            # Identical uploads already waiting on Gemini share one call
+            return await self.in_flight.do(ticket[0], lambda: self._analyze_with_gemini(image, ticket))
+            
+        except Overloaded:
+            raise
+        except Exception as e:
+            logger.error(f"Soil analysis error: {e}")
+            return self._fallback_analysis()
+    
+    async def analyze_soil_many_async(self, images):
+        """
+        Analyze several images with one multi-image Gemini prompt (results in input order)
+        """
+        await registry.wait_until_warm()
+        images = [ensure_prepared(image) for image in images]
+        results = [self._prescreen(image) for image in images]
+        if not self.model:
+            return [result or self._fallback_analysis() for result in results]
+        
+        tickets = [None] * len(images)
+        pending = []
+        for i, image in enumerate(images):
+            if results[i] is not None:
+                continue
+            results[i], tickets[i] = await self._lookup(image)
+            if results[i] is None:
+                pending.append(i)
+        
+        if len(pending) > 1:
+            logger.info(f"🔍 Analyzing {len(pending)} soil images in one prompt...")
+            try:
+                contents = SOIL_PROMPT.multi_contents([images[i].as_blob() for i in pending])
+                response = await self.policy.generate(contents,
+                                                      **self.parser.request_options(len(pending)))
+                with stage('parse'):
+                    items = self._parse_response_list(response.text, len(pending))
+                for i, result in zip(pending, items or []):
+                    if result is not None:
+                        results[i] = result
+                        self._remember(tickets[i], result, response.model_name)
+            except Overloaded:
+                raise
+            except Exception as e:
+                logger.error(f"Packed soil analysis failed: {e}")
+        
+        # Single image, or images the packed reply didn't cover: one call each
+        pending = [i for i in pending if results[i] is None]
+        singles = await asyncio.gather(*(
+            self.in_flight.do(tickets[i][0], lambda i=i: self._analyze_with_gemini(images[i], tickets[i]))
+            for i in pending
+        ))
+        for i, result in zip(pending, singles):
+            results[i] = result
+        
+        return results
+    
+    def _prescreen(self, image):
+        """
+        Not-soil result for a photo the local pre-screen rejects, None if it should be analyzed
+        """
+        rejected = prescreener.screen(image, 'soil')
+        if rejected is None:
+            return None
+        result = self._result_from_data({
+            'is_soil': False,
+            'detected_object': "Something other than soil" if rejected['reason'] == 'not_soil' else "Unclear photo",
+            'message': rejected['message'],
+            'tips': rejected['tips']
+        })
+        result["prescreen"] = rejected['reason']
+        return result
+    
+    async def _lookup(self, image):
+        """
+        Result cache, then near-duplicate index. Returns (known result or None, ticket for _remember)
+        """
+        with stage('cache_lookup'):
+            model_name = model_name_of(self.model)
+            cache_key, namespace = self._cache_keys(image.data, model_name)
+            cached = await self.cache.get_async(cache_key)
+            if cached is not None:
+                logger.info(f"⚡ Cache hit: {cached['soil_type']}")
+                return cached, None
+            
+            # Re-photographed or re-compressed copies of an image we've already analyzed
+            image_hash = image.perceptual_hash(self.near_duplicates.algorithm) if self.near_duplicates.enabled else None
+            ticket = (cache_key, namespace, image_hash, model_name, image.data)
+            return self.near_duplicates.lookup(image_hash, namespace), ticket
+    
+    def _cache_keys(self, data, model_name):
+        return make_key(data, SOIL_PROMPT.key, model_name), f"{model_name}:{SOIL_PROMPT.key}"
+
+    def _remember(self, ticket, result, model_name):
+        # Only successful parses are cached, under the model that answered (not the primary after a failover)
+        if result.pop(SALVAGED, False):
+            # Recovered from a truncated reply: answer this request, but don't serve its defaults again
+            return
+        cache_key, namespace, image_hash, looked_up, data = ticket
+        if model_name != looked_up:
+            cache_key, namespace = self._cache_keys(data, model_name)
+        self.cache.set_behind(cache_key, result)
+        self.near_duplicates.add(image_hash, namespace, result)
+    
+    async def _analyze_with_gemini(self, image, ticket):
+        try:
+            logger.info("🔍 Analyzing soil with Gemini AI...")
+            
+            response = await self.policy.generate(SOIL_PROMPT.contents(image.as_blob()),
+                                                 **self.parser.request_options())
             
             if not response or not response.text:
                 logger.error("Empty response from Gemini")
@@ -101,99 +283,91 @@ Respond with ONLY valid JSON.
             
             logger.info(f"📥 Gemini soil analysis: {response.text[:200]}...")
             
-            result = self._parse_response(response.text)
+            with stage('parse'):
+                result = self._parse_response(response.text)
+            if result is None:
+                return self._fallback_analysis()
             
             if result.get('is_soil', True):
                 logger.info(f"🌱 Soil Type: {result['soil_type']}, pH: {result['ph_estimate']}")
             else:
                 logger.info(f"❌ Not soil - Detected: {result.get('detected_object', 'Unknown object')}")
             
+            self._remember(ticket, result, response.model_name)
             return result
             
+        except Overloaded:
+            raise
         except Exception as e:
             logger.error(f"Soil analysis error: {e}")
             return self._fallback_analysis()
     
     def _parse_response(self, response_text):
-        try:
-            json_text = response_text.strip()
-            
-            # Remove markdown
-            if '```' in json_text:
-                parts = json_text.split('```')
-                for part in parts:
-                    if part.strip().startswith('json'):
-                        json_text = part.strip()[4:].strip()
-                        break
-                    elif part.strip().startswith('{'):
-                        json_text = part.strip()
-                        break
-            
-            data = json.loads(json_text.strip())
-            
-            # Check if it's soil or not
-            is_soil = data.get('is_soil', True)
-            
-            if not is_soil:
-                # Return non-soil response - NO ph_estimate parsing needed!
-                logger.info(f"🚫 Not soil detected: {data.get('detected_object', 'Unknown')}")
-                return {
-                    "success": False,
-                    "is_soil": False,
-                    "detected_object": data.get('detected_object', 'Unknown object'),
-                    "message": data.get('message', 'This does not appear to be soil. Please upload a soil image.'),
-                    "tips": data.get('tips', [
-                        "Take a photo of actual ground soil",
-                        "Ensure good lighting",
-                        "Remove any debris or objects",
-                        "Focus on the soil surface"
-                    ]),
-                    "soil_type": "Not Soil",
-                    "color": "N/A",
-                    "texture": "N/A",
-                    "moisture": "N/A",
-                    "ph_estimate": 0,
-                    "nitrogen": "N/A",
-                    "phosphorus": "N/A",
-                    "potassium": "N/A",
-                    "organic_matter": "N/A",
-                    "recommendations": "Please upload a valid soil image for analysis.",
-                    "suitable_crops": [],
-                    "improvements": "N/A"
-                }
-            
-            # Return soil analysis - parse ph_estimate safely
-            ph_value = data.get('ph_estimate', 6.5)
-            try:
-                ph_value = float(ph_value) if ph_value is not None else 6.5
-            except (ValueError, TypeError):
-                ph_value = 6.5
-            
+        """
+        Parse Gemini's JSON response (returns None if it can't be parsed)
+        """
+        return self._result_from_parse(self.parser.parse_one(response_text))
+    
+    def _parse_response_list(self, response_text, expected):
+        """
+        Parse a multi-image reply (JSON array, one object per image): a result or None per image, or None
+        """
+        items = self.parser.parse_many(response_text, expected)
+        if items is None:
+            return None
+        return [self._result_from_parse(item) for item in items]
+    
+    def _result_from_parse(self, data):
+        if data is None:
+            return None
+        result = self._result_from_data(data)
+        if data.get(SALVAGED):
+            result[SALVAGED] = True
+        return result
+    
+    def _result_from_data(self, data):
+        # data is already validated and defaulted by SOIL_SCHEMA
+        if not data['is_soil']:
+            logger.info(f"🚫 Not soil detected: {data['detected_object']}")
             return {
-                "success": True,
-                "is_soil": True,
-                "soil_type": data.get('soil_type', 'Unknown'),
-                "color": data.get('color', 'Not determined'),
-                "texture": data.get('texture', 'Medium'),
-                "moisture": data.get('moisture', 'Unknown'),
-                "ph_estimate": ph_value,
-                "nitrogen": data.get('nitrogen', 'Medium'),
-                "phosphorus": data.get('phosphorus', 'Medium'),
-                "potassium": data.get('potassium', 'Medium'),
-                "organic_matter": data.get('organic_matter', 'Medium'),
-                "recommendations": data.get('recommendations', 'Consult local agricultural expert'),
-                "suitable_crops": data.get('suitable_crops', ['Rice', 'Wheat', 'Vegetables']),
-                "improvements": data.get('improvements', 'Add organic compost')
+                "success": False,
+                "is_soil": False,
+                "detected_object": data['detected_object'],
+                "message": data['message'],
+                "tips": list(data['tips']),
+                "soil_type": "Not Soil",
+                "color": "N/A",
+                "texture": "N/A",
+                "moisture": "N/A",
+                "ph_estimate": 0,
+                "nitrogen": "N/A",
+                "phosphorus": "N/A",
+                "potassium": "N/A",
+                "organic_matter": "N/A",
+                "recommendations": "Please upload a valid soil image for analysis.",
+                "suitable_crops": [],
+                "improvements": "N/A"
             }
-            
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON parse error: {e}")
-            return self._fallback_analysis()
-        except Exception as e:
-            logger.error(f"Failed to parse soil response: {e}")
-            return self._fallback_analysis()
+        
+        return {
+            "success": True,
+            "is_soil": True,
+            "soil_type": data['soil_type'],
+            "color": data['color'],
+            "texture": data['texture'],
+            "moisture": data['moisture'],
+            "ph_estimate": data['ph_estimate'],
+            "nitrogen": data['nitrogen'],
+            "phosphorus": data['phosphorus'],
+            "potassium": data['potassium'],
+            "organic_matter": data['organic_matter'],
+            "recommendations": data['recommendations'],
+            "suitable_crops": list(data['suitable_crops']),
+            "improvements": data['improvements']
+        }
     
     def _fallback_analysis(self):
+        FALLBACKS.inc(service='soil')
         return {
             "success": False,
             "is_soil": True,
@@ -0,0 +1,186 @@
+import json
+import logging
+import os
+
+from starlette.formparsers import MultiPartParser
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# ⚙️ Upload settings
+UPLOAD_MAX_MB = float(os.getenv('UPLOAD_MAX_MB', '15'))
+# Batch requests carry many images or a zip archive
+UPLOAD_MAX_BATCH_MB = float(os.getenv('UPLOAD_MAX_BATCH_MB', '200'))
+# Rejected from the header alone, before any pixels are decoded (decompression bombs);
+# 40MP is well above any phone camera
+UPLOAD_MAX_PIXELS = int(os.getenv('UPLOAD_MAX_PIXELS', str(40_000_000)))
+UPLOAD_MAX_SIDE = int(os.getenv('UPLOAD_MAX_SIDE', '12000'))
+# Uploads up to this size stay in memory while the multipart body is parsed; larger ones spill to a temp file
+UPLOAD_SPOOL_KB = int(os.getenv('UPLOAD_SPOOL_KB', '1024'))
+
+# PIL decoders allowed to touch uploads (no EPS/PSD/etc. parsers on untrusted input)
+ALLOWED_FORMATS = ('JPEG', 'PNG', 'WEBP', 'GIF', 'BMP', 'TIFF')
+
+# (offset, signature, format) checked against the first bytes of the upload
+MAGIC_BYTES = (
+    (0, b'\xff\xd8\xff', 'JPEG'),
+    (0, b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (8, b'WEBP', 'WEBP'),
+    (0, b'GIF87a', 'GIF'),
+    (0, b'GIF89a', 'GIF'),
+    (0, b'BM', 'BMP'),
+    (0, b'II*\x00', 'TIFF'),
+    (0, b'MM\x00*', 'TIFF'),
+)
+
+UPLOAD_REJECTIONS = REGISTRY.counter('upload_rejections', 'Uploads refused before decoding, by reason', ('reason',))
+
+MultiPartParser.max_file_size = UPLOAD_SPOOL_KB * 1024
+
+
+class UploadRejected(Exception):
+    """
+    Upload refused before it was decoded; status_code is the HTTP status to answer with
+    """
+    status_code = 400
+    reason = 'invalid'
+
+
+class UploadTooLarge(UploadRejected):
+    status_code = 413
+    reason = 'too_large'
+
+
+class UnsupportedImage(UploadRejected):
+    status_code = 415
+    reason = 'unsupported_format'
+
+
+class ImageTooLarge(UploadRejected):
+    """
+    Header declares more pixels than we're willing to decode (likely a decompression bomb)
+    """
+    status_code = 413
+    reason = 'too_many_pixels'
+
+
+def reject(error):
+    UPLOAD_REJECTIONS.inc(reason=error.reason)
+    logger.warning(f"🛑 Upload rejected ({error.reason}): {error}")
+    raise error
+
+
+def sniff_format(head):
+    """
+    Image format from the file signature, or None if it isn't one we accept
+    """
+    for offset, signature, fmt in MAGIC_BYTES:
+        if head[offset:offset + len(signature)] == signature:
+            if fmt == 'WEBP' and head[:4] != b'RIFF':
+                continue
+            return fmt
+    return None
+
+
+def check_dimensions(width, height, max_pixels=UPLOAD_MAX_PIXELS, max_side=UPLOAD_MAX_SIDE):
+    """
+    Refuse images whose declared size would be too expensive to decode
+    """
+    if width <= 0 or height <= 0:
+        reject(UploadRejected(f"invalid image dimensions {width}x{height}"))
+    if width * height > max_pixels or max(width, height) > max_side:
+        reject(ImageTooLarge(f"image is {width}x{height} ({width * height / 1e6:.0f}MP, "
+                             f"limit {max_pixels / 1e6:.0f}MP / {max_side}px per side)"))
+
+
+def open_upload(upload, max_bytes=None):
+    """
+    Validate an UploadFile without reading it into memory: size from the spooled
+    file, format from the magic bytes. Returns the file rewound to the start,
+    ready for PIL (which reads the header first and checks dimensions, see
+    image_preprocessing.open_image)
+    """
+    max_bytes = max_bytes or int(UPLOAD_MAX_MB * 1024 * 1024)
+    file = upload.file
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    if size == 0:
+        reject(UploadRejected("empty upload"))
+    if size > max_bytes:
+        reject(UploadTooLarge(f"upload is {size / 1e6:.1f}MB (limit {max_bytes / 1e6:.1f}MB)"))
+    file.seek(0)
+    if sniff_format(file.read(16)) is None:
+        reject(UnsupportedImage(f"{upload.filename or 'upload'} is not a supported image "
+                                f"({', '.join(ALLOWED_FORMATS)})"))
+    file.seek(0)
+    return file
+
+
+def read_upload(upload, max_bytes=None):
+    """
+    Validated upload bytes, for callers that must keep them (queued jobs)
+    """
+    return open_upload(upload, max_bytes).read()
+
+
+class UploadLimitMiddleware:
+    """
+    ASGI middleware: 413 for request bodies over the limit, checked against
+    Content-Length up front and counted while the body streams in, so an
+    oversized upload is cut off instead of being spooled to the end
+    """
+
+    def __init__(self, app, max_mb=UPLOAD_MAX_MB, max_batch_mb=UPLOAD_MAX_BATCH_MB):
+        self.app = app
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.max_batch_bytes = int(max_batch_mb * 1024 * 1024)
+
+    def limit_for(self, path):
+        # Form fields and multipart framing add a little on top of the file itself
+        return (self.max_batch_bytes if path.endswith('/batch') else self.max_bytes) + 64 * 1024
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] not in ('POST', 'PUT'):
+            await self.app(scope, receive, send)
+            return
+
+        limit = self.limit_for(scope['path'])
+        headers = dict(scope['headers'])
+        declared = headers.get(b'content-length')
+        if declared is not None and declared.isdigit() and int(declared) > limit:
+            await self._reject(send, int(declared), limit)
+            return
+
+        received = 0
+        exceeded = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    exceeded = True
+                    raise UploadTooLarge(f"request body over {limit / 1e6:.1f}MB")
+            return message
+
+        async def guarded_send(message):
+            # The body parser turns the abort into its own 400; answer 413 instead
+            if not exceeded:
+                await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except UploadTooLarge:
+            pass
+        if exceeded:
+            await self._reject(send, received, limit)
+
+    async def _reject(self, send, size, limit):
+        UPLOAD_REJECTIONS.inc(reason='body_too_large')
+        logger.warning(f"🛑 Request body too large ({size / 1e6:.1f}MB+, limit {limit / 1e6:.1f}MB)")
+        body = json.dumps({"success": False, "error": f"upload too large (limit {limit / 1e6:.0f}MB)"}).encode()
+        await send({'type': 'http.response.start', 'status': 413,
+                    'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})